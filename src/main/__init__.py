@@ -5,4 +5,6 @@ fmt = getattr(settings, 'LOG_FORMAT', None)
 lvl = getattr(settings, 'LOG_LEVEL', logging.DEBUG)
 
 logging.basicConfig(format=fmt, level=lvl)
-logging.debug("Logging started on %s for %s" % (logging.root.name, logging.getLevelName(lvl)))
\ No newline at end of file
+logging.debug("Logging started on %s for %s" % (logging.root.name, logging.getLevelName(lvl)))
+
+default_app_config = 'main.apps.MainConfig'
@@ -0,0 +1,362 @@
+""" Contains the admission control of transcriptions. The requests of the index view used to be processed in arrival
+order, so a few long uploads could hold up the short chunks of the live recorders, whose latency is what users notice.
+Every transcription now asks the AdmissionController of the process for room for its audio before it is decoded and
+recognized (see ADMISSION in settings.py):
+
+- Work is classified by its duration, read from the header of the file or estimated from its size (the WebM chunks of
+  the recorder have no duration in their header): recording chunks and audio of up to SHORT_SECONDS are "live",
+  longer uploads are "bulk". The exact duration replaces the estimate once the audio is decoded.
+- At most MAX_INFLIGHT_SECONDS seconds of audio are processed at the same time (a longer file is admitted alone).
+  Waiting work is admitted live first and shortest first within a class, new work that fits only overtakes work that
+  waits if it comes first in that order.
+- Bulk work may only use a BULK_SHARE of that, the rest is reserved for live work: a recording chunk is never held up
+  by long uploads that were admitted before it. A bulk file counts as at most that share while it is decoded, the
+  segments of long audio are admitted one by one before they are recognized (see admit_segment()), so one long file
+  does not claim the whole capacity.
+- Under overload, requests are shed (the view answers with a 429 and Retry-After) when the audio that waits in their
+  class would exceed MAX_QUEUED_SECONDS, or when they waited longer than MAX_WAIT seconds. Transcription jobs are
+  deferred instead: they wait until there is room, however long that takes, without a thread (see admit_later()).
+
+The decisions are counted per class and exposed at /metrics (speech_admission), the waits are timed as the
+"admission" stage. The limit applies per process, with more than one worker every worker has its own.
+"""
+
+import asyncio
+import itertools
+import math
+import threading
+import time
+from collections import Counter
+from typing import Callable, Union
+from django.core.files import File
+from src.main.instrumentation import record_stage
+from src.main.probe import HEADER_BYTES, probe_header
+import src.recorder.settings as cfg
+
+LIVE = 'live'
+BULK = 'bulk'
+CLASSES = (LIVE, BULK)
+
+
+class Overloaded(Exception):
+    """ Raised when a transcription is shed.
+
+    Attributes:
+        retry_after (int): Seconds after which the client may try again.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """ The admission of one transcription, release it (or leave the with block) when the work is done.
+
+    Attributes:
+        work_class (str): LIVE or BULK.
+        seconds (float): Seconds of audio that are accounted for the work (bulk work at most the bulk share).
+    """
+
+    def __init__(self, controller, work_class: str, seconds: float, order: int = 0):
+        self.controller = controller
+        self.work_class = work_class
+        self.seconds = seconds
+        self.order = order
+        self.admitted = False
+        self.grant = None
+
+    @property
+    def key(self) -> tuple:
+        """ Admission order: live first, then shortest first, then first come. """
+        return CLASSES.index(self.work_class), self.seconds, self.order
+
+    def resize(self, seconds: float):
+        """ Replaces the estimated duration by the exact one. """
+        if self.controller is not None:
+            self.controller.resize(self, seconds)
+
+    def release(self):
+        if self.controller is not None:
+            self.controller.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class AdmissionController:
+    """ Limits the seconds of audio that are processed at the same time and admits waiting work shortest job first
+    (see above).
+
+    Arguments:
+        max_inflight_seconds (float): Maximum seconds of audio that are processed at the same time.
+        short_seconds (float): Uploads up to this duration are live work.
+        max_wait (dict): Seconds a request of a class waits for admission before it is shed.
+        max_queued_seconds (dict): Seconds of audio of a class that may wait, more is shed.
+        bulk_share (float): Share of max_inflight_seconds that bulk work may use, the rest is reserved for live work.
+    """
+
+    def __init__(self, max_inflight_seconds: float, short_seconds: float, max_wait: dict, max_queued_seconds: dict,
+                 bulk_share: float = 0.5):
+        self.max_inflight_seconds = max_inflight_seconds
+        self.short_seconds = short_seconds
+        self.max_wait = max_wait
+        self.max_queued_seconds = max_queued_seconds
+        self.max_bulk_seconds = max_inflight_seconds * bulk_share
+        self.inflight = 0.0
+        self.inflight_bulk = 0.0
+        self.active = 0
+        self.waiting = []
+        self.order = itertools.count()
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def classify(self, seconds: float, is_recording: bool = False) -> str:
+        return LIVE if is_recording or seconds <= self.short_seconds else BULK
+
+    def _account(self, work_class: str, seconds: float) -> float:
+        """ Returns the seconds that are accounted for work, bulk work counts as at most the bulk share. """
+        return min(seconds, self.max_bulk_seconds) if work_class == BULK else seconds
+
+    def _fits(self, ticket: Ticket) -> bool:
+        if self.inflight + ticket.seconds > self.max_inflight_seconds:
+            return self.active == 0
+        # Bulk work never takes the reserve of live work
+        return ticket.work_class == LIVE or self.inflight_bulk + ticket.seconds <= self.max_bulk_seconds
+
+    def _add(self, ticket: Ticket, sign: int):
+        self.inflight += sign * ticket.seconds
+        self.active += sign
+        if ticket.work_class == BULK:
+            self.inflight_bulk += sign * ticket.seconds
+
+    def _admit(self, ticket: Ticket):
+        ticket.admitted = True
+        self._add(ticket, 1)
+
+    def _shed(self, ticket: Ticket):
+        self.counters["shed_" + ticket.work_class] += 1
+        raise Overloaded("The server is busy, please try again later.",
+                         max(1, math.ceil(self.max_wait[ticket.work_class])))
+
+    def _enter(self, seconds: float, is_recording: bool, deferred: bool, work_class: str = None) -> Ticket:
+        """ Admits the work now or queues it, raises Overloaded if it is shed. Call it with the lock held. """
+        work_class = work_class or self.classify(seconds, is_recording)
+        ticket = Ticket(self, work_class, self._account(work_class, seconds), next(self.order))
+        if self._fits(ticket) and (not self.waiting or ticket.key < min(waiter.key for waiter in self.waiting)):
+            self._admit(ticket)
+            self.counters["admitted_" + ticket.work_class] += 1
+            return ticket
+
+        queued = sum(waiter.seconds for waiter in self.waiting if waiter.work_class == ticket.work_class)
+        if not deferred and queued + ticket.seconds > self.max_queued_seconds[ticket.work_class]:
+            self._shed(ticket)
+        self.waiting.append(ticket)
+        self.counters["deferred_" + ticket.work_class] += 1
+        return ticket
+
+    def _dispatch(self):
+        """ Admits waiting work in order while it fits. Call it with the lock held. """
+        while self.waiting:
+            ticket = min(self.waiting, key=lambda waiter: waiter.key)
+            if not self._fits(ticket):
+                return
+            self.waiting.remove(ticket)
+            self._admit(ticket)
+            try:
+                ticket.grant()
+            except RuntimeError:
+                # The event loop of the waiter is closed
+                self._add(ticket, -1)
+                ticket.admitted = False
+                continue
+            self.counters["admitted_" + ticket.work_class] += 1
+
+    def _abandon(self, ticket: Ticket) -> bool:
+        """ Sheds work that stopped waiting. Returns False if it was admitted in the meantime. """
+        with self.lock:
+            if ticket not in self.waiting:
+                return False
+            self.waiting.remove(ticket)
+            self._dispatch()
+            self.counters["shed_" + ticket.work_class] += 1
+            return True
+
+    def admit(self, seconds: float, is_recording: bool = False, deferred: bool = False,
+              work_class: str = None) -> Ticket:
+        """ Waits until the work is admitted.
+
+        Arguments:
+            seconds (float): Duration of the audio.
+            is_recording (bool): The audio is a chunk of a live recording.
+            deferred (bool): Wait as long as it takes instead of shedding the work (for jobs).
+            work_class (str): Class of the work, instead of classifying it by its duration.
+
+        Returns:
+            The admission (Ticket).
+
+        Raises:
+            Overloaded: If the work is shed.
+        """
+        start = time.perf_counter()
+        with self.lock:
+            ticket = self._enter(seconds, is_recording, deferred, work_class)
+            if ticket.admitted:
+                return ticket
+            granted = threading.Event()
+            ticket.grant = granted.set
+
+        if not granted.wait(None if deferred else self.max_wait[ticket.work_class]) and self._abandon(ticket):
+            raise Overloaded("The server is busy, please try again later.",
+                             max(1, math.ceil(self.max_wait[ticket.work_class])))
+        record_stage("admission", time.perf_counter() - start)
+        return ticket
+
+    async def admit_async(self, seconds: float, is_recording: bool = False, deferred: bool = False) -> Ticket:
+        """ Waits until the work is admitted like admit(), without blocking the event loop. """
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        with self.lock:
+            ticket = self._enter(seconds, is_recording, deferred)
+            if ticket.admitted:
+                return ticket
+            granted = loop.create_future()
+
+            def grant():
+                loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+            ticket.grant = grant
+
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), None if deferred else self.max_wait[ticket.work_class])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if self._abandon(ticket):
+                if isinstance(ex, asyncio.CancelledError):
+                    raise
+                raise Overloaded("The server is busy, please try again later.",
+                                 max(1, math.ceil(self.max_wait[ticket.work_class])))
+            if isinstance(ex, asyncio.CancelledError):
+                # The work was admitted while the waiter gave up
+                ticket.release()
+                raise
+        record_stage("admission", time.perf_counter() - start)
+        return ticket
+
+    def admit_later(self, seconds: float, is_recording: bool, on_admit: Callable[[Ticket], None]) -> Ticket:
+        """ Admits deferred work without waiting for it: on_admit(ticket) is called once the work is admitted, right
+        away or by the thread that makes room for it (with the lock held, it must not block).
+
+        Arguments:
+            seconds (float): Duration of the audio.
+            is_recording (bool): The audio is a chunk of a live recording.
+            on_admit (Callable): Starts the admitted work.
+
+        Returns:
+            The admission (Ticket).
+        """
+        start = time.perf_counter()
+        with self.lock:
+            ticket = self._enter(seconds, is_recording, True)
+            if not ticket.admitted:
+                def grant():
+                    record_stage("admission", time.perf_counter() - start)
+                    on_admit(ticket)
+                ticket.grant = grant
+                return ticket
+        on_admit(ticket)
+        return ticket
+
+    def resize(self, ticket: Ticket, seconds: float):
+        with self.lock:
+            if ticket.admitted:
+                self._add(ticket, -1)
+                ticket.seconds = self._account(ticket.work_class, seconds)
+                self._add(ticket, 1)
+                self._dispatch()
+
+    def release(self, ticket: Ticket):
+        with self.lock:
+            if ticket.admitted:
+                ticket.admitted = False
+                self._add(ticket, -1)
+                self._dispatch()
+
+    def stats(self) -> dict:
+        """ Admitted, deferred (they had to wait) and shed work per class, the seconds of audio in flight (in total
+        and bulk) and waiting. """
+        with self.lock:
+            stats = dict(self.counters, active=self.active, waiting=len(self.waiting),
+                         inflight_seconds=round(max(self.inflight, 0.0), 2),
+                         inflight_bulk_seconds=round(max(self.inflight_bulk, 0.0), 2),
+                         queued_seconds=round(sum(waiter.seconds for waiter in self.waiting), 2))
+        return stats
+
+
+def estimate_duration(file: File) -> float:
+    """ Returns the duration of an uploaded file in seconds from its header, without decoding it. Files without a
+    duration in their header are estimated from their size (ADMISSION['BYTES_PER_SECOND']). """
+    head = file.read(HEADER_BYTES)
+    file.seek(0)
+    info = probe_header(head, file.size, file.name, getattr(file, 'content_type', None))
+    if info is not None and info.duration > 0:
+        return info.duration
+    return file.size / float(cfg.ADMISSION['BYTES_PER_SECOND'])
+
+
+def admit(file: File, is_recording: bool = False, deferred: bool = False) -> Ticket:
+    """ Waits until the transcription of an uploaded file is admitted, see AdmissionController.admit(). """
+    seconds = estimate_duration(file)
+    controller = get_admission_controller()
+    if controller is None:
+        return Ticket(None, LIVE, seconds)
+    return controller.admit(seconds, is_recording, deferred)
+
+
+async def admit_async(file: File, is_recording: bool = False, deferred: bool = False) -> Ticket:
+    """ Like admit(), without blocking the event loop. """
+    seconds = estimate_duration(file)
+    controller = get_admission_controller()
+    if controller is None:
+        return Ticket(None, LIVE, seconds)
+    return await controller.admit_async(seconds, is_recording, deferred)
+
+
+def admit_later(file: File, is_recording: bool, on_admit: Callable[[Ticket], None]) -> Ticket:
+    """ Admits the deferred transcription of an uploaded file without waiting, see AdmissionController.admit_later().
+    """
+    seconds = estimate_duration(file)
+    controller = get_admission_controller()
+    if controller is None:
+        ticket = Ticket(None, LIVE, seconds)
+        on_admit(ticket)
+        return ticket
+    return controller.admit_later(seconds, is_recording, on_admit)
+
+
+def admit_segment(seconds: float, work_class: str) -> Ticket:
+    """ Waits until a segment of long audio whose transcription was admitted before is admitted (see above), as work
+    of the class of the transcription. Segments are not shed, the transcription has started already. """
+    controller = get_admission_controller()
+    if controller is None:
+        return Ticket(None, work_class, seconds)
+    return controller.admit(seconds, deferred=True, work_class=work_class)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> Union[AdmissionController, None]:
+    """ Returns the admission controller of this process, configured by ADMISSION in settings.py, None if admission
+    control is disabled. """
+    global _controller
+    if not cfg.ADMISSION['ENABLED']:
+        return None
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController(cfg.ADMISSION['MAX_INFLIGHT_SECONDS'], cfg.ADMISSION['SHORT_SECONDS'],
+                                              cfg.ADMISSION['MAX_WAIT'], cfg.ADMISSION['MAX_QUEUED_SECONDS'],
+                                              cfg.ADMISSION['BULK_SHARE'])
+        return _controller
@@ -1,138 +1,195 @@
 """ Contains a module used for analyzing/saving audio files that are sent to the server by recording or upload and
-manages some backend tasks for views.py. Also contains a class and method for creating/loading the models as described
-in settings.py. The models will only be loaded one time at server start if create_global_models() is used properly.
+manages some backend tasks for views.py. Also contains create_global_models(), which loads the local models described
+by MODELS in settings.py (see inference.py). The models are only loaded one time per worker process if
+create_global_models() is used properly: at boot (WARM_UP does), in every worker, after a preforking server forked it.
 """
 
 import logging
 import time
-import subprocess
-from typing import Tuple
+from typing import Tuple, Union
+from asgiref.sync import sync_to_async
+from django.core.files import File
 from django.core.files.uploadedfile import UploadedFile
-from django.core.files.storage import FileSystemStorage
-import librosa
 import src.recorder.settings as cfg
-import os
-import dialogflow_v2 as dialogflow
-import mutagen.mp3
-import jiwer
+from src.main.audio import DecodedAudio, decode_audio, decode_audio_async, load_audio, map_file
+from src.main.probe import probe_audio
+from src.main.recognizers import get_recognizer
+from src.main.inference import get_model_registry
+from src.main.admission import Ticket, admit, admit_async, admit_segment
+from src.main.metrics import align, score
+from src.main.normalization import split_words
+from src.main.cache import cache_key, get_transcription_cache
+from src.main.vad import trim_silence
+from src.main.segmentation import needs_segmentation, recognize_segments
+from src.main.instrumentation import timed
+from src.main.media import MediaStore, get_media_store
+
+
+def create_global_models() -> dict:
+    """ Loads every model of MODELS in settings.py into the model registry of this process and predicts half a second
+    of silence with it, so the first request does not pay for loading the model and building its prediction function.
+    A model that can not be loaded is logged and skipped (the requests that need it will fail).
+
+    Returns:
+        dict: Seconds spent per model, None for the models that could not be loaded.
+    """
+    registry = get_model_registry()
+    silence = DecodedAudio(bytes(cfg.SAMPLE_RATE), cfg.SAMPLE_RATE)
+    timings = {}
+    for name in cfg.MODELS:
+        start = time.time()
+        try:
+            registry.get(name).transcribe(silence)
+            timings[name] = round(time.time() - start, 4)
+
+        except Exception as ex:
+            logging.warning("Model '%s' could not be loaded: %s", name, ex)
+            timings[name] = None
+
+    return timings
+
+
+def _keep(file: UploadedFile, is_recording: bool, store: MediaStore) -> Tuple[bytes, str, Union[str, None], bool]:
+    """ Reads the upload, or keeps it in the media store if it is not spooled (processed in memory only): it is
+    copied in chunks and the stored file is memory-mapped, so a large upload is never read into memory.
+
+    Returns:
+        The data (bytes, or the mapped stored file), the name of the upload (str), the name in the store (str, None if
+        it is spooled) and whether it is spooled (bool).
+    """
+    name = file.name + '.webm' if is_recording else file.name
+    file = file if isinstance(file, File) else File(file)
+    with timed("save"):
+        spooled = is_recording or file.size <= cfg.MEDIA['SPOOL_MAX_BYTES'] or not cfg.MEDIA['PERSIST']
+        if spooled:
+            store.count_spooled()
+            return file.read(), name, None, True
+        filename = store.save_file(file, name)
+        return map_file(store.path(filename)), name, filename, False
+
+
+def _describe(context: dict, audio: DecodedAudio, name: str, filename: Union[str, None], store: MediaStore) -> dict:
+    """ Adds the file name, path and audio features of a saved recording to the context. """
+    context["filename"] = filename or name
+    context["to_be_analyzed"] = store.path(filename) if filename else None
+    context["audio_bitrate"], context["audio_length"] = get_audio_features(audio, round_duration=True)
+    context["audio_extension"] = name.split('.')[-1]
+    return context
 
 
-def save_recording(context: dict, file: UploadedFile, is_recording: bool = False) -> Tuple[dict, str]:
-    """ Converts recording from .webm to .wav if necessary and saves it after.
-    TODO: Work for more filetypes (only webm to wav is supported at the moment).
+def save_recording(context: dict, file: UploadedFile, is_recording: bool = False,
+                   store: MediaStore = None) -> Tuple[dict, DecodedAudio]:
+    """ Decodes the uploaded file once, in memory, to mono 16-bit PCM. Recordings and short uploads are processed in
+    memory only, larger uploads are kept in the content addressed media store if MEDIA['PERSIST'] is set (see
+    media.py).
 
     Arguments:
         context (dict): Context dictionary containing project wide variables.
         file (File): File uploaded to POST (most likely through request.FILES).
         is_recording (bool): Specifies whether the file is a recording or an uploaded file.
+        store (MediaStore): Where the file is kept, defaults to the media store of MEDIA_ROOT.
 
     Returns:
-        The path to the saved .wav recording (str).
+        The updated context (dict) and the decoded audio (DecodedAudio) that should be used for further analysis.
     """
-    fs = FileSystemStorage(cfg.MEDIA_ROOT)
+    store = store or get_media_store()
 
     if file:
-        if is_recording:
-            try:
-                # On audio recording:
-                filename = fs.save(file.name + '.webm', file)
-                # Convert file from webm to wav using FFMPEG:
-                webm_path = os.path.join(cfg.MEDIA_ROOT, filename)
-                subprocess.call('ffmpeg -y -i {} -acodec pcm_s16le -ac 1 -ar 48000 {}.wav'
-                                .format(webm_path,
-                                        os.path.join(cfg.MEDIA_ROOT, filename.split('.webm')[0])),
-                                shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-                os.remove(webm_path)
-                filename = filename.replace(filename.split('.')[-1], 'wav')
-                assert (os.path.exists(os.path.join(cfg.MEDIA_ROOT, filename))), \
-                    "FFPMEG failed to convert the file to wav, please check if you have FFMPEG installed."
-
-            except Exception as ex:
-                logging.error("An error occurred while saving and converting the recording from .webm to .wav.")
-                raise ex
+        # Uploads have been decoded while they were received (see uploads.py)
+        decoder = getattr(file, 'decoder', None)
+        try:
+            data, name, filename, spooled = _keep(file, is_recording, store)
+            with timed("decode"):
+                if decoder is not None:
+                    audio = decoder.result(source=data, mapped=not spooled,
+                                           path=store.path(filename) if filename else None)
+                elif spooled:
+                    audio = decode_audio(data, name=name)
+                else:
+                    # FFMPEG reads the stored file
+                    audio = decode_audio(data, name=filename, mapped=True, path=store.path(filename))
 
-        else:
-            try:
-                filename = fs.save(file.name, file)
-                filename = os.path.join(cfg.MEDIA_ROOT, filename)
-                if filename.split(".")[-1] == "wav":
-                    subprocess.call('ffmpeg -y -i {} -acodec pcm_s16le -ac 1 -ar 48000 {}_converted.wav'
-                                    .format(filename, filename[:-4]),
-                                    shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                    os.remove(filename)
-                    filename = filename[:-4] + "_converted.wav"
+        except Exception as ex:
+            logging.error("An error occurred while saving and decoding the %s.",
+                          "recording" if is_recording else "uploaded recording")
+            if decoder is not None:
+                decoder.abort()
+            raise ex
 
-            except Exception as ex:
-                logging.error("An error occurred while saving the uploaded recording.")
-                raise ex
+        return _describe(context, audio, name, filename, store), audio
 
-        context["filename"] = filename
-        context["to_be_analyzed"] = os.path.join(cfg.MEDIA_ROOT, filename)
-        if filename.split(".")[-1] == "wav":
-            context["audio_bitrate"], context["audio_length"] = \
-                get_audio_features(context["to_be_analyzed"], round_duration=True)
 
-        if filename:
-            context["audio_extension"] = filename.split('.')[-1]
+async def save_recording_async(context: dict, file: UploadedFile, is_recording: bool = False,
+                               store: MediaStore = None) -> Tuple[dict, DecodedAudio]:
+    """ Like save_recording(), for async views: the file is kept in a worker thread and decoded by an asyncio
+    subprocess. """
+    store = store or get_media_store()
 
-        return context, context["to_be_analyzed"]
+    if file:
+        decoder = getattr(file, 'decoder', None)
+        try:
+            data, name, filename, spooled = await sync_to_async(_keep, thread_sensitive=False)(
+                file, is_recording, store)
+            with timed("decode"):
+                if decoder is not None:
+                    audio = await decoder.result_async(source=data, mapped=not spooled,
+                                                       path=store.path(filename) if filename else None)
+                elif spooled:
+                    audio = await decode_audio_async(data, name=name)
+                else:
+                    audio = await sync_to_async(decode_audio, thread_sensitive=False)(
+                        data, name=filename, mapped=True, path=store.path(filename))
+
+        except Exception as ex:
+            logging.error("An error occurred while saving and decoding the %s.",
+                          "recording" if is_recording else "uploaded recording")
+            if decoder is not None:
+                decoder.abort()
+            raise ex
+
+        return _describe(context, audio, name, filename, store), audio
 
 
-def get_audio_features(audio_path: str, round_duration: bool = False) -> Tuple[int, float]:
-    """ Gets audio features (bitrate, length).
+def get_audio_features(audio: Union[str, DecodedAudio], round_duration: bool = False) -> Tuple[int, float]:
+    """ Gets audio features (bitrate, length). Files on disk are probed by reading their header only, they are not
+    decoded unless the header is missing or unusable.
 
     Arguments:
-        audio_path (str): Path to the audio file (wav).
+        audio (str, DecodedAudio): Decoded audio or the path to an audio file.
         round_duration (bool): Should the duration in seconds be rounded to 2 decimals?
 
     Returns:
         2 audio features (audio_bitrate, audio_length).
     """
-    # If opening file gives Exception, convert with FFMPEG and try again, if it still doesn't work raise Exception.
     try:
-        y, sr = librosa.load(audio_path, sr=None)
-        duration = librosa.core.get_duration(y, sr)
-
-    except Exception as e:
-        try:
-            # Call FFMPEG and convert values to 16bit int values (_TEMP_ is added because FFMPEG doesn't support
-            # in-place file editing)
-            subprocess.call('ffmpeg -y -i {} -acodec pcm_s16le -ar 48000 {}_TEMP_.wav'
-                            .format(audio_path, audio_path[:-4]),
-                            shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-            audio_path = audio_path[:-4] + "_TEMP_.wav"
-            assert (os.path.exists(audio_path)), "FFMPEG Could not convert the file properly."
-
-            y, sr = librosa.load(audio_path, sr=None)
-            duration = librosa.core.get_duration(y, sr)
-
-        except Exception as ex:
-            logging.error("Audio features could not be resolved.")
-            raise ex
+        if isinstance(audio, DecodedAudio):
+            sample_rate, duration = audio.sample_rate, audio.duration
+        else:
+            with timed("probe"):
+                info = probe_audio(audio)
+            sample_rate, duration = info.sample_rate, info.duration
 
-        finally:
-            if os.path.exists(audio_path):
-                os.remove(audio_path)
+    except Exception as ex:
+        logging.error("Audio features could not be resolved.")
+        raise ex
 
     if round_duration:
         duration = int(duration * 100) / 100.00
 
-    return sr, duration
+    return sample_rate, duration
 
 
-def check_audio_length(file_path: str) -> bool:
+def check_audio_length(audio: Union[str, DecodedAudio]) -> bool:
     """ Checks whether or not an audio file is long enough to predict with.
 
     Args:
-        file_path (str): Path to the audio file.
+        audio (str, DecodedAudio): Decoded audio or the path to an audio file.
 
     Returns:
         bool: True if the file is long enough, otherwise False.
     """
     try:
-        _, duration = get_audio_features(file_path)
+        _, duration = get_audio_features(audio)
 
         return duration >= cfg.MIN_LEN
 
@@ -141,147 +198,205 @@ def check_audio_length(file_path: str) -> bool:
         raise ex
 
 
-def speech_to_text(audio_file_path, language_code="en", project_id="clean-pilot-296112", session_id="me"):
-    """Returns the result of detect intent with an audio file as input and the RTF (Real Time Factor)
+def _prepare(audio: DecodedAudio, backend: str, use_cache: bool, use_vad: bool) -> tuple:
+    """ Resolves the defaults of speech_to_text() and trims the silence.
+
+    Returns:
+        The trimmed audio (DecodedAudio, None if there is no speech), the backend (str), whether the cache is used
+        (bool) and the duration of the speech (float).
+    """
+    backend = backend or cfg.ASR_BACKEND
+    if use_cache is None:
+        use_cache = cfg.TRANSCRIPTION_CACHE['ENABLED']
+    if use_vad is None:
+        use_vad = cfg.VAD['ENABLED']
+
+    speech_duration = audio.duration
+    if use_vad:
+        with timed("vad"):
+            audio, activity = trim_silence(audio)
+        if not activity.has_speech:
+            return None, backend, use_cache, 0.0
+        speech_duration = activity.speech_duration
+
+    return audio, backend, use_cache, speech_duration
+
+
+def speech_to_text(audio, language_code="en", session_id="me", backend: str = None, use_cache: bool = None,
+                   use_vad: bool = None):
+    """Returns the transcript of the audio and the RTF (Real Time Factor) of the recognition backend.
     Using the same `session_id` between requests allows continuation
-    of the conversation."""
-    session_client = dialogflow.SessionsClient()
+    of the conversation. The audio can be a DecodedAudio buffer or the path to an audio file,
+    the backend defaults to ASR_BACKEND in settings.py. Transcripts of identical audio are served
+    from the transcription cache (see cache.py) unless use_cache is False.
+    Leading and trailing silence is trimmed first and audio without speech is not sent to the
+    recognizer at all (see vad.py) unless use_vad is False, the RTF is relative to the speech only.
+    Long audio is split into segments that are recognized concurrently (see segmented_speech_to_text)."""
+    audio = load_audio(audio)
+    if needs_segmentation(audio):
+        text, rtf, _ = segmented_speech_to_text(audio, language_code, session_id, backend, use_cache, use_vad)
+        return text, rtf
+
+    audio, backend, use_cache, speech_duration = _prepare(audio, backend, use_cache, use_vad)
+    if audio is None:
+        return "", 0.0
+
+    def recognize():
+        with timed("recognize"):
+            return get_recognizer(backend).recognize(audio, language_code=language_code, session_id=session_id)
 
-    audio_encoding = dialogflow.enums.AudioEncoding.AUDIO_ENCODING_UNSPECIFIED
-    if audio_file_path.split(".")[-1] == "wav":
-        sample_rate_hertz, length = get_audio_features(audio_file_path)
+    start = time.time()
+    if use_cache:
+        with timed("hash"):
+            key = cache_key(audio, backend, language_code)
+        text, _ = get_transcription_cache().get_or_compute(key, recognize)
     else:
-        try:
-            # Convert to wav with 1 audio channel
-            subprocess.call('ffmpeg -y -i {} -acodec pcm_s16le -ac 1 -ar 48000 {}_converted.wav'
-                            .format(audio_file_path, audio_file_path[:-4]),
-                            shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            os.remove(audio_file_path)
-            audio_file_path = audio_file_path[:-4] + "_converted.wav"
-            sample_rate_hertz, length = get_audio_features(audio_file_path)
-        except Exception:
-            audio = mutagen.mp3.MP3(audio_file_path)
-            length = audio.info.length
-            sample_rate_hertz = audio.info.sample_rate
-
-    session = session_client.session_path(project_id, session_id)
-
-    with open(audio_file_path, 'rb') as audio_file:
-        input_audio = audio_file.read()
-
-    audio_config = dialogflow.types.InputAudioConfig(
-        audio_encoding=audio_encoding, language_code=language_code,
-        sample_rate_hertz=sample_rate_hertz)
-    query_input = dialogflow.types.QueryInput(audio_config=audio_config)
+        text = recognize()
+
+    end = time.time()
+    rtf = round((end - start) / speech_duration, 2)
+    return text, rtf
+
+
+async def speech_to_text_async(audio: DecodedAudio, language_code="en", session_id="me", backend: str = None,
+                               use_cache: bool = None, use_vad: bool = None):
+    """ Like speech_to_text(), for async views: the recognizer is awaited (see Recognizer.recognize_async) instead of
+    blocking a thread. Long audio is segmented and recognized by speech_to_text() in a worker thread. """
+    if needs_segmentation(audio):
+        return await sync_to_async(speech_to_text, thread_sensitive=False)(
+            audio, language_code, session_id, backend, use_cache, use_vad)
+
+    audio, backend, use_cache, speech_duration = _prepare(audio, backend, use_cache, use_vad)
+    if audio is None:
+        return "", 0.0
+
+    async def recognize():
+        with timed("recognize"):
+            return await get_recognizer(backend).recognize_async(audio, language_code=language_code,
+                                                                 session_id=session_id)
 
     start = time.time()
-    response = session_client.detect_intent(
-        session=session, query_input=query_input,
-        input_audio=input_audio)
+    if use_cache:
+        with timed("hash"):
+            key = cache_key(audio, backend, language_code)
+        text, _ = await get_transcription_cache().get_or_compute_async(key, recognize)
+    else:
+        text = await recognize()
 
-    end = time.time()
-    rtf = round((end - start) / length, 2)
-    return response.query_result.query_text, rtf
+    rtf = round((time.time() - start) / speech_duration, 2)
+    return text, rtf
 
 
-def calculate_metrics(context: dict, truth, hypothesis):
-    """ Calculates the relevant metrics for speech recognition model analysis. """
-    try:
-        hypo_dict = {}
-        truth_dict = {}
+def segmented_speech_to_text(audio: DecodedAudio, language_code="en", session_id="me", backend: str = None,
+                             use_cache: bool = None, use_vad: bool = None,
+                             work_class: str = None) -> Tuple[str, float, list]:
+    """ Splits long audio at silence, recognizes the segments concurrently with speech_to_text() and stitches the
+    transcripts together in order (see segmentation.py). If work_class is given every segment is admitted as work of
+    that class before it is recognized (see admission.py).
 
-        for word in hypothesis:
-            hypo_dict[word] = hypo_dict[word] + 1 if word in hypo_dict else 1
+    Returns:
+        The transcript (str), the RTF of the complete audio (float) and the segments (list of Segment) with their
+        timestamps, transcripts and RTF.
+    """
+    def recognize(segment: DecodedAudio) -> Tuple[str, float]:
+        if work_class is None:
+            return speech_to_text(segment, language_code, session_id, backend, use_cache, use_vad)
+        with admit_segment(segment.duration, work_class):
+            return speech_to_text(segment, language_code, session_id, backend, use_cache, use_vad)
 
-        for word in truth:
-            truth_dict[word] = truth_dict[word] + 1 if word in truth_dict else 1
+    start = time.time()
+    segments = recognize_segments(audio, recognize)
+    rtf = round((time.time() - start) / audio.duration, 2)
+    return " ".join(segment.text for segment in segments if segment.text), rtf, segments
 
-    except (ZeroDivisionError, ValueError):
-        hypo_dict = truth_dict = None
 
-    # WER
-    try:
-        context['wer'] = round(jiwer.wer(truth=truth, hypothesis=hypothesis), 2)
-    except (ZeroDivisionError, ValueError):
-        context['wer'] = 0.00
+def transcribe(file: UploadedFile, is_recording: bool = False, session_id: str = "me", ticket: Ticket = None) -> dict:
+    """ Saves, decodes, checks and recognizes one uploaded file. This is the complete processing of an upload, it is
+    run in the request (synchronous uploads) or by the job queue. It starts when the admission control admits it (see
+    admission.py).
 
-    # WCR
-    if hypo_dict and truth_dict:
-        try:
-            correct = 0
-            for key in truth_dict.keys():
-                if key in hypo_dict:
-                    correct += min(hypo_dict[key], truth_dict[key])
-
-            context['wcr'] = round(correct / len(truth), 2)
-        except (ZeroDivisionError, ValueError):
-            context['wcr'] = 0.00
-    else:
-        context['wcr'] = 0.00
+    Arguments:
+        file (File): The uploaded file.
+        is_recording (bool): Specifies whether the file is a recording or an uploaded file.
+        session_id (str): Session id passed to the recognition backend.
+        ticket (Ticket): The admission of a job that was admitted before it was run, by default the transcription
+            waits for admission.
 
-    # Precision Micro
-    try:
-        true_positives = 0
-        for true, hypo in zip(truth, hypothesis):
-            if true == hypo:
-                true_positives += 1
+    Returns:
+        The context keys (dict) that describe the file and its transcription (text, rtf, audio features and the
+        segments of long files).
 
-        context["precision_micro"] = round(true_positives / len(hypothesis), 2)
-    except (ZeroDivisionError, ValueError):
-        context["precision_micro"] = 0.00
+    Raises:
+        ValueError: If the file can not be decoded or an uploaded file is too short.
+        Overloaded: If the transcription was shed by the admission control.
+    """
+    with ticket or admit(file, is_recording) as ticket:
+        context, audio = save_recording(context={}, file=file, is_recording=is_recording)
+        ticket.resize(audio.duration)
+
+        if not is_recording and not check_audio_length(audio):
+            raise ValueError("The audio file is too short, it should be at least {} seconds long.".format(
+                cfg.MIN_LEN))
+
+        if needs_segmentation(audio):
+            # The segments are admitted one by one instead of the whole file
+            ticket.release()
+            context['text'], context['rtf'], segments = segmented_speech_to_text(audio, session_id=session_id,
+                                                                                 work_class=ticket.work_class)
+            context['segments'] = [dict(segment._asdict()) for segment in segments]
+        else:
+            context['text'], context['rtf'] = speech_to_text(audio, session_id=session_id)
+            context['segments'] = []
 
-    # Precision Macro
-    try:
-        match_dict = {}
-        for word_index in range(len(hypothesis)):
-            if word_index < len(truth):
-                if hypothesis[word_index] == truth[word_index]:
-                    match_dict[hypothesis[word_index]] = match_dict[hypothesis[word_index]] + 1 \
-                        if hypothesis[word_index] in match_dict else 1
+    return context
 
-        sum_precision = sum(match_dict[key] / hypo_dict[key] if key in match_dict else 0 for key in hypo_dict.keys())
-        context["precision_macro"] = round(1 / (len(hypo_dict.keys())) * sum_precision, 2)
 
-    except (ZeroDivisionError, ValueError):
-        context["precision_macro"] = 0.00
+async def transcribe_async(file: UploadedFile, is_recording: bool = False, session_id: str = "me") -> dict:
+    """ Like transcribe(), for async views: admission, decoding and recognition are awaited (see
+    save_recording_async() and speech_to_text_async()), long files are segmented in a worker thread. """
+    with await admit_async(file, is_recording) as ticket:
+        context, audio = await save_recording_async(context={}, file=file, is_recording=is_recording)
+        ticket.resize(audio.duration)
 
-    # Recall Micro
-    try:
-        true_positives = 0
-        for true, hypo in zip(truth, hypothesis):
-            if true == hypo:
-                true_positives += 1
+        if not is_recording and not check_audio_length(audio):
+            raise ValueError("The audio file is too short, it should be at least {} seconds long.".format(
+                cfg.MIN_LEN))
 
-        context["recall_micro"] = round(true_positives / len(truth), 2)
-    except (ZeroDivisionError, ValueError):
-        context["recall_micro"] = 0.00
+        if needs_segmentation(audio):
+            ticket.release()
+            context['text'], context['rtf'], segments = await sync_to_async(
+                segmented_speech_to_text, thread_sensitive=False)(audio, session_id=session_id,
+                                                                  work_class=ticket.work_class)
+            context['segments'] = [dict(segment._asdict()) for segment in segments]
+        else:
+            context['text'], context['rtf'] = await speech_to_text_async(audio, session_id=session_id)
+            context['segments'] = []
 
-    # Recall Macro
-    try:
-        match_dict = {}
-        for word_index in range(len(truth)):
-            if word_index < len(hypothesis):
-                if truth[word_index] == hypothesis[word_index]:
-                    match_dict[truth[word_index]] = match_dict[truth[word_index]] + 1 \
-                        if truth[word_index] in match_dict else 1
-
-        sum_recall = sum(match_dict[key] / truth_dict[key] if key in match_dict else 0 for key in truth_dict.keys())
-        context["recall_macro"] = round((1 / len(truth_dict.keys())) * sum_recall, 2)
-    except (ZeroDivisionError, ValueError):
-        context["recall_macro"] = 0.00
-
-    # F1 Micro
-    try:
-        context["f1_micro"] = round((2 * context["precision_micro"] * context["recall_micro"]) / \
-                                    (context["precision_micro"] + context["recall_micro"]), 2)
-    except (ZeroDivisionError, ValueError):
-        context["f1_micro"] = 0.00
+    return context
 
-    # F1 Macro
-    try:
-        context["f1_macro"] = round((2 * context["precision_macro"] * context["recall_macro"]) / \
-                                    (context["precision_macro"] + context["recall_macro"]), 2)
-    except (ZeroDivisionError, ValueError):
-        context["f1_macro"] = 0.00
+
+@timed("normalize")
+def normalize_transcript(text: str) -> list:
+    """ Normalizes a transcript for scoring (lower case, no punctuation) and splits it into words. Use
+    get_normalizer() (see normalization.py) for the word ids that the metrics engine consumes directly. """
+    return split_words(text)
+
+
+@timed("metrics")
+def calculate_metrics(context: dict, truth, hypothesis):
+    """ Calculates the relevant metrics for speech recognition model analysis. All metrics are derived from one
+    word alignment of the hypothesis against the truth (see metrics.py), precision and recall count the aligned hits.
+
+    Arguments:
+        context (dict): Context dictionary the metrics are added to.
+        truth (list, np.ndarray): Normalized words (or integer ids) of the reference transcript.
+        hypothesis (list, np.ndarray): Normalized words (or integer ids) of the recognized transcript.
+
+    Returns:
+        The context (dict) with the rounded metrics and the hit/substitution/deletion/insertion counts.
+    """
+    metrics = score(align(truth, hypothesis))
+    for key, value in metrics.items():
+        context[key] = round(value, 2) if isinstance(value, float) else value
 
     return context
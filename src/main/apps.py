@@ -2,4 +2,5 @@ from django.apps import AppConfig
 
 
 class MainConfig(AppConfig):
+    # The servers preload and warm up in recorder/wsgi.py and asgi.py (see warmup.py), not every management command
     name = 'main'
@@ -0,0 +1,410 @@
+""" Contains the in-memory audio decode stage. Every uploaded or recorded file is turned into one normalized mono
+16-bit PCM buffer by piping its bytes through FFMPEG (no shell). That single buffer is then used for the
+duration/sample rate probe, the length check and the payload that is sent to the recognizer. Long files can be
+decoded to an anonymous temporary file that is memory-mapped instead, so only the parts that are used are paged in.
+Uploads are decoded while they are received with StreamingDecoder (see uploads.py).
+
+MP4 files (M4A, MOV, 3GP, the ISO base media format) usually have their index (the moov atom) after the audio, which
+is how FFMPEG and most phones write them, and FFMPEG can not demux them from a pipe. They are decoded from a seekable
+file instead: the stored upload, or a temporary copy. Other files that can not be decoded from the pipe are tried once
+more from a copy.
+"""
+
+import asyncio
+import contextlib
+import io
+import logging
+import mmap
+import os
+import subprocess
+import tempfile
+import wave
+from typing import Union
+import numpy as np
+import src.recorder.settings as cfg
+
+
+class DecodedAudio:
+    """ Mono 16-bit little-endian PCM audio that lives in memory.
+
+    Attributes:
+        pcm (bytes, mmap): Raw PCM samples, in memory or memory-mapped.
+        sample_rate (int): Sample rate of the PCM samples in Hz.
+        name (str): Name of the file the audio was decoded from (informational only).
+        source (bytes): The encoded file the audio was decoded from, if it is still available.
+        offset (float): Start of the audio in the source in seconds (the audio may be trimmed).
+    """
+
+    SAMPLE_WIDTH = 2
+
+    def __init__(self, pcm: bytes, sample_rate: int, name: str = "", source: bytes = None, offset: float = 0.0):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.name = name
+        self.source = source
+        self.offset = offset
+
+    def __len__(self) -> int:
+        return len(self.pcm) // self.SAMPLE_WIDTH
+
+    @property
+    def duration(self) -> float:
+        """ Duration of the audio in seconds. """
+        return len(self) / float(self.sample_rate) if self.sample_rate else 0.0
+
+    @property
+    def samples(self) -> np.ndarray:
+        """ Read-only int16 view on the PCM buffer (no copy). """
+        return np.frombuffer(self.pcm, dtype=np.int16)
+
+    def to_wav(self) -> bytes:
+        """ Wraps the PCM buffer in a WAV container.
+
+        Returns:
+            The WAV file as bytes.
+        """
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(self.SAMPLE_WIDTH)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(self.pcm)
+
+        return buffer.getvalue()
+
+
+def _read_wav(data: bytes, sample_rate: int) -> Union[DecodedAudio, None]:
+    """ Reads a WAV file directly if it already has the target format, so FFMPEG does not have to be started.
+
+    Returns:
+        The decoded audio or None if the data is not a mono 16-bit PCM WAV at the requested sample rate.
+    """
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+
+    if isinstance(data, mmap.mmap):
+        # A mapped file is read in place
+        data.seek(0)
+    try:
+        with wave.open(data if isinstance(data, mmap.mmap) else io.BytesIO(data), 'rb') as wav:
+            if wav.getnchannels() != 1 or wav.getsampwidth() != DecodedAudio.SAMPLE_WIDTH \
+                    or wav.getframerate() != sample_rate:
+                return None
+            return DecodedAudio(wav.readframes(wav.getnframes()), sample_rate)
+
+    except (wave.Error, EOFError):
+        return None
+
+
+def _decoder_command(sample_rate: int, source: str = 'pipe:0') -> list:
+    """ FFMPEG command that decodes any audio file on stdin (or the file at source) to mono 16-bit PCM on stdout. """
+    return [cfg.FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-i', source,
+            '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+
+
+def _is_iso_bmff(data: bytes) -> bool:
+    """ True if the data is an MP4 file (ISO base media format), it has to be decoded from a seekable file. """
+    return data[4:8] == b'ftyp'
+
+
+@contextlib.contextmanager
+def _seekable_copy(data: bytes):
+    """ Writes the data to a temporary file that FFMPEG can seek in, yields its path. """
+    handle, path = tempfile.mkstemp(suffix=".audio")
+    try:
+        with os.fdopen(handle, 'wb') as copy:
+            copy.write(data)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def _run_decoder(command: list, data: bytes, mapped: bool):
+    """ Runs FFMPEG on the data (None if the command reads a file), its output is kept in memory or written to a
+    temporary file that is memory-mapped.
+
+    Returns:
+        (process, pcm): The finished process and its output.
+    """
+    source = {'input': data} if data is not None else {'stdin': subprocess.DEVNULL}
+    if not mapped:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **source)
+        return process, process.stdout
+
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.run(command, stdout=output, stderr=subprocess.PIPE, **source)
+        # The mapping stays valid after the file is closed (and removed)
+        size = output.seek(0, os.SEEK_END)
+        return process, mmap.mmap(output.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+
+def _decode(data: bytes, sample_rate: int, mapped: bool, path: str):
+    """ Runs FFMPEG on the file at path, or on the data (from a seekable copy if the pipe does not work, see above).
+
+    Returns:
+        (process, pcm): The finished process and its output.
+    """
+    if path is not None:
+        return _run_decoder(_decoder_command(sample_rate, path), None, mapped)
+
+    if not _is_iso_bmff(data):
+        process, pcm = _run_decoder(_decoder_command(sample_rate), data, mapped)
+        if process.returncode == 0 and len(pcm):
+            return process, pcm
+    with _seekable_copy(data) as copy:
+        return _run_decoder(_decoder_command(sample_rate, copy), None, mapped)
+
+
+async def _run_decoder_async(command: list, data: bytes, mapped: bool):
+    """ Runs FFMPEG like _run_decoder(), as an asyncio subprocess.
+
+    Returns:
+        (process, pcm, errors): The finished process, its output and its error output.
+    """
+    with tempfile.TemporaryFile() as output:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdin=subprocess.PIPE if data is not None else subprocess.DEVNULL,
+            stdout=output if mapped else subprocess.PIPE, stderr=subprocess.PIPE)
+        pcm, errors = await process.communicate(data)
+        if mapped:
+            # The mapping stays valid after the file is closed (and removed)
+            size = output.seek(0, os.SEEK_END)
+            pcm = mmap.mmap(output.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    return process, pcm, errors
+
+
+async def _decode_async(data: bytes, sample_rate: int, mapped: bool, path: str):
+    """ Like _decode(), as an asyncio subprocess.
+
+    Returns:
+        (process, pcm, errors): The finished process, its output and its error output.
+    """
+    if path is not None:
+        return await _run_decoder_async(_decoder_command(sample_rate, path), None, mapped)
+
+    if not _is_iso_bmff(data):
+        process, pcm, errors = await _run_decoder_async(_decoder_command(sample_rate), data, mapped)
+        if process.returncode == 0 and len(pcm):
+            return process, pcm, errors
+    with _seekable_copy(data) as copy:
+        return await _run_decoder_async(_decoder_command(sample_rate, copy), None, mapped)
+
+
+def decode_audio(data: bytes, sample_rate: int = None, name: str = "", mapped: bool = False,
+                 path: str = None) -> DecodedAudio:
+    """ Decodes an audio file (any format FFMPEG understands) to mono 16-bit PCM in memory.
+
+    Arguments:
+        data (bytes): The complete audio file.
+        sample_rate (int): Target sample rate in Hz, defaults to SAMPLE_RATE in settings.py.
+        name (str): Name of the file, only used for logging and reporting.
+        mapped (bool): Decode to a memory-mapped temporary file instead of memory (for long files).
+        path (str): Path of the file on disk, FFMPEG reads it from there instead of the data.
+
+    Returns:
+        The decoded audio (DecodedAudio).
+
+    Raises:
+        ValueError: If the data could not be decoded.
+    """
+    sample_rate = sample_rate or cfg.SAMPLE_RATE
+
+    audio = _read_wav(data, sample_rate)
+    if audio is not None:
+        audio.name, audio.source = name, data
+        return audio
+
+    try:
+        process, pcm = _decode(data, sample_rate, mapped, path)
+
+    except FileNotFoundError as ex:
+        logging.error("FFMPEG could not be started, please check if you have FFMPEG installed.")
+        raise ex
+
+    if process.returncode != 0 or not len(pcm):
+        logging.error("FFMPEG failed to decode %s: %s", name or "the audio",
+                      process.stderr.decode(errors='replace').strip())
+        raise ValueError("The audio could not be decoded (is the file valid?).")
+
+    return DecodedAudio(pcm, sample_rate, name, source=data)
+
+
+async def decode_audio_async(data: bytes, sample_rate: int = None, name: str = "", mapped: bool = False,
+                             path: str = None) -> DecodedAudio:
+    """ Decodes an audio file like decode_audio(), but FFMPEG runs as an asyncio subprocess so the event loop is
+    not blocked while it decodes (for async views).
+
+    Raises:
+        ValueError: If the data could not be decoded.
+    """
+    sample_rate = sample_rate or cfg.SAMPLE_RATE
+
+    audio = _read_wav(data, sample_rate)
+    if audio is not None:
+        audio.name, audio.source = name, data
+        return audio
+
+    try:
+        process, pcm, errors = await _decode_async(data, sample_rate, mapped, path)
+    except FileNotFoundError as ex:
+        logging.error("FFMPEG could not be started, please check if you have FFMPEG installed.")
+        raise ex
+
+    if process.returncode != 0 or not len(pcm):
+        logging.error("FFMPEG failed to decode %s: %s", name or "the audio", errors.decode(errors='replace').strip())
+        raise ValueError("The audio could not be decoded (is the file valid?).")
+
+    return DecodedAudio(pcm, sample_rate, name, source=data)
+
+
+class StreamingDecoder:
+    """ Decodes an audio file while it is still being received: its bytes are written to FFMPEG as they arrive and the
+    PCM is collected in an anonymous temporary file, so decoding overlaps with the upload instead of following it.
+    MP4 files can not be decoded from a pipe (see above), they are decoded from the complete file by result().
+
+    Arguments:
+        sample_rate (int): Target sample rate in Hz, defaults to SAMPLE_RATE in settings.py.
+        name (str): Name of the file, only used for logging and reporting.
+    """
+
+    def __init__(self, sample_rate: int = None, name: str = ""):
+        self.sample_rate = sample_rate or cfg.SAMPLE_RATE
+        self.name = name
+        self.received = 0
+        self.whole_file = False
+        self.output = tempfile.TemporaryFile()
+        self.errors = tempfile.TemporaryFile()
+        try:
+            # Unbuffered, so every chunk reaches FFMPEG right away
+            self.process = subprocess.Popen(_decoder_command(self.sample_rate), bufsize=0, stdin=subprocess.PIPE,
+                                            stdout=self.output, stderr=self.errors)
+        except FileNotFoundError as ex:
+            logging.error("FFMPEG could not be started, please check if you have FFMPEG installed.")
+            self._close_files()
+            raise ex
+
+    def _close_files(self):
+        self.output.close()
+        self.errors.close()
+
+    @property
+    def failed(self) -> bool:
+        """ True if FFMPEG has given up on the data already (it is not audio it understands). """
+        return not self.whole_file and self.process.poll() not in (None, 0)
+
+    def feed(self, chunk: bytes) -> bool:
+        """ Passes the next bytes of the file to the decoder.
+
+        Returns:
+            bool: False if the decoder has failed, the rest of the file does not have to be sent.
+        """
+        if not self.received and _is_iso_bmff(chunk):
+            self.abort()
+            self.whole_file = True
+        if self.whole_file:
+            self.received += len(chunk)
+            return True
+
+        try:
+            self.process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # FFMPEG exited (or the input was closed already)
+            return False
+
+        self.received += len(chunk)
+        return not self.failed
+
+    def close(self):
+        """ Signals the end of the file, FFMPEG decodes the rest in the background. """
+        if not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def abort(self):
+        """ Stops the decoder and removes its output, does nothing if it has finished already. """
+        self.process.kill()
+        self.close()
+        self.process.wait()
+        self._close_files()
+
+    def result(self, source: bytes = None, mapped: bool = False, path: str = None) -> DecodedAudio:
+        """ Waits for the decoder to finish.
+
+        Arguments:
+            source (bytes): The complete file, kept as the source of the audio (MP4 files are decoded from it).
+            mapped (bool): Memory-map the decoded PCM instead of reading it into memory (for long files).
+            path (str): Path of the file on disk, MP4 files are decoded from there instead of a copy of the source.
+
+        Returns:
+            The decoded audio (DecodedAudio).
+
+        Raises:
+            ValueError: If the data could not be decoded.
+        """
+        if self.whole_file:
+            return decode_audio(source, self.sample_rate, self.name, mapped, path)
+
+        self.close()
+        self.process.wait()
+        try:
+            size = self.output.seek(0, os.SEEK_END)
+            if self.process.returncode != 0 or not size:
+                self.errors.seek(0)
+                logging.error("FFMPEG failed to decode %s: %s", self.name or "the audio",
+                              self.errors.read().decode(errors='replace').strip())
+                raise ValueError("The audio could not be decoded (is the file valid?).")
+
+            if mapped:
+                # The mapping stays valid after the file is closed (and removed)
+                pcm = mmap.mmap(self.output.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.output.seek(0)
+                pcm = self.output.read()
+
+        finally:
+            self._close_files()
+
+        return DecodedAudio(pcm, self.sample_rate, self.name, source=source)
+
+    async def result_async(self, source: bytes = None, mapped: bool = False, path: str = None) -> DecodedAudio:
+        """ Waits for the decoder like result(), without blocking the event loop. """
+        if self.whole_file:
+            return await decode_audio_async(source, self.sample_rate, self.name, mapped, path)
+
+        self.close()
+        await asyncio.get_event_loop().run_in_executor(None, self.process.wait)
+        return self.result(source, mapped)
+
+
+def map_file(file_path: str) -> Union[mmap.mmap, bytes]:
+    """ Memory-maps a file read-only, so it is paged in only where it is used (an empty file is b''). """
+    with open(file_path, 'rb') as audio_file:
+        if not audio_file.seek(0, os.SEEK_END):
+            return b''
+        # The mapping stays valid after the file is closed
+        return mmap.mmap(audio_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def decode_file(file_path: str, sample_rate: int = None, mapped: bool = False) -> DecodedAudio:
+    """ Decodes an audio file on disk with decode_audio(): FFMPEG reads the file itself and the source of the audio
+    is the memory-mapped file, the file is not read into memory.
+
+    Arguments:
+        file_path (str): Path to the audio file.
+        sample_rate (int): Target sample rate in Hz, defaults to SAMPLE_RATE in settings.py.
+        mapped (bool): Decode to a memory-mapped temporary file instead of memory (for long files).
+
+    Returns:
+        The decoded audio (DecodedAudio).
+    """
+    return decode_audio(map_file(file_path), sample_rate, name=file_path, mapped=mapped, path=file_path)
+
+
+def load_audio(audio: Union[str, DecodedAudio]) -> DecodedAudio:
+    """ Returns the decoded audio as is, or decodes it first if a file path is given. """
+    if isinstance(audio, DecodedAudio):
+        return audio
+
+    return decode_file(audio)
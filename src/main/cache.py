@@ -0,0 +1,258 @@
+""" Contains the content addressed transcription cache. Transcripts are keyed by a hash of the decoded PCM together
+with the backend, its configuration and the language, so identical audio is only sent to the recognizer once.
+
+There are two tiers: a size bounded in-memory LRU per process and a directory on disk that is shared by all workers.
+Entries expire after a TTL. A background collector removes the expired entries from the disk tier and then the oldest
+ones until it fits in its size limit. Concurrent requests for the same key are coalesced: only the first one calls the
+recognizer, the others wait for its result.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Tuple, Union
+from asgiref.sync import sync_to_async
+from src.main.audio import DecodedAudio
+from src.main.media import collect_directory, start_collector
+import src.recorder.settings as cfg
+
+
+def cache_key(audio: DecodedAudio, backend: str, language_code: str) -> str:
+    """ Creates the cache key of a transcription.
+
+    Arguments:
+        audio (DecodedAudio): The audio that is recognized.
+        backend (str): Name of the recognition backend, its OPTIONS in settings.py are part of the key.
+        language_code (str): Language of the speech.
+
+    Returns:
+        The key (str), a SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(audio.pcm)
+    config = {"sample_rate": audio.sample_rate, "backend": backend, "language_code": language_code,
+              "options": cfg.ASR_BACKENDS.get(backend, {}).get('OPTIONS', {})}
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class TranscriptionCache:
+    """ Two tier (memory and disk) cache of transcripts with request coalescing.
+
+    Arguments:
+        max_entries (int): Maximum number of entries in the memory tier, the least recently used one is evicted.
+        ttl (float): Seconds an entry stays valid.
+        directory (str): Directory of the disk tier, None disables it.
+        max_bytes (int): Maximum size of the disk tier, collect() removes the oldest entries above it.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, directory: str = None, max_bytes: int = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.usage = {"disk_entries": 0, "disk_bytes": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _read_disk(self, key: str) -> Union[dict, None]:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key)) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+        if entry["expires"] < time.time():
+            with self.lock:
+                self.counters["expirations"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            return None
+
+        return entry
+
+    def _write_disk(self, key: str, entry: dict):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+            # Write to a temporary file first so other workers never read a partial entry
+            handle, temporary = tempfile.mkstemp(dir=os.path.dirname(self._path(key)), prefix=".tmp")
+            with os.fdopen(handle, 'w') as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(temporary, self._path(key))
+        except OSError as ex:
+            logging.warning("Could not write transcription cache entry: %s", ex)
+
+    def collect(self) -> dict:
+        """ Removes the expired entries from the disk tier and then the oldest ones until it fits in max_bytes.
+
+        Returns:
+            dict: Number of removed entries and freed bytes of this run.
+        """
+        if not self.directory:
+            return {"removed": 0, "freed_bytes": 0}
+
+        max_bytes = self.max_bytes if self.max_bytes is not None else float('inf')
+        result = collect_directory(self.directory, self.ttl, max_bytes)
+        with self.lock:
+            self.counters["collections"] += 1
+            self.counters["disk_removals"] += result["removed"]
+            self.counters["disk_freed_bytes"] += result["freed_bytes"]
+            self.usage = {"disk_entries": result["files"], "disk_bytes": result["bytes"]}
+
+        if result["removed"]:
+            logging.info("Transcription cache collector removed %d entries (%d bytes).", result["removed"],
+                         result["freed_bytes"])
+        return {"removed": result["removed"], "freed_bytes": result["freed_bytes"]}
+
+    def start_collector(self, interval: float) -> threading.Thread:
+        """ Runs collect() every interval seconds in a daemon thread. """
+        return start_collector(self.collect, interval, "transcription-cache-collector")
+
+    def _remember(self, key: str, entry: dict):
+        """ Puts an entry in the memory tier (must be called with the lock held). """
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def get(self, key: str) -> Union[str, None]:
+        """ Returns the cached text or None. """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry["expires"] >= time.time():
+                    self.memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return entry["text"]
+                del self.memory[key]
+                self.counters["expirations"] += 1
+
+        entry = self._read_disk(key)
+        with self.lock:
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._remember(key, entry)
+            return entry["text"]
+
+    def set(self, key: str, text: str):
+        """ Stores a text in both tiers. """
+        entry = {"text": text, "expires": time.time() + self.ttl}
+        with self.lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def _claim(self, key: str) -> Tuple[Future, bool]:
+        """ Returns the future of the computation of a key and whether the caller owns it (has to compute it). """
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        return future, owner
+
+    def _release(self, key: str):
+        with self.lock:
+            del self.in_flight[key]
+
+    def get_or_compute(self, key: str, compute: Callable[[], str]) -> Tuple[str, bool]:
+        """ Returns the cached text, or computes and caches it. While a key is being computed, other callers for the
+        same key wait for that result instead of computing it again.
+
+        Returns:
+            (text, cached): The text and whether it was served without calling compute in this thread.
+        """
+        text = self.get(key)
+        if text is not None:
+            return text, True
+
+        future, owner = self._claim(key)
+        if not owner:
+            return future.result(), True
+
+        try:
+            text = compute()
+            self.set(key, text)
+            future.set_result(text)
+            return text, False
+
+        except Exception as ex:
+            future.set_exception(ex)
+            raise
+
+        finally:
+            self._release(key)
+
+    async def get_or_compute_async(self, key: str, compute: Callable[[], Awaitable[str]]) -> Tuple[str, bool]:
+        """ Like get_or_compute() for a coroutine function compute, the disk tier is read and written in a worker
+        thread. Requests are coalesced with the synchronous callers as well. """
+        text = await sync_to_async(self.get, thread_sensitive=False)(key)
+        if text is not None:
+            return text, True
+
+        future, owner = self._claim(key)
+        if not owner:
+            return await asyncio.wrap_future(future), True
+
+        try:
+            text = await compute()
+            await sync_to_async(self.set, thread_sensitive=False)(key, text)
+            future.set_result(text)
+            return text, False
+
+        except (Exception, asyncio.CancelledError) as ex:
+            # A cancelled request must not leave the coalesced requests waiting forever
+            future.set_exception(ex)
+            raise
+
+        finally:
+            self._release(key)
+
+    def stats(self) -> dict:
+        """ Counters (hits, misses, evictions, expirations, coalesced requests, collected entries), the size of the
+        memory tier and the size of the disk tier at the last collection. """
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(self.usage)
+            stats["memory_entries"] = len(self.memory)
+            stats["in_flight"] = len(self.in_flight)
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_transcription_cache() -> TranscriptionCache:
+    """ Returns the transcription cache of this process, configured by TRANSCRIPTION_CACHE in settings.py. The
+    collector of the disk tier is started with it if TRANSCRIPTION_CACHE['COLLECT_INTERVAL'] is set. """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TranscriptionCache(cfg.TRANSCRIPTION_CACHE['MAX_ENTRIES'], cfg.TRANSCRIPTION_CACHE['TTL'],
+                                        cfg.TRANSCRIPTION_CACHE['DIRECTORY'], cfg.TRANSCRIPTION_CACHE['MAX_BYTES'])
+            if cfg.TRANSCRIPTION_CACHE['DIRECTORY'] and cfg.TRANSCRIPTION_CACHE['COLLECT_INTERVAL']:
+                _cache.start_collector(cfg.TRANSCRIPTION_CACHE['COLLECT_INTERVAL'])
+        return _cache
@@ -0,0 +1,139 @@
+""" Contains the payload encoding policy: how audio is encoded when it is sent to a recognition backend. Speech only
+needs 16 kHz and raw PCM is the largest possible payload, so the first encoding of PAYLOAD_ENCODINGS in settings.py
+that the backend accepts is used:
+
+    OGG_OPUS  The Opus stream the browser recorded, remuxed from WebM to Ogg without re-encoding (only for Opus input).
+    FLAC      Lossless, about half the size of PCM.
+    LINEAR16  Raw mono 16-bit PCM at the decode sample rate (SAMPLE_RATE), no extra work.
+
+An encoding that can not be produced for the audio (or fails) falls through to the next one.
+"""
+
+import asyncio
+import logging
+import subprocess
+from typing import NamedTuple, Union
+from src.main.audio import DecodedAudio
+from src.main.probe import probe_header
+from src.main.instrumentation import timed
+import src.recorder.settings as cfg
+
+OGG_OPUS, FLAC, LINEAR16 = 'OGG_OPUS', 'FLAC', 'LINEAR16'
+
+
+class Payload(NamedTuple):
+    """ Encoded audio that is sent to a recognition backend.
+
+    Attributes:
+        data (bytes): The encoded audio.
+        encoding (str): OGG_OPUS, FLAC or LINEAR16.
+        sample_rate (int): Sample rate of the encoded audio in Hz.
+    """
+    data: bytes
+    encoding: str
+    sample_rate: int
+
+
+def _command(arguments: list) -> list:
+    return [cfg.FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error'] + arguments
+
+
+def _output(process, stdout: bytes, stderr: bytes) -> Union[bytes, None]:
+    """ Returns the output of a finished FFMPEG process or None if it failed. """
+    if process.returncode != 0 or not stdout:
+        logging.warning("FFMPEG failed to encode the payload: %s", stderr.decode(errors='replace').strip())
+        return None
+
+    return stdout
+
+
+def _ffmpeg(arguments: list, data: bytes) -> Union[bytes, None]:
+    """ Runs FFMPEG with the data on stdin, returns its stdout or None if it failed. """
+    process = subprocess.run(_command(arguments), input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return _output(process, process.stdout, process.stderr)
+
+
+async def _ffmpeg_async(arguments: list, data: bytes) -> Union[bytes, None]:
+    """ Runs FFMPEG like _ffmpeg() as an asyncio subprocess. """
+    process = await asyncio.create_subprocess_exec(*_command(arguments), stdin=subprocess.PIPE,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = await process.communicate(data)
+    return _output(process, stdout, stderr)
+
+
+class _Job(NamedTuple):
+    """ How an encoding is produced: FFMPEG arguments, its input and the sample rate of its output. """
+    arguments: list
+    data: bytes
+    sample_rate: int
+
+
+def _ogg_opus(audio: DecodedAudio) -> Union[_Job, None]:
+    """ Copies the Opus packets of the (trimmed) audio from its source into an Ogg container. """
+    if not audio.source:
+        return None
+    info = probe_header(audio.source)
+    if info is None or 'opus' not in info.codec:
+        return None
+
+    return _Job(['-i', 'pipe:0', '-map', '0:a:0', '-c:a', 'copy', '-ss', '{:.3f}'.format(audio.offset),
+                 '-t', '{:.3f}'.format(audio.duration), '-f', 'ogg', 'pipe:1'], audio.source, info.sample_rate)
+
+
+def _flac(audio: DecodedAudio) -> _Job:
+    return _Job(['-f', 's16le', '-ar', str(audio.sample_rate), '-ac', '1', '-i', 'pipe:0',
+                 '-c:a', 'flac', '-f', 'flac', 'pipe:1'], audio.pcm, audio.sample_rate)
+
+
+def _linear16(audio: DecodedAudio) -> Payload:
+    return Payload(audio.pcm, LINEAR16, audio.sample_rate)
+
+
+ENCODERS = {OGG_OPUS: _ogg_opus, FLAC: _flac}
+
+
+def _jobs(audio: DecodedAudio, accepted: tuple):
+    """ Yields (encoding, job) for the encodings the backend accepts that are preferred over LINEAR16. """
+    for encoding in cfg.PAYLOAD_ENCODINGS:
+        if encoding == LINEAR16 and encoding in accepted:
+            return
+        if encoding in accepted:
+            job = ENCODERS[encoding](audio)
+            if job is not None:
+                yield encoding, job
+
+
+def _log(audio: DecodedAudio, payload: Payload) -> Payload:
+    logging.debug("Payload of %s: %s, %d bytes (%d bytes as PCM)", audio.name or "the audio", payload.encoding,
+                  len(payload.data), len(audio.pcm))
+    return payload
+
+
+@timed("encode")
+def encode_payload(audio: DecodedAudio, accepted: tuple) -> Payload:
+    """ Encodes the audio with the preferred encoding (PAYLOAD_ENCODINGS in settings.py) that the backend accepts.
+
+    Arguments:
+        audio (DecodedAudio): The audio to send.
+        accepted (tuple): Encodings the backend accepts.
+
+    Returns:
+        The payload (Payload), LINEAR16 if no other accepted encoding can be produced.
+    """
+    for encoding, job in _jobs(audio, accepted):
+        data = _ffmpeg(job.arguments, job.data)
+        if data:
+            return _log(audio, Payload(data, encoding, job.sample_rate))
+
+    return _log(audio, _linear16(audio))
+
+
+async def encode_payload_async(audio: DecodedAudio, accepted: tuple) -> Payload:
+    """ Encodes the audio like encode_payload(), FFMPEG runs as an asyncio subprocess (for async views). """
+    with timed("encode"):
+        for encoding, job in _jobs(audio, accepted):
+            data = await _ffmpeg_async(job.arguments, job.data)
+            if data:
+                return _log(audio, Payload(data, encoding, job.sample_rate))
+
+        return _log(audio, _linear16(audio))
@@ -0,0 +1,245 @@
+""" Contains the acoustic features of the local models (see inference.py): log-mel spectra or MFCCs computed with
+librosa from the decoded audio (mono, SAMPLE_RATE), in frames of WINDOW_MS milliseconds every HOP_MS milliseconds.
+They are configured by FEATURES in settings.py, a model can override them with FEATURES in MODELS.
+
+The features of an evaluation corpus are precomputed once into a FeatureStore ("manage.py extractfeatures", or
+"manage.py evaluate --model"), so later runs over the same corpus do not decode the audio again. A store is a directory
+with one contiguous array of all frames (float16 by default) and an index of the offset and number of frames of every
+utterance; the array is memory-mapped and the features of an utterance are a read-only slice of it (no copy).
+
+Every utterance in the index keeps the size, modification time and SHA-256 hash of its audio file: files whose size
+or modification time changed are hashed again and only extracted again (in parallel) if their content changed. A
+store with other features or another dtype is extracted from scratch. One process at a time may update a store.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Iterable, Tuple
+import numpy as np
+from src.main.audio import decode_audio
+import src.recorder.settings as cfg
+
+KINDS = ('logmel', 'mfcc')
+# Mel bands of the spectrum the MFCCs are computed from
+MFCC_MELS = 40
+
+
+def compute_features(samples: np.ndarray, sample_rate: int, kind: str = 'logmel', size: int = 40,
+                     window_ms: float = 25, hop_ms: float = 10) -> np.ndarray:
+    """ Computes the features of mono audio.
+
+    Arguments:
+        samples (np.ndarray): int16 PCM samples, or float samples between -1 and 1.
+        sample_rate (int): Sample rate of the samples in Hz.
+        kind (str): 'logmel' (log-mel spectrum in dB) or 'mfcc'.
+        size (int): Number of mel bands or coefficients per frame.
+        window_ms (float): Length of the analysis window in milliseconds.
+        hop_ms (float): Distance between the frames in milliseconds.
+
+    Returns:
+        The features (np.ndarray of float32, frames x size).
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown feature kind '{}', choose one of: {}.".format(kind, ", ".join(KINDS)))
+    if len(samples) == 0:
+        return np.zeros((0, size), dtype=np.float32)
+
+    import librosa
+
+    audio = samples.astype(np.float32) / 32768.0 if samples.dtype == np.int16 else samples.astype(np.float32)
+    window = int(sample_rate * window_ms / 1000)
+    mel = librosa.feature.melspectrogram(y=audio, sr=sample_rate, n_fft=1 << (window - 1).bit_length(),
+                                         win_length=window, hop_length=int(sample_rate * hop_ms / 1000),
+                                         n_mels=size if kind == 'logmel' else max(size, MFCC_MELS))
+    features = librosa.power_to_db(mel)
+    if kind == 'mfcc':
+        features = librosa.feature.mfcc(S=features, n_mfcc=size)
+    return np.ascontiguousarray(features.T, dtype=np.float32)
+
+
+def fix_frames(features: np.ndarray, frames: int) -> np.ndarray:
+    """ Pads features with zero frames or cuts them to the given number of frames. """
+    if len(features) >= frames:
+        return features[:frames]
+    return np.concatenate([features, np.zeros((frames - len(features),) + features.shape[1:], features.dtype)])
+
+
+def _extract(path: str, digest: str, features: dict) -> Tuple[str, np.ndarray]:
+    """ Hashes an audio file and extracts its features unless it has the given hash (runs in a worker).
+
+    Returns:
+        The SHA-256 hash of the file (str) and its features (np.ndarray, None if the hash did not change).
+    """
+    with open(path, 'rb') as audio_file:
+        data = audio_file.read()
+    new_digest = hashlib.sha256(data).hexdigest()
+    if new_digest == digest:
+        return digest, None
+
+    audio = decode_audio(data, name=path)
+    return new_digest, compute_features(audio.samples, audio.sample_rate, **features)
+
+
+class FeatureStore:
+    """ Precomputed features of the utterances of a corpus on disk (see above).
+
+    Arguments:
+        directory (str): Directory of the store, it is created when the store is updated.
+        features (dict): Arguments of compute_features() (kind, size, window_ms, hop_ms).
+        dtype (str): Type of the stored features, 'float16' or 'float32'.
+    """
+
+    INDEX = "index.json"
+
+    def __init__(self, directory: str, features: dict, dtype: str = 'float16'):
+        self.directory = directory
+        self.features = dict(features)
+        self.dtype = np.dtype(dtype)
+        self.config = dict(self.features, dtype=self.dtype.name, sample_rate=cfg.SAMPLE_RATE)
+        self.entries = {}
+        self.data = None
+        self._open()
+
+    def _open(self):
+        """ Reads the index and maps the features, an index of other features is ignored. """
+        self.entries, self.data = {}, None
+        try:
+            with open(os.path.join(self.directory, self.INDEX), encoding='utf-8') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        if index.get('config') != self.config:
+            return
+
+        self.entries = index['entries']
+        frames = sum(entry['frames'] for entry in self.entries.values())
+        if frames:
+            self.data = np.memmap(os.path.join(self.directory, index['data']), dtype=self.dtype, mode='r',
+                                  shape=(frames, self.features['size']))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str) -> np.ndarray:
+        """ Returns the features of an utterance: a read-only, memory-mapped slice (frames x size). """
+        entry = self.entries[key]
+        if not entry['frames']:
+            return np.zeros((0, self.features['size']), dtype=self.dtype)
+        return self.data[entry['offset']:entry['offset'] + entry['frames']]
+
+    def duration(self, key: str) -> float:
+        """ Returns the duration of an utterance in seconds, judging by its number of frames. """
+        return self.entries[key]['frames'] * self.features.get('hop_ms', 10) / 1000.0
+
+    def _stale(self, key: str, stat: os.stat_result) -> bool:
+        entry = self.entries.get(key)
+        return entry is None or entry['bytes'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns
+
+    def update(self, items: Iterable[Tuple[str, str]], workers: int = None, processes: bool = True,
+               log=None) -> dict:
+        """ Extracts the features of the new and changed utterances, in parallel, and rewrites the store with them.
+        Utterances that are not in items are kept.
+
+        Arguments:
+            items (Iterable): (key, audio path) of every utterance.
+            workers (int): Number of files that are extracted at the same time, defaults to the number of CPUs.
+            processes (bool): Extract in a process pool instead of a thread pool.
+            log (Callable): Called with a message for every file that failed.
+
+        Returns:
+            dict: Number of utterances that were reused, extracted and failed.
+        """
+        stats = {'reused': 0, 'extracted': 0, 'failed': 0}
+        checks = {}
+        for key, path in items:
+            try:
+                stat = os.stat(path)
+            except OSError as ex:
+                stats['failed'] += 1
+                if log:
+                    log("{}: {}".format(key, ex))
+                continue
+            if self._stale(key, stat):
+                checks[key] = (path, stat)
+            else:
+                stats['reused'] += 1
+        if not checks:
+            return stats
+
+        os.makedirs(self.directory, exist_ok=True)
+        data_name = "features-{}.bin".format(uuid.uuid4().hex)
+        entries, offset = {}, 0
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with open(os.path.join(self.directory, data_name), 'wb') as data_file:
+            def write(key: str, features: np.ndarray, stat: os.stat_result, digest: str):
+                nonlocal offset
+                np.ascontiguousarray(features, dtype=self.dtype).tofile(data_file)
+                entries[key] = {'offset': offset, 'frames': len(features), 'bytes': stat.st_size,
+                                'mtime': stat.st_mtime_ns, 'sha256': digest}
+                offset += len(features)
+
+            for key, entry in self.entries.items():
+                if key not in checks:
+                    np.ascontiguousarray(self.get(key)).tofile(data_file)
+                    entries[key] = dict(entry, offset=offset)
+                    offset += entry['frames']
+
+            with executor_class(max_workers=workers) as executor:
+                futures = {executor.submit(_extract, path, self.entries.get(key, {}).get('sha256'), self.features):
+                           key for key, (path, _) in checks.items()}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    path, stat = checks[key]
+                    try:
+                        digest, features = future.result()
+                    except Exception as ex:
+                        logging.warning("The features of %s could not be extracted: %s", path, ex)
+                        stats['failed'] += 1
+                        if log:
+                            log("{}: {}".format(key, ex))
+                        continue
+
+                    if features is None:
+                        # Only the modification time changed
+                        features = self.get(key)
+                        stats['reused'] += 1
+                    else:
+                        stats['extracted'] += 1
+                    write(key, features, stat, digest)
+
+        self._replace(data_name, entries)
+        return stats
+
+    def _replace(self, data_name: str, entries: dict):
+        """ Switches the store to a new features file atomically (readers keep the old mapping) and removes the others.
+        """
+        self.data = None
+        index_path = os.path.join(self.directory, self.INDEX)
+        with open(index_path + ".tmp", 'w', encoding='utf-8') as index_file:
+            json.dump({'config': self.config, 'data': data_name, 'entries': entries}, index_file)
+        os.replace(index_path + ".tmp", index_path)
+
+        for name in os.listdir(self.directory):
+            if name.startswith("features-") and name != data_name:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    # Still mapped on a platform that does not allow removing it
+                    pass
+        self._open()
+
+
+def store_directory(source: str, features: dict, dtype: str) -> str:
+    """ Returns the directory of the feature store of a corpus (directory or manifest) in FEATURE_STORE['DIRECTORY'],
+    one per corpus, features and dtype. """
+    source = os.path.abspath(source)
+    digest = hashlib.sha256(json.dumps([source, features, dtype], sort_keys=True).encode()).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(source.rstrip(os.sep)))[0]
+    return os.path.join(cfg.FEATURE_STORE['DIRECTORY'], "{}-{}".format(name, digest))
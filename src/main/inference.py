@@ -0,0 +1,271 @@
+""" Contains the local acoustic models: Keras models on disk (MODELS in settings.py) that recognize speech offline, such
+as a classifier of commands or intents or a CTC model of characters. They are used by the "local" recognition backend.
+
+The ModelRegistry of a process (get_model_registry()) loads every model once, when create_global_models() (see
+analyzer.py) runs at boot or on first use, and all threads share it. TensorFlow does not survive a fork after it has
+loaded a model (the predictions of the child hang), so a server that forks its workers from a preloaded master only
+imports the libraries there (PRELOAD_MODELS in settings.py, see preload_model_libraries()) and the workers share their
+code copy-on-write; the registry of a forked worker starts empty and loads the models again.
+
+The predictions of a model run on one thread (its MicroBatcher): inputs that arrive while it is busy, or within
+MAX_WAIT_MS of the oldest waiting one, are stacked into one batch of up to MAX_BATCH inputs. The overhead of a call into
+the model is shared by the batch, so the throughput grows with the load instead of the number of calls.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from typing import Callable
+import numpy as np
+from asgiref.sync import sync_to_async
+from src.main.audio import DecodedAudio
+from src.main.features import compute_features, fix_frames
+from src.main.instrumentation import timed
+import src.recorder.settings as cfg
+
+DECODERS = ('classifier', 'ctc')
+
+
+class MicroBatcher:
+    """ Runs a batch prediction function for single inputs that are submitted by many threads or coroutines. The inputs
+    are stacked into batches of inputs with the same shape, in arrival order.
+
+    Arguments:
+        predict (Callable): Predicts a batch (the inputs stacked on a new first axis), returns one output per input.
+        max_batch (int): Maximum number of inputs per batch.
+        max_wait (float): Seconds the oldest input waits for more inputs before its batch runs.
+    """
+
+    def __init__(self, predict: Callable[[np.ndarray], np.ndarray], max_batch: int = 32, max_wait: float = 0.005):
+        self.predict_batch = predict
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.counters = Counter()
+
+    def _start(self):
+        """ Starts the prediction thread, also in a forked process (threads do not survive a fork). Call it with the
+        condition held. """
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+            self.thread.start()
+
+    def submit(self, inputs: np.ndarray) -> Future:
+        """ Queues one input, the future gets its output. """
+        future = Future()
+        with self.condition:
+            self._start()
+            self.queue.append((inputs, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        """ Predicts one input in the next batch. """
+        return self.submit(inputs).result()
+
+    async def predict_async(self, inputs: np.ndarray) -> np.ndarray:
+        """ Predicts one input like predict(), without blocking the event loop. """
+        return await asyncio.wrap_future(self.submit(inputs))
+
+    def _next_batch(self) -> list:
+        """ Waits for the next batch: up to max_batch queued inputs with the shape of the oldest one. """
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+
+            deadline = self.queue[0][2] + self.max_wait
+            while len(self.queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            shape = self.queue[0][0].shape
+            batch, skipped = [], []
+            while self.queue and len(batch) < self.max_batch:
+                item = self.queue.popleft()
+                (batch if item[0].shape == shape else skipped).append(item)
+            self.queue.extendleft(reversed(skipped))
+            return batch
+
+    def _run(self):
+        while True:
+            batch = [(inputs, future) for inputs, future, _ in self._next_batch()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                with timed("model_batch"):
+                    outputs = self.predict_batch(np.stack([inputs for inputs, _ in batch]))
+            except Exception as ex:
+                for _, future in batch:
+                    future.set_exception(ex)
+                self._count(len(batch), "errors")
+                continue
+
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+            self._count(len(batch), "full_batches" if len(batch) == self.max_batch else None)
+
+    def _count(self, size: int, counter: str = None):
+        with self.condition:
+            self.counters["batches"] += 1
+            self.counters["inputs"] += size
+            if counter:
+                self.counters[counter] += 1
+
+    def stats(self) -> dict:
+        """ Batches, predicted inputs, full batches, failed batches, the mean batch size and the queued inputs. """
+        with self.condition:
+            stats = dict(self.counters, queued=len(self.queue))
+        if stats.get("batches"):
+            stats["mean_batch"] = round(stats["inputs"] / stats["batches"], 2)
+        return stats
+
+
+class LocalModel:
+    """ A loaded model with the features of its inputs, the decoding of its outputs and its batcher.
+
+    Arguments:
+        name (str): Name of the model in MODELS.
+        model: The Keras model.
+        config (dict): Its configuration in MODELS.
+    """
+
+    def __init__(self, name: str, model, config: dict):
+        self.name = name
+        self.model = model
+        self.labels = list(config['LABELS'])
+        self.decoder = config.get('DECODER', 'classifier')
+        if self.decoder not in DECODERS:
+            raise ValueError("Unknown decoder '{}', choose one of: {}.".format(self.decoder, ", ".join(DECODERS)))
+
+        self.features = feature_config(config)
+        self.frames = config.get('FRAMES')
+        # Convolutional models take the features as an image with one channel
+        self.channel = len(model.input_shape) == 4
+        batching = dict(cfg.MODEL_BATCHING, **config.get('BATCHING', {}))
+        self.batcher = MicroBatcher(model.predict_on_batch, batching['MAX_BATCH'], batching['MAX_WAIT_MS'] / 1000.0)
+
+    def inputs(self, audio: DecodedAudio) -> np.ndarray:
+        """ Returns the input of the model for the audio. """
+        with timed("features"):
+            features = compute_features(audio.samples, audio.sample_rate, **self.features)
+        return self.prepare(features)
+
+    def prepare(self, features: np.ndarray) -> np.ndarray:
+        """ Returns the input of the model for features of the audio (e.g. from a FeatureStore). """
+        features = features.astype(np.float32, copy=False)
+        if self.frames:
+            features = fix_frames(features, self.frames)
+        return features[..., np.newaxis] if self.channel else features
+
+    def decode(self, output: np.ndarray) -> str:
+        """ Returns the text of the output of the model: the most likely label of a classifier, or the best label per
+        frame of a CTC model with repeats merged and blanks (the output after the last label) dropped. """
+        if self.decoder == 'classifier':
+            return self.labels[int(np.argmax(output))]
+
+        best = np.argmax(output, axis=-1)
+        if not len(best):
+            return ""
+        keep = np.concatenate([[True], best[1:] != best[:-1]]) & (best < len(self.labels))
+        return "".join(self.labels[label] for label in best[keep]).strip()
+
+    def transcribe(self, audio: DecodedAudio) -> str:
+        return self.predict(self.inputs(audio))
+
+    def transcribe_features(self, features: np.ndarray) -> str:
+        """ Recognizes precomputed features of the audio. """
+        return self.predict(self.prepare(features))
+
+    def predict(self, inputs: np.ndarray) -> str:
+        with timed("inference"):
+            output = self.batcher.predict(inputs)
+        return self.decode(output)
+
+    async def transcribe_async(self, audio: DecodedAudio) -> str:
+        inputs = await sync_to_async(self.inputs, thread_sensitive=False)(audio)
+        with timed("inference"):
+            output = await self.batcher.predict_async(inputs)
+        return self.decode(output)
+
+
+def feature_config(config: dict) -> dict:
+    """ Returns the arguments of compute_features() for a model of MODELS: FEATURES in settings.py, overridden by the
+    FEATURES of the model. """
+    return {key.lower(): value for key, value in dict(cfg.FEATURES, **config.get('FEATURES', {})).items()}
+
+
+def load_keras_model(path: str):
+    """ Loads a Keras model for inference (it is not compiled). """
+    import keras
+
+    model = keras.models.load_model(path, compile=False)
+    if hasattr(model, '_make_predict_function'):
+        # Keras 2 builds the prediction function lazily, it has to exist before the batcher thread uses it
+        model._make_predict_function()
+    return model
+
+
+def preload_model_libraries():
+    """ Imports the libraries of the local models without loading a model, so a server that forks its workers after
+    this shares their code with them (see above). """
+    import keras  # noqa: F401
+    import librosa  # noqa: F401
+
+
+class ModelRegistry:
+    """ The local models of a process, every model is loaded once, on first use.
+
+    Arguments:
+        configs (dict): Configuration per model name (MODELS in settings.py).
+    """
+
+    def __init__(self, configs: dict):
+        self.configs = configs
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> LocalModel:
+        """ Returns a model, it is loaded if this is its first use. """
+        model = self.models.get(name)
+        if model is not None:
+            return model
+
+        with self.lock:
+            if name not in self.models:
+                try:
+                    config = self.configs[name]
+                except KeyError:
+                    raise ValueError("Unknown model '{}', choose one of: {}.".format(
+                        name, ", ".join(self.configs) or "none (set LOCAL_MODEL_PATH or MODELS in settings.py)"))
+                self.models[name] = LocalModel(name, load_keras_model(config['PATH']), config)
+            return self.models[name]
+
+    def stats(self) -> dict:
+        """ Batching statistics of the loaded models (see MicroBatcher.stats()), per "model/statistic". """
+        return {"{}/{}".format(name, key): value for name, model in list(self.models.items())
+                for key, value in model.batcher.stats().items()}
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def get_model_registry() -> ModelRegistry:
+    """ Returns the model registry of this process, configured by MODELS in settings.py. A forked process gets a new
+    registry (see above). """
+    global _registry, _registry_pid
+    with _registry_lock:
+        if _registry is None or _registry_pid != os.getpid():
+            _registry = ModelRegistry(cfg.MODELS)
+            _registry_pid = os.getpid()
+        return _registry
@@ -0,0 +1,210 @@
+""" Contains the latency instrumentation. Every stage of the pipeline (saving, decoding, voice activity detection,
+recognition, scoring, ...) is timed with timed(); the durations are collected in histograms per stage and per view,
+which the metrics view exposes in the Prometheus text format. The stages of a request are also sent back to the
+client in a Server-Timing header (ServerTimingMiddleware), so they show up in the network panel of the browser.
+
+The histograms are kept per process: with more than one worker every worker has to be scraped. The timings of a
+request are kept in a context variable, so concurrent requests of async views (which share a thread) are kept apart.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterable, Tuple
+from django.contrib.sessions.middleware import SessionMiddleware
+import src.recorder.settings as cfg
+
+HELP = {
+    'speech_stage_seconds': "Duration of the stages of the speech recognition pipeline.",
+    'speech_request_seconds': "Duration of the requests per view, including the session and all middleware.",
+}
+
+# Timings of the request that is being handled, None outside of a request
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class Histogram:
+    """ Cumulative histogram of observed values, safe to use from multiple threads.
+
+    Arguments:
+        buckets (Iterable[float]): Upper bounds of the buckets, a +Inf bucket is added.
+    """
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> Tuple[list, float, int]:
+        """ Returns the cumulative counts per bucket, the sum and the count of the observed values. """
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+
+        cumulative, running = [], 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total, running
+
+
+def _labels(labels: tuple) -> str:
+    return ",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels)
+
+
+class Metrics:
+    """ Registry of labelled histograms.
+
+    Arguments:
+        buckets (Iterable[float]): Bucket bounds of every histogram, in seconds.
+    """
+
+    def __init__(self, buckets: Iterable[float]):
+        self.buckets = tuple(buckets)
+        self.histograms = OrderedDict()
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def render(self) -> str:
+        """ Renders all histograms in the Prometheus text format. """
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+
+        lines, previous = [], None
+        for (name, labels), histogram in histograms:
+            if name != previous:
+                lines += ["# HELP {} {}".format(name, HELP.get(name, name)), "# TYPE {} histogram".format(name)]
+                previous = name
+
+            cumulative, total, count = histogram.snapshot()
+            bounds = [repr(float(bound)) for bound in histogram.buckets] + ["+Inf"]
+            for bound, value in zip(bounds, cumulative):
+                lines.append("{}_bucket{{{}}} {}".format(name, _labels(labels + (("le", bound),)), value))
+            lines.append("{}_sum{{{}}} {}".format(name, _labels(labels), repr(total)))
+            lines.append("{}_count{{{}}} {}".format(name, _labels(labels), count))
+
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+def render_gauge(name: str, description: str, values: dict, label: str) -> str:
+    """ Renders a gauge with one labelled value per item of values in the Prometheus text format. """
+    lines = ["# HELP {} {}".format(name, description), "# TYPE {} gauge".format(name)]
+    lines += ["{}{{{}}} {}".format(name, _labels(((label, key),)), value) for key, value in sorted(values.items())]
+    return "\n".join(lines) + "\n"
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """ Returns the metrics registry of this process, configured by INSTRUMENTATION in settings.py. """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(cfg.INSTRUMENTATION['BUCKETS'])
+        return _metrics
+
+
+def record_stage(stage: str, seconds: float):
+    """ Adds the duration of a stage to its histogram and to the timings of the current request. """
+    if not cfg.INSTRUMENTATION['ENABLED']:
+        return
+
+    get_metrics().observe('speech_stage_seconds', seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage: str):
+    """ Times the enclosed block (or the decorated function) as a stage of the pipeline. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def server_timing(timings: Iterable[Tuple[str, float]]) -> str:
+    """ Formats stage timings as a Server-Timing header, stages that ran more than once are added up. """
+    totals = OrderedDict()
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+    return ", ".join("{};dur={:.1f}".format(stage, seconds * 1000) for stage, seconds in totals.items())
+
+
+class ServerTimingMiddleware:
+    """ Times every request per view and adds the stages that ran in it as a Server-Timing header. It should be the
+    first middleware, so the total includes the other middleware (e.g. writing the session). It supports both sync
+    and async requests. """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marks this instance as a coroutine function for Django
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self._acall(request)
+        if not cfg.INSTRUMENTATION['ENABLED']:
+            return self.get_response(request)
+
+        token, start = _timings.set([]), time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = _timings.get()
+            _timings.reset(token)
+        return self._finish(request, response, timings, time.perf_counter() - start)
+
+    async def _acall(self, request):
+        if not cfg.INSTRUMENTATION['ENABLED']:
+            return await self.get_response(request)
+
+        token, start = _timings.set([]), time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timings = _timings.get()
+            _timings.reset(token)
+        return self._finish(request, response, timings, time.perf_counter() - start)
+
+    @staticmethod
+    def _finish(request, response, timings: list, total: float):
+        view = getattr(getattr(request, 'resolver_match', None), 'url_name', None) or "unresolved"
+        get_metrics().observe('speech_request_seconds', total, view=view, method=request.method)
+        response['Server-Timing'] = server_timing(timings + [('total', total)])
+        return response
+
+
+class TimedSessionMiddleware(SessionMiddleware):
+    """ Django's SessionMiddleware, writing the session is timed as the "session" stage. """
+
+    def process_response(self, request, response):
+        with timed("session"):
+            return super().process_response(request, response)
@@ -0,0 +1,267 @@
+""" Contains the asynchronous transcription job queue. Uploads are put in a bounded queue and processed by a fixed
+pool of worker threads, so a slow recognizer does not keep the web workers busy. When the queue is full new jobs are
+refused (QueueFull), which the views turn into a 429 response. Finished jobs are kept for JOB_RESULT_TTL seconds
+so clients can poll (or long-poll) for the result.
+
+Queued jobs run in the order of their priority, then in submission order. A job can be submitted held: it waits
+outside of the queue, without a worker, until start() queues it (the views start a job when the admission control
+admits it, with the admission order as its priority, see admission.py).
+
+The jobs of an owner are numbered when they are submitted. Their results are applied (added to the transcript of the
+session, see views.job_status) strictly in that order, whichever poll comes first: a job that finishes early is held
+back until the jobs before it are finished, and every job is applied exactly once.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Union
+from src.main.instrumentation import record_stage
+import src.recorder.settings as cfg
+
+
+class QueueFull(Exception):
+    """ Raised when a job is submitted while the queue is full. """
+
+
+class Job:
+    """ A unit of work in the JobQueue.
+
+    Attributes:
+        id (str): Unique id of the job.
+        owner (str): Identifies who submitted the job (the session key), only the owner may see the result.
+        status (str): "queued", "running", "done" or "failed".
+        result: Return value of the function, once it is done.
+        error (str): Error message, if it failed.
+        data (dict): Extra data the submitter wants to keep with the job.
+        seq (int): Position of the job among the jobs of its owner.
+    """
+
+    def __init__(self, func: Callable, args: tuple, kwargs: dict, owner: str = None, data: dict = None):
+        self.id = uuid.uuid4().hex
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.owner = owner
+        self.data = data or {}
+        self.seq = None
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def timings(self) -> dict:
+        """ Seconds spent waiting in the queue, running and in total (None if not reached yet). """
+        def elapsed(start, end):
+            return round(end - start, 4) if start is not None and end is not None else None
+
+        return {"queued": elapsed(self.queued_at, self.started_at),
+                "running": elapsed(self.started_at, self.finished_at),
+                "total": elapsed(self.queued_at, self.finished_at)}
+
+    def run(self):
+        self.started_at = time.time()
+        self.status = "running"
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.status = "done"
+
+        except Exception as ex:
+            logging.error("Job %s failed: %s", self.id, ex)
+            self.error = str(ex)
+            self.status = "failed"
+
+        finally:
+            self.finished_at = time.time()
+            with self.lock:
+                self.finished.set()
+                callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback()
+            record_stage("job_queued", self.started_at - self.queued_at)
+            record_stage("job_running", self.finished_at - self.started_at)
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Blocks until the job is finished or the timeout expires, returns True if it is finished. """
+        return self.finished.wait(timeout)
+
+    async def wait_async(self, timeout: float = None) -> bool:
+        """ Waits like wait() without blocking a thread (for async views), returns True if the job is finished. """
+        loop = asyncio.get_event_loop()
+        finished = asyncio.Event()
+
+        def notify():
+            try:
+                loop.call_soon_threadsafe(finished.set)
+            except RuntimeError:
+                # The loop has been closed, nobody is waiting anymore
+                pass
+
+        with self.lock:
+            if self.finished.is_set():
+                return True
+            self.callbacks.append(notify)
+
+        try:
+            await asyncio.wait_for(finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                if notify in self.callbacks:
+                    self.callbacks.remove(notify)
+
+        return self.finished.is_set()
+
+
+class JobQueue:
+    """ Bounded priority queue of jobs processed by a pool of worker threads.
+
+    Arguments:
+        workers (int): Number of worker threads.
+        max_size (int): Maximum number of held and queued (not yet running) jobs.
+        result_ttl (float): Seconds a finished job is kept.
+    """
+
+    def __init__(self, workers: int, max_size: int, result_ttl: float):
+        self.max_size = max_size
+        # Heap of (priority, submission order, job)
+        self.queue = []
+        self.held = set()
+        self.order = itertools.count()
+        self.result_ttl = result_ttl
+        self.jobs = OrderedDict()
+        # Per owner: the next number, the number of the next job to apply, the numbered jobs and the lock of applying
+        self.sequences = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.threads = [threading.Thread(target=self._work, name="transcription-worker-{}".format(i), daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                _, _, job = heapq.heappop(self.queue)
+            job.run()
+
+    def _expire(self):
+        """ Forgets finished jobs that are older than result_ttl (jobs are ordered by submission). """
+        now = time.time()
+        while self.jobs:
+            job = next(iter(self.jobs.values()))
+            if job.finished_at is None or now - job.finished_at < self.result_ttl:
+                break
+            self.jobs.popitem(last=False)
+            sequence = self.sequences.get(job.owner)
+            if sequence is not None:
+                sequence["jobs"].pop(job.seq, None)
+                if not sequence["jobs"]:
+                    del self.sequences[job.owner]
+
+    def submit(self, func: Callable, *args, owner: str = None, data: dict = None, priority: tuple = (),
+               held: bool = False, **kwargs) -> Job:
+        """ Queues func(*args, **kwargs).
+
+        Arguments:
+            priority (tuple): Jobs with a lower priority run first.
+            held (bool): Keep the job out of the queue until it is started with start().
+
+        Returns:
+            The queued job (Job).
+
+        Raises:
+            QueueFull: If the maximum number of held and queued jobs has been reached.
+        """
+        job = Job(func, args, kwargs, owner, data)
+        with self.lock:
+            self._expire()
+            if len(self.queue) + len(self.held) >= self.max_size:
+                raise QueueFull("The transcription queue is full, please try again later.")
+            if held:
+                self.held.add(job)
+            else:
+                self._push(job, priority)
+            self.jobs[job.id] = job
+            sequence = self.sequences.setdefault(owner, {"next": 0, "applied": 0, "jobs": {},
+                                                         "lock": threading.Lock()})
+            job.seq = sequence["next"]
+            sequence["jobs"][job.seq] = job
+            sequence["next"] += 1
+
+        return job
+
+    def _push(self, job: Job, priority: tuple):
+        """ Queues a job for the workers. Call it with the lock held. """
+        heapq.heappush(self.queue, (priority, next(self.order), job))
+        self.ready.notify()
+
+    def start(self, job: Job, priority: tuple = (), **kwargs):
+        """ Queues a held job, kwargs are added to the keyword arguments of its function. """
+        with self.lock:
+            if job not in self.held:
+                return
+            self.held.remove(job)
+            job.kwargs.update(kwargs)
+            self._push(job, priority)
+
+    def apply(self, job: Job, apply: Callable[[Job], None]) -> Union[Job, None]:
+        """ Applies the finished jobs of the owner of a job in submission order, up to the first one that is not
+        finished. Every job is applied once: apply(job) is called with the lock of the owner held. Jobs that expired
+        before they were applied are skipped.
+
+        Returns:
+            None if the job has been applied, otherwise the earlier job it is held back by (Job).
+        """
+        with self.lock:
+            sequence = self.sequences.get(job.owner)
+        if sequence is None:
+            return None
+
+        with sequence["lock"]:
+            while True:
+                with self.lock:
+                    if sequence["applied"] == sequence["next"]:
+                        return None
+                    pending = sequence["jobs"].get(sequence["applied"])
+                    if pending is not None and not pending.finished.is_set():
+                        return None if job.seq < sequence["applied"] else pending
+                    sequence["applied"] += 1
+                if pending is not None:
+                    apply(pending)
+
+    def get(self, job_id: str) -> Union[Job, None]:
+        """ Returns the job with the given id or None if it does not exist (anymore). """
+        with self.lock:
+            self._expire()
+            return self.jobs.get(job_id)
+
+    def __len__(self) -> int:
+        """ Returns the number of held and queued jobs. """
+        with self.lock:
+            return len(self.queue) + len(self.held)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """ Returns the job queue of this process, it is created (and its workers are started) on first use. """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(cfg.JOB_WORKERS, cfg.JOB_QUEUE_SIZE, cfg.JOB_RESULT_TTL)
+        return _job_queue
@@ -0,0 +1,181 @@
+""" Benchmarks the hot paths of the analyzer on synthetic audio and compares them with a stored baseline.
+
+Usage:
+    python manage.py benchmark [--output results.json] [--baseline baseline.json] [--save-baseline]
+                               [--tolerance 0.25] [--repeat 5] [--quick]
+
+Speech-like audio (voiced syllables with harmonics, fricative noise and pauses) is generated for several lengths and
+encoded as wav, webm (Opus) and mp3. Every case is run --repeat times and its median is compared with the median in
+the baseline: a case that is more than --tolerance slower (and more than MIN_REGRESSION_SECONDS) fails the command.
+Baselines depend on the machine, save one on the machine that runs the benchmark: without a baseline the command fails
+unless --save-baseline is given, so a missing baseline never passes as "no regression".
+"""
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+import numpy as np
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from src.main.analyzer import calculate_metrics, check_audio_length, get_audio_features, save_recording, \
+    speech_to_text
+from src.main.media import MediaStore
+from src.main.normalization import Normalizer
+from src.main.probe import clear_probe_cache
+from src.main.synthetic import encode, synthesize_speech, synthesize_transcripts
+import src.recorder.settings as cfg
+
+FORMATS = ('wav', 'webm', 'mp3')
+DURATIONS = (5, 30, 120)
+QUICK_DURATIONS = (5,)
+# Long transcripts (a lecture) catch an alignment that does not scale
+TRANSCRIPT_SIZES = (10, 100, 1000, 10000, 20000)
+QUICK_TRANSCRIPT_SIZES = (10, 100, 20000)
+# Differences below this are noise, they are never reported as a regression
+MIN_REGRESSION_SECONDS = 0.002
+# Stand-in recognizer without latency, so the benchmark measures the pipeline and not a simulated network
+BACKEND = 'benchmark'
+BACKEND_CONFIG = {'CLASS': 'src.main.recognizers.FakeRecognizer',
+                  'OPTIONS': {'transcripts': ["the quick brown fox jumps over the lazy dog"]}}
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """ Runs func repeat times (after setup, which is not timed) and returns the median and minimum in seconds. """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {'median': statistics.median(durations), 'min': min(durations), 'repeat': repeat}
+
+
+def run_benchmarks(durations: tuple, transcript_sizes: tuple, repeat: int, log=None) -> OrderedDict:
+    """ Runs every benchmark case.
+
+    Returns:
+        OrderedDict: Timings (median, min, repeat) per case name.
+    """
+    results = OrderedDict()
+    added_backend = cfg.ASR_BACKENDS.setdefault(BACKEND, BACKEND_CONFIG) is BACKEND_CONFIG
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    store = MediaStore(os.path.join(directory, "media"), cfg.MEDIA['TTL'], cfg.MEDIA['MAX_BYTES'])
+    try:
+        for duration in durations:
+            samples = synthesize_speech(duration)
+            for fmt in FORMATS:
+                data = encode(samples, 16000, fmt)
+                name = "{}s.{}".format(duration, fmt)
+                saved = {}
+
+                def save():
+                    saved['context'], saved['audio'] = save_recording({}, ContentFile(data, name=name), store=store)
+
+                results['save_recording/' + name] = measure(save, repeat)
+                # Short files are not kept by save_recording, the probes always read a file
+                path = os.path.join(directory, name)
+                with open(path, 'wb') as audio_file:
+                    audio_file.write(data)
+                results['get_audio_features/' + name] = measure(lambda: get_audio_features(path), repeat,
+                                                                setup=clear_probe_cache)
+                results['check_audio_length/' + name] = measure(lambda: check_audio_length(path), repeat,
+                                                                setup=clear_probe_cache)
+                if fmt == 'wav':
+                    results['speech_to_text/' + name] = measure(
+                        lambda: speech_to_text(saved['audio'], backend=BACKEND, use_cache=False), repeat)
+                if log:
+                    log("{} done".format(name))
+
+        for size in transcript_sizes:
+            truth, hypothesis = synthesize_transcripts(size)
+            text = " ".join(hypothesis)
+            results['normalize/{}_words'.format(size)] = measure(lambda: Normalizer(memo_size=0).ids(text), repeat)
+            results['calculate_metrics/{}_words'.format(size)] = measure(
+                lambda: calculate_metrics({}, truth, hypothesis), repeat)
+
+    finally:
+        if added_backend:
+            del cfg.ASR_BACKENDS[BACKEND]
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """ Compares the medians with the baseline.
+
+    Returns:
+        list: (case, baseline median, median) of the cases that are more than tolerance slower.
+    """
+    regressions = []
+    for case, timing in results.items():
+        reference = baseline.get(case)
+        if reference is None:
+            continue
+        if timing['median'] > reference['median'] * (1 + tolerance) \
+                and timing['median'] - reference['median'] > MIN_REGRESSION_SECONDS:
+            regressions.append((case, reference['median'], timing['median']))
+    return regressions
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the analyzer on synthetic audio and fails if it is slower than the baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help="Write the results to this JSON file.")
+        parser.add_argument('--baseline', default=cfg.BENCHMARK_BASELINE,
+                            help="Baseline JSON file (default: BENCHMARK_BASELINE in settings.py).")
+        parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline.")
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help="Allowed slowdown relative to the baseline (0.25 = 25%%).")
+        parser.add_argument('--repeat', '-r', type=int, default=5, help="Number of runs per case.")
+        parser.add_argument('--quick', action='store_true', help="Only the short audio and small transcripts.")
+
+    def handle(self, *args, **options):
+        if not options['save_baseline'] and not (options['baseline'] and os.path.exists(options['baseline'])):
+            raise CommandError("No baseline found at {}, run with --save-baseline to store one.".format(
+                options['baseline']))
+
+        results = run_benchmarks(QUICK_DURATIONS if options['quick'] else DURATIONS,
+                                 QUICK_TRANSCRIPT_SIZES if options['quick'] else TRANSCRIPT_SIZES,
+                                 options['repeat'], log=self.stderr.write)
+        report = OrderedDict([
+            ('environment', {'python': sys.version.split()[0], 'numpy': np.__version__,
+                             'platform': platform.platform(), 'cpus': os.cpu_count()}),
+            ('results', results),
+        ])
+
+        baseline = None
+        if options['baseline'] and os.path.exists(options['baseline']):
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)['results']
+
+        for case, timing in results.items():
+            reference = baseline.get(case) if baseline else None
+            change = " ({:+.0%})".format(timing['median'] / reference['median'] - 1) \
+                if reference and reference['median'] else ""
+            self.stdout.write("{:<40} {:>10.2f} ms{}".format(case, timing['median'] * 1000, change))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+        if options['save_baseline']:
+            os.makedirs(os.path.dirname(os.path.abspath(options['baseline'])), exist_ok=True)
+            with open(options['baseline'], 'w') as baseline_file:
+                json.dump(report, baseline_file, indent=2)
+            self.stdout.write("Baseline saved to {}".format(options['baseline']))
+            return
+
+        regressions = find_regressions(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError("Performance regression:\n" + "\n".join(
+                "  {}: {:.2f} ms -> {:.2f} ms".format(case, before * 1000, after * 1000)
+                for case, before, after in regressions))
@@ -0,0 +1,28 @@
+""" Removes expired audio files from MEDIA_ROOT once, e.g. from cron when the background collector is disabled.
+
+Usage:
+    python manage.py collectmedia [--ttl 86400] [--max-bytes 2147483648]
+
+Files older than --ttl seconds are removed, then the oldest files until MEDIA_ROOT is smaller than --max-bytes
+(defaults: MEDIA in settings.py).
+"""
+
+from django.core.management.base import BaseCommand
+from src.main.media import MediaStore
+import src.recorder.settings as cfg
+
+
+class Command(BaseCommand):
+    help = "Removes expired audio files from MEDIA_ROOT and reports the size of the media store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=float, default=cfg.MEDIA['TTL'], help="Maximum age of a file in seconds.")
+        parser.add_argument('--max-bytes', type=int, default=cfg.MEDIA['MAX_BYTES'],
+                            help="Maximum size of all files together.")
+
+    def handle(self, *args, **options):
+        store = MediaStore(cfg.MEDIA_ROOT, options['ttl'], options['max_bytes'])
+        result = store.collect()
+        stats = store.stats()
+        self.stdout.write("Removed {} files ({} bytes), {} files ({} bytes) left.".format(
+            result['removed'], result['freed_bytes'], stats['files'], stats['bytes']))
@@ -0,0 +1,250 @@
+""" Evaluates the speech recognition pipeline on a corpus of audio files with reference transcripts.
+
+Usage:
+    python manage.py evaluate <directory or manifest> --output results.csv [--workers 8] [--processes]
+                              [--model commands [--features DIR]]
+
+A directory is searched (recursively) for audio files that have a .txt file with the same name next to them.
+A manifest is a .csv file with "audio" and "text" columns or a .jsonl file with {"audio": ..., "text": ...} lines,
+relative audio paths are resolved from the directory of the manifest.
+
+With --model, the utterances are recognized by a local model (see MODELS in settings.py) instead of the backend, from
+features that are precomputed into a feature store first (see "manage.py extractfeatures"): a later run over the same
+corpus only extracts the files that changed and reads the others from the store.
+
+The utterances are recognized in the workers and scored as they come in. The references are normalized once, in one
+batch, so every utterance is scored on the word ids of one vocabulary (see normalization.py).
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from src.main.analyzer import calculate_metrics, speech_to_text
+from src.main.audio import decode_file
+from src.main.features import FeatureStore
+from src.main.inference import LocalModel, get_model_registry
+from src.main.normalization import Normalizer, get_normalizer
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.webm', '.ogg', '.opus', '.m4a')
+METRICS = ('wer', 'wcr', 'precision_micro', 'precision_macro', 'recall_micro', 'recall_macro',
+           'f1_micro', 'f1_macro')
+COUNTS = ('hits', 'substitutions', 'deletions', 'insertions')
+COLUMNS = ('id', 'audio', 'duration', 'rtf', 'seconds') + METRICS + COUNTS + ('reference', 'hypothesis', 'error')
+
+
+def read_corpus(source: str) -> list:
+    """ Reads the (audio path, reference text) pairs of a corpus directory or manifest.
+
+    Args:
+        source (str): Directory or .csv/.jsonl manifest.
+
+    Returns:
+        list: (id, audio path, reference text) tuples.
+    """
+    if os.path.isdir(source):
+        items = []
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                stem, extension = os.path.splitext(name)
+                reference = os.path.join(root, stem + '.txt')
+                if extension.lower() in AUDIO_EXTENSIONS and os.path.exists(reference):
+                    with open(reference, encoding='utf-8') as text_file:
+                        items.append((os.path.relpath(os.path.join(root, stem), source),
+                                      os.path.join(root, name), text_file.read().strip()))
+        return items
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding='utf-8') as manifest:
+        if source.endswith('.jsonl'):
+            rows = [json.loads(line) for line in manifest if line.strip()]
+        elif source.endswith('.csv'):
+            rows = list(csv.DictReader(manifest))
+        else:
+            raise CommandError("The manifest should be a .csv or .jsonl file.")
+
+    return [(row.get('id', row['audio']), os.path.join(base, row['audio']), row['text']) for row in rows]
+
+
+def evaluate_utterance(item: tuple, backend: str = None, language_code: str = "en", use_cache: bool = None) -> dict:
+    """ Decodes and recognizes one utterance (runs in a worker thread or process), see score_utterance().
+
+    Returns:
+        dict: One result row (see COLUMNS), with the error message if the utterance failed.
+    """
+    utterance_id, audio_path, reference = item
+    row = {'id': utterance_id, 'audio': audio_path, 'reference': reference}
+    start = time.time()
+    try:
+        audio = decode_file(audio_path, mapped=True)
+        row['duration'] = round(audio.duration, 3)
+        row['hypothesis'], row['rtf'] = speech_to_text(audio, language_code=language_code, backend=backend,
+                                                    use_cache=use_cache)
+    except Exception as ex:
+        row['error'] = "{}: {}".format(type(ex).__name__, ex)
+
+    row['seconds'] = round(time.time() - start, 3)
+    return row
+
+
+def evaluate_features(item: tuple, store: FeatureStore, model: LocalModel) -> dict:
+    """ Recognizes one utterance from its precomputed features with a local model (runs in a worker thread), see
+    evaluate_utterance().
+
+    Returns:
+        dict: One result row (see COLUMNS), with the error message if the utterance failed.
+    """
+    utterance_id, audio_path, reference = item
+    row = {'id': utterance_id, 'audio': audio_path, 'reference': reference}
+    start = time.time()
+    try:
+        if utterance_id not in store:
+            raise ValueError("The features of the audio could not be extracted.")
+        row['duration'] = round(store.duration(utterance_id), 3)
+        row['hypothesis'] = model.transcribe_features(store.get(utterance_id))
+        row['rtf'] = round((time.time() - start) / row['duration'], 2) if row['duration'] else 0.0
+    except Exception as ex:
+        row['error'] = "{}: {}".format(type(ex).__name__, ex)
+
+    row['seconds'] = round(time.time() - start, 3)
+    return row
+
+
+def score_utterance(row: dict, truth: np.ndarray, normalizer: Normalizer) -> dict:
+    """ Scores the hypothesis of a recognized utterance against the word ids of its reference.
+
+    Returns:
+        dict: The row with the metrics, the word counts and the alignment counts.
+    """
+    if row.get('error'):
+        return row
+
+    hypothesis = normalizer.ids(row['hypothesis'])
+    row['truth_words'], row['hypothesis_words'] = len(truth), len(hypothesis)
+    metrics = calculate_metrics({}, truth, hypothesis)
+    row.update((key, metrics[key]) for key in METRICS + COUNTS)
+    return row
+
+
+def summarize(rows: list) -> dict:
+    """ Calculates the corpus level metrics of the successful rows. Micro averages of the micro metrics (WER, WCR,
+    precision, recall and F1) are calculated from the alignment counts summed over the corpus, those of the macro
+    metrics weigh every utterance by its number of reference words (recall) or hypothesis words (precision). Macro
+    averages weigh every utterance the same. """
+    rows = [row for row in rows if not row.get('error')]
+    summary = {'utterances': len(rows)}
+    if not rows:
+        return summary
+
+    truth_words = np.array([row['truth_words'] for row in rows], dtype=float)
+    hypothesis_words = np.array([row['hypothesis_words'] for row in rows], dtype=float)
+    counts = {key: sum(row[key] for row in rows) for key in COUNTS}
+    summary.update(counts)
+    pooled = {}
+    if truth_words.sum():
+        pooled['wer'] = (counts['substitutions'] + counts['deletions'] + counts['insertions']) / truth_words.sum()
+        pooled['wcr'] = pooled['recall_micro'] = counts['hits'] / truth_words.sum()
+    if hypothesis_words.sum():
+        pooled['precision_micro'] = counts['hits'] / hypothesis_words.sum()
+    precision, recall = pooled.get('precision_micro', 0.0), pooled.get('recall_micro', 0.0)
+    pooled['f1_micro'] = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+    for metric in METRICS:
+        values = np.array([row[metric] for row in rows], dtype=float)
+        weights = hypothesis_words if metric.startswith('precision') else truth_words
+        summary[metric + '_macro_avg'] = round(float(values.mean()), 4)
+        if metric in ('wer', 'wcr') or metric.endswith('_micro'):
+            summary[metric + '_micro_avg'] = round(float(pooled.get(metric, 0.0)), 4)
+        else:
+            summary[metric + '_micro_avg'] = round(float((values * weights).sum() / weights.sum()), 4) \
+                if weights.sum() else 0.0
+
+    rtf = np.array([row['rtf'] for row in rows], dtype=float)
+    summary['rtf_mean'] = round(float(rtf.mean()), 4)
+    for percentile in (50, 90, 95, 99):
+        summary['rtf_p{}'.format(percentile)] = round(float(np.percentile(rtf, percentile)), 4)
+    summary['audio_seconds'] = round(sum(row['duration'] for row in rows), 3)
+
+    return summary
+
+
+class Command(BaseCommand):
+    help = "Evaluates speech recognition on a corpus of audio files with reference transcripts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Corpus directory or .csv/.jsonl manifest.")
+        parser.add_argument('--output', '-o', help="Per utterance results, .csv or .jsonl (default: stdout).")
+        parser.add_argument('--workers', '-w', type=int, default=os.cpu_count() or 4,
+                            help="Number of utterances that are processed at the same time.")
+        parser.add_argument('--processes', action='store_true',
+                            help="Use a process pool instead of a thread pool.")
+        parser.add_argument('--backend', help="ASR backend (default: ASR_BACKEND in settings.py).")
+        parser.add_argument('--language', default="en", help="Language code of the corpus.")
+        parser.add_argument('--no-cache', action='store_true',
+                            help="Always call the recognizer, also for audio that was recognized before.")
+        parser.add_argument('--model', help="Recognize with this local model of MODELS in settings.py, from "
+                                            "precomputed features.")
+        parser.add_argument('--features', help="Directory of the feature store of --model (default: in "
+                                               "FEATURE_STORE['DIRECTORY']).")
+
+    def handle(self, *args, **options):
+        items = read_corpus(options['source'])
+        if not items:
+            raise CommandError("No audio files with reference transcripts found in {}.".format(options['source']))
+
+        output = open(options['output'], 'w', newline='', encoding='utf-8') if options['output'] else sys.stdout
+        as_jsonl = bool(options['output']) and options['output'].endswith('.jsonl')
+        writer = None if as_jsonl else csv.DictWriter(output, COLUMNS, extrasaction='ignore')
+        if writer:
+            writer.writeheader()
+
+        normalizer = get_normalizer()
+        truths = normalizer.batch(reference for _, _, reference in items)
+        rows = []
+        start = time.time()
+        if options['model']:
+            # extractfeatures builds on this module
+            from src.main.management.commands.extractfeatures import open_store
+
+            # The features are extracted before the model is loaded, TensorFlow does not survive the fork of a worker
+            store = open_store(options['source'], options['model'], options['features'])
+            store.update([(utterance_id, path) for utterance_id, path, _ in items], options['workers'],
+                         log=self.stderr.write)
+            model = get_model_registry().get(options['model'])
+            # The model batches the utterances of all threads, it is not shared by processes
+            executor_class = ThreadPoolExecutor
+
+            def submit(executor, item):
+                return executor.submit(evaluate_features, item, store, model)
+        else:
+            executor_class = ProcessPoolExecutor if options['processes'] else ThreadPoolExecutor
+
+            def submit(executor, item):
+                return executor.submit(evaluate_utterance, item, options['backend'], options['language'],
+                                       False if options['no_cache'] else None)
+
+        try:
+            with executor_class(max_workers=options['workers']) as executor:
+                futures = {submit(executor, item): truth for item, truth in zip(items, truths)}
+                for future in as_completed(futures):
+                    row = score_utterance(future.result(), futures[future], normalizer)
+                    rows.append(row)
+                    if as_jsonl:
+                        output.write(json.dumps({key: row.get(key) for key in COLUMNS}) + '\n')
+                    else:
+                        writer.writerow(row)
+                    output.flush()
+
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        summary = summarize(rows)
+        summary['failed'] = len(rows) - summary['utterances']
+        summary['wall_seconds'] = round(time.time() - start, 3)
+        # Keep stdout clean for the rows if they are written there
+        (self.stdout if options['output'] else self.stderr).write(json.dumps(summary, indent=2))
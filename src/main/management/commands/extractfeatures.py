@@ -0,0 +1,74 @@
+""" Precomputes the features of a corpus for the local models into a feature store (see features.py), so evaluations
+over the same corpus do not decode the audio again.
+
+Usage:
+    python manage.py extractfeatures <directory or manifest> [--model commands] [--kind logmel] [--size 40]
+                                     [--dtype float16] [--store DIR] [--workers 8] [--threads]
+
+The corpus is read like by "manage.py evaluate". The features are those of --model (see MODELS in settings.py), or
+FEATURES in settings.py changed by --kind and --size. The store is kept in FEATURE_STORE['DIRECTORY'] unless --store is
+given, only new and changed audio files are extracted.
+"""
+
+import json
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from src.main.features import KINDS, FeatureStore, store_directory
+from src.main.inference import feature_config
+from src.main.management.commands.evaluate import read_corpus
+import src.recorder.settings as cfg
+
+
+def open_store(source: str, model: str = None, directory: str = None, dtype: str = None, kind: str = None,
+               size: int = None) -> FeatureStore:
+    """ Opens the feature store of a corpus.
+
+    Arguments:
+        source (str): Corpus directory or manifest.
+        model (str): Use the features of this model of MODELS, instead of FEATURES in settings.py.
+        directory (str): Directory of the store, defaults to one in FEATURE_STORE['DIRECTORY'].
+        dtype (str): Type of the stored features, defaults to FEATURE_STORE['DTYPE'].
+        kind (str): Kind of the features, overrides the model or settings.
+        size (int): Size of the features, overrides the model or settings.
+
+    Returns:
+        The store (FeatureStore).
+    """
+    if model is not None and model not in cfg.MODELS:
+        raise CommandError("Unknown model '{}', choose one of: {}.".format(model, ", ".join(cfg.MODELS)))
+
+    features = feature_config(cfg.MODELS[model] if model else {})
+    features.update((key, value) for key, value in (('kind', kind), ('size', size)) if value is not None)
+    dtype = dtype or cfg.FEATURE_STORE['DTYPE']
+    return FeatureStore(directory or store_directory(source, features, dtype), features, dtype)
+
+
+class Command(BaseCommand):
+    help = "Precomputes the features of a corpus for the local models."
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Corpus directory or .csv/.jsonl manifest.")
+        parser.add_argument('--model', help="Extract the features of this model of MODELS in settings.py.")
+        parser.add_argument('--kind', choices=KINDS, help="Kind of features (default: FEATURES in settings.py).")
+        parser.add_argument('--size', type=int, help="Mel bands or coefficients per frame.")
+        parser.add_argument('--dtype', choices=('float16', 'float32'), help="Type of the stored features "
+                                                                             "(default: FEATURE_STORE in settings.py).")
+        parser.add_argument('--store', help="Directory of the store (default: in FEATURE_STORE['DIRECTORY']).")
+        parser.add_argument('--workers', '-w', type=int, default=os.cpu_count() or 4,
+                            help="Number of files that are extracted at the same time.")
+        parser.add_argument('--threads', action='store_true', help="Use a thread pool instead of a process pool.")
+
+    def handle(self, *args, **options):
+        items = read_corpus(options['source'])
+        if not items:
+            raise CommandError("No audio files with reference transcripts found in {}.".format(options['source']))
+
+        store = open_store(options['source'], options['model'], options['store'], options['dtype'], options['kind'],
+                           options['size'])
+        start = time.time()
+        stats = store.update([(utterance_id, path) for utterance_id, path, _ in items], options['workers'],
+                             processes=not options['threads'], log=self.stderr.write)
+        stats.update(store=store.directory, utterances=len(store), seconds=round(time.time() - start, 3),
+                     bytes=store.data.nbytes if store.data is not None else 0)
+        self.stdout.write(json.dumps(stats, indent=2))
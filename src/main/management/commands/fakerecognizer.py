@@ -0,0 +1,112 @@
+""" Runs a local stand-in recognition service for load tests, used with the "http" backend (ASR_BACKEND=http).
+
+Usage:
+    python manage.py fakerecognizer [--port 8765] [--latency 0.3] [--jitter 0.5] [--distribution lognormal]
+                                    [--error-rate 0.01] [--realtime-factor 0.05]
+
+POST /recognize?encoding=FLAC&sample_rate=16000 with the encoded audio as body answers {"text": ...} after the
+simulated latency, or a 503 for the injected failures. GET /health answers {"status": "ok"}.
+"""
+
+import json
+import logging
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from django.core.management.base import BaseCommand
+from src.main.audio import DecodedAudio, decode_audio
+from src.main.recognizers import FakeRecognizer, RecognitionError
+
+
+class RecognitionServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server that handles every request in its own thread. """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, recognizer: FakeRecognizer, verbose: bool = False):
+        super().__init__(address, RecognitionHandler)
+        self.recognizer = recognizer
+        self.verbose = verbose
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+
+    def _respond(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path == "/health":
+            self._respond(200, {"status": "ok"})
+        else:
+            self._respond(404, {"error": "Not found."})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != "/recognize":
+            self._respond(404, {"error": "Not found."})
+            return
+
+        query = dict(urllib.parse.parse_qsl(url.query))
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if query.get("encoding", "LINEAR16") == "LINEAR16":
+                audio = DecodedAudio(data, int(query.get("sample_rate", 16000)))
+            else:
+                audio = decode_audio(data)
+            text = self.server.recognizer.recognize(audio, query.get("language_code", "en"),
+                                                    query.get("session_id", "me"))
+
+        except ValueError as ex:
+            self._respond(400, {"error": str(ex)})
+            return
+        except RecognitionError as ex:
+            self._respond(503, {"error": str(ex)})
+            return
+
+        self._respond(200, {"text": text})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            logging.info("%s %s", self.address_string(), format % args)
+
+
+def make_server(host: str, port: int, recognizer: FakeRecognizer, verbose: bool = False) -> RecognitionServer:
+    """ Creates the stand-in recognition server, port 0 picks a free port (see server.server_address). """
+    return RecognitionServer((host, port), recognizer, verbose)
+
+
+class Command(BaseCommand):
+    help = "Runs a stand-in speech recognition service with simulated latency and failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default="127.0.0.1")
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.3, help="Base (or median) latency in seconds.")
+        parser.add_argument('--jitter', type=float, default=0.0, help="Spread of the latency.")
+        parser.add_argument('--distribution', choices=FakeRecognizer.DISTRIBUTIONS, default="lognormal",
+                            help="Latency distribution (see FakeRecognizer).")
+        parser.add_argument('--realtime-factor', type=float, default=0.0, help="Extra latency per second of audio.")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests that fail (503).")
+        parser.add_argument('--transcript', action='append', dest='transcripts',
+                            help="Canned transcript, can be given more than once.")
+        parser.add_argument('--seed', type=int, help="Seed of the jitter and the errors (default: random).")
+
+    def handle(self, *args, **options):
+        recognizer = FakeRecognizer(transcripts=options['transcripts'] or
+                                    ["the quick brown fox jumps over the lazy dog"],
+                                    latency=options['latency'], jitter=options['jitter'],
+                                    distribution=options['distribution'],
+                                    realtime_factor=options['realtime_factor'],
+                                    error_rate=options['error_rate'], seed=options['seed'])
+        server = make_server(options['host'], options['port'], recognizer, verbose=options['verbosity'] > 1)
+        self.stdout.write("Fake recognizer listening on http://{}:{}/recognize".format(*server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,88 @@
+""" Reports what importing the app costs, per module, to find what makes a worker start slowly.
+
+Usage:
+    python manage.py importprofile [--top 25] [--sort self|cumulative] [--packages] [--warm-up]
+
+The modules are imported in a fresh interpreter with "python -X importtime", the report is sorted by the time spent
+in the module itself (self) or including its imports (cumulative), in milliseconds.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+DEFAULT_MODULES = ('src.main.views', 'src.main.streaming', 'src.main.analyzer')
+
+
+def profile_imports(modules: tuple, warm_up: bool = False) -> tuple:
+    """ Imports the modules (after django.setup()) in a new interpreter and parses its import times.
+
+    Args:
+        modules (tuple): Dotted module names.
+        warm_up (bool): Also run the warm-up phase, so its lazy imports are included.
+
+    Returns:
+        tuple: (rows, seconds), rows are (module, self ms, cumulative ms, depth) tuples in import order and
+            seconds is the wall time of the interpreter.
+    """
+    script = "import django; django.setup(); import {}".format(", ".join(modules))
+    if warm_up:
+        script += "; from src.main.warmup import warm_up; warm_up()"
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path), WARM_UP="0")
+    start = time.time()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.time() - start
+
+    rows, errors = [], []
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            own, cumulative, indent, module = match.groups()
+            rows.append((module, int(own) / 1000, int(cumulative) / 1000, len(indent) // 2))
+        elif not line.startswith('import time:'):
+            errors.append(line)
+
+    if process.returncode != 0:
+        raise CommandError("Importing the modules failed:\n" + "\n".join(errors))
+
+    return rows, seconds
+
+
+class Command(BaseCommand):
+    help = "Reports the import time of every module that is loaded when the app starts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES,
+                            help="Modules to import (default: {}).".format(" ".join(DEFAULT_MODULES)))
+        parser.add_argument('--top', '-n', type=int, default=25, help="Number of modules to report.")
+        parser.add_argument('--sort', choices=('self', 'cumulative'), default='self',
+                            help="Sort by the time of the module itself or including its imports.")
+        parser.add_argument('--packages', action='store_true',
+                            help="Add up the self time per top level package.")
+        parser.add_argument('--warm-up', action='store_true', help="Include the imports of the warm-up phase.")
+
+    def handle(self, *args, **options):
+        rows, seconds = profile_imports(tuple(options['modules']), options['warm_up'])
+
+        if options['packages']:
+            totals = Counter()
+            for module, own, _, _ in rows:
+                totals[module.split('.')[0]] += own
+            report = [(package, own, own) for package, own in totals.most_common()]
+        else:
+            column = 1 if options['sort'] == 'self' else 2
+            report = [row[:3] for row in sorted(rows, key=lambda row: row[column], reverse=True)]
+
+        self.stdout.write("{:>12} {:>12}  {}".format("self (ms)", "cumul. (ms)", "module"))
+        for module, own, cumulative in report[:options['top']]:
+            self.stdout.write("{:>12.1f} {:>12.1f}  {}".format(own, cumulative, module))
+
+        self.stdout.write("\n{} modules, {:.1f} ms importing, {:.2f} s interpreter wall time".format(
+            len(rows), sum(row[1] for row in rows), seconds))
@@ -0,0 +1,228 @@
+""" Load tests a running deployment the way the recorder page uses it, with a rising number of concurrent users.
+
+Usage:
+    python manage.py loadtest http://127.0.0.1:8000 [--users 1 5 10 20] [--duration 60] [--chunk-seconds 3]
+                              [--chunks 5] [--output results.json]
+
+Every simulated user repeats recording sessions like recorder_uploader.js: it loads the page (session and CSRF
+token), posts an "audio_recording" chunk every --chunk-seconds seconds (queued with async=true, the result is
+long-polled at /jobs/<id>) and finally posts a "text_upload" to score the transcript once all chunks are transcribed.
+Every concurrency step runs for --duration seconds and reports the throughput, the latency percentiles and the error
+rate per endpoint. "transcription" is the time from the moment a chunk is due until its text is available.
+
+Every chunk is sent from its own thread on a fixed schedule, like the recorder does: a slow deployment does not delay
+the next chunks, so its latency is not hidden by sending less (coordinated omission).
+
+The chunks are generated speech-like webm files (--distinct different ones); run the deployment with the
+transcription cache disabled, or use enough distinct chunks, so repeated chunks are not served from the cache.
+"""
+
+import http.cookiejar
+import json
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import OrderedDict, defaultdict
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from src.main.synthetic import encode, synthesize_speech
+
+CSRF_TOKEN = re.compile(r'CSRF_TOKEN = "([^"]+)"')
+REFERENCE = "the quick brown fox jumps over the lazy dog"
+
+
+def encode_multipart(fields: dict, files: dict) -> tuple:
+    """ Encodes form fields and files ({name: (filename, bytes)}) as multipart/form-data.
+
+    Returns:
+        tuple: The body (bytes) and the content type (str).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'
+                     .format(boundary, name, value).encode())
+    for name, (filename, data) in files.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, filename).encode())
+        parts.append(data + b'\r\n')
+    parts.append('--{}--\r\n'.format(boundary).encode())
+    return b''.join(parts), 'multipart/form-data; boundary=' + boundary
+
+
+class Statistics:
+    """ Collects the duration and outcome of every request, per endpoint. """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint: str, seconds: float, ok: bool):
+        with self.lock:
+            self.samples[endpoint].append((seconds, ok))
+
+    def report(self, elapsed: float) -> OrderedDict:
+        """ Throughput, error rate and latency percentiles (ms) per endpoint. """
+        report = OrderedDict()
+        with self.lock:
+            samples = dict(self.samples)
+        for endpoint, values in sorted(samples.items()):
+            durations = np.array([seconds for seconds, _ in values]) * 1000
+            errors = sum(1 for _, ok in values if not ok)
+            report[endpoint] = OrderedDict([
+                ('requests', len(values)), ('per_second', round(len(values) / elapsed, 2)),
+                ('error_rate', round(errors / len(values), 4)),
+                ('p50', round(float(np.percentile(durations, 50)), 1)),
+                ('p95', round(float(np.percentile(durations, 95)), 1)),
+                ('p99', round(float(np.percentile(durations, 99)), 1)),
+            ])
+        return report
+
+
+class SimulatedUser:
+    """ One recorder page that records and uploads chunks until the deadline.
+
+    Arguments:
+        base_url (str): URL of the deployment.
+        chunks (list): Encoded audio chunks to choose from.
+        options (dict): Command options (chunk_seconds, chunks, timeout).
+        statistics (Statistics): Where the requests are recorded.
+        number (int): Number of the user, used to pick different chunks per user.
+    """
+
+    def __init__(self, base_url: str, chunks: list, options: dict, statistics: Statistics, number: int):
+        self.base_url = base_url.rstrip('/')
+        self.chunks = chunks
+        self.options = options
+        self.statistics = statistics
+        self.number = number
+        self.sent = 0
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, endpoint: str, path: str, fields: dict = None, files: dict = None) -> tuple:
+        """ Sends a GET (or a POST if there are fields) and records it.
+
+        Returns:
+            tuple: The status code and the body (bytes), status 0 if the request failed.
+        """
+        data, headers = None, {}
+        if fields is not None:
+            data, headers["Content-Type"] = encode_multipart(fields, files or {})
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.options['timeout']) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as ex:
+            status, body = ex.code, ex.read()
+        except OSError:
+            status, body = 0, b''
+
+        self.statistics.add(endpoint, time.perf_counter() - start, 200 <= status < 300)
+        return status, body
+
+    def transcribe(self, token: str, reset: bool, chunk: bytes, due: float) -> bool:
+        """ Uploads one chunk at the time it is due (time.time()) and waits for its transcription, returns True if it
+        succeeded. The transcription latency counts from the time it was due. """
+        time.sleep(max(0.0, due - time.time()))
+        status, body = self.request("index:audio_recording", "/", {
+            "async": "true", "reset": str(reset).lower(), "csrfmiddlewaretoken": token,
+        }, {"audio_recording": ("blob", chunk)})
+
+        if status == 202:
+            job = json.loads(body.decode())["job"]
+            while True:
+                status, body = self.request("jobs", "/jobs/{}?wait=10".format(job))
+                if status != 200 or json.loads(body.decode())["status"] in ("done", "failed"):
+                    break
+
+        ok = status == 200 and json.loads(body.decode()).get("status", "done") == "done"
+        self.statistics.add("transcription", time.time() - due, ok)
+        return ok
+
+    def run(self, deadline: float):
+        while time.time() < deadline:
+            status, body = self.request("index:get", "/")
+            match = CSRF_TOKEN.search(body.decode(errors='replace'))
+            if not match:
+                time.sleep(1)
+                continue
+
+            # The recorder sends a chunk every chunk_seconds, whether the previous one is done or not
+            start = time.time()
+            senders = []
+            for number in range(self.options['chunks']):
+                due = start + (number + 1) * self.options['chunk_seconds']
+                if due > deadline:
+                    break
+                chunk = self.chunks[(self.number + self.sent) % len(self.chunks)]
+                self.sent += 1
+                senders.append(threading.Thread(target=self.transcribe, args=(match.group(1), number == 0, chunk, due),
+                                                daemon=True))
+                senders[-1].start()
+
+            for sender in senders:
+                sender.join()
+            if len(senders) < self.options['chunks']:
+                return
+            self.request("index:text_upload", "/", {"text_upload": REFERENCE, "csrfmiddlewaretoken": match.group(1)})
+
+
+def run_step(base_url: str, users: int, chunks: list, options: dict) -> OrderedDict:
+    """ Runs users simulated users for options['duration'] seconds and reports the statistics. """
+    statistics = Statistics()
+    deadline = time.time() + options['duration']
+    threads = [threading.Thread(target=SimulatedUser(base_url, chunks, options, statistics, number).run,
+                                args=(deadline,), daemon=True) for number in range(users)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+        time.sleep(options['chunk_seconds'] / max(users, 1))  # spread the users over one chunk interval
+    for thread in threads:
+        thread.join()
+
+    return statistics.report(time.time() - start)
+
+
+class Command(BaseCommand):
+    help = "Load tests a deployment with simulated recorder users and reports latency percentiles per endpoint."
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help="Base URL of the deployment, e.g. http://127.0.0.1:8000")
+        parser.add_argument('--users', type=int, nargs='+', default=[1, 5, 10, 20],
+                            help="Numbers of concurrent users, one step per number.")
+        parser.add_argument('--duration', type=float, default=60, help="Seconds per step.")
+        parser.add_argument('--chunk-seconds', type=float, default=3, help="Seconds of audio per chunk.")
+        parser.add_argument('--chunks', type=int, default=5, help="Chunks per recording session.")
+        parser.add_argument('--distinct', type=int, default=20, help="Number of different chunks.")
+        parser.add_argument('--timeout', type=float, default=60, help="Timeout of one request in seconds.")
+        parser.add_argument('--output', '-o', help="Write the results to this JSON file.")
+
+    def handle(self, *args, **options):
+        try:
+            chunks = [encode(synthesize_speech(options['chunk_seconds'], seed=seed), 16000, 'webm')
+                      for seed in range(options['distinct'])]
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        results = OrderedDict()
+        for users in options['users']:
+            self.stderr.write("Running {} users for {} seconds...".format(users, options['duration']))
+            report = run_step(options['url'], users, chunks, options)
+            results[str(users)] = report
+
+            self.stdout.write("\n{} users".format(users))
+            self.stdout.write("{:<24} {:>8} {:>8} {:>8} {:>9} {:>9} {:>9}".format(
+                "endpoint", "requests", "req/s", "errors", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+            for endpoint, row in report.items():
+                self.stdout.write("{:<24} {:>8} {:>8} {:>8.1%} {:>9} {:>9} {:>9}".format(
+                    endpoint, row['requests'], row['per_second'], row['error_rate'], row['p50'], row['p95'],
+                    row['p99']))
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
@@ -0,0 +1,215 @@
+""" Contains the media store, the lifecycle of the audio files in MEDIA_ROOT. Short clips (and every recorded chunk)
+are processed entirely in memory and never written to disk; only uploads larger than MEDIA['SPOOL_MAX_BYTES'] are
+kept, if MEDIA['PERSIST'] is set in settings.py.
+
+Kept files are content addressed: the name of a file is the SHA-256 hash of its bytes, so an upload that is already
+stored is not written again (its TTL is refreshed instead). A background collector removes the files that are older
+than MEDIA['TTL'] and then the oldest ones until the directory is smaller than MEDIA['MAX_BYTES'].
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterable
+from django.core.files import File
+import src.recorder.settings as cfg
+
+# Extensions that are kept in the names of stored files, anything else is stored without one
+EXTENSION = re.compile(r'^\.[a-z0-9]{1,5}$')
+
+
+class MediaStore:
+    """ Content addressed file store with TTL and size based garbage collection.
+
+    Arguments:
+        directory (str): Root directory of the store.
+        ttl (float): Seconds a file is kept after it was last stored.
+        max_bytes (int): Maximum size of all files together, the oldest files are removed first.
+    """
+
+    def __init__(self, directory: str, ttl: float, max_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.usage = {"files": 0, "bytes": 0}
+
+    def path(self, name: str) -> str:
+        """ Returns the path of a stored file. """
+        return os.path.join(self.directory, name)
+
+    def save(self, data: bytes, filename: str = "") -> str:
+        """ Stores the data unless a file with the same content is stored already.
+
+        Arguments:
+            data (bytes): The file.
+            filename (str): Original name of the file, only its extension is kept.
+
+        Returns:
+            The name of the stored file (str), relative to the directory of the store.
+        """
+        return self._store([data], filename)
+
+    def save_file(self, file: File, filename: str = "") -> str:
+        """ Stores a file like save(), it is copied in chunks (file.chunks()) and hashed on the way, so it is never
+        read into memory as a whole. """
+        return self._store(file.chunks(), filename)
+
+    def _store(self, chunks: Iterable[bytes], filename: str) -> str:
+        """ Writes the chunks to a temporary file, so other workers never read a partial file, and moves it to its
+        content addressed name unless a file with the same content is stored already. """
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(handle, 'wb') as media_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    media_file.write(chunk)
+                    size += len(chunk)
+
+            extension = os.path.splitext(filename)[1].lower()
+            digest = digest.hexdigest()
+            name = os.path.join(digest[:2], digest + (extension if EXTENSION.match(extension) else ""))
+            path = self.path(name)
+            try:
+                # Refresh the TTL of a duplicate
+                os.utime(path)
+                duplicate = True
+            except FileNotFoundError:
+                duplicate = False
+            if duplicate:
+                os.remove(temporary)
+                with self.lock:
+                    self.counters["deduplicated"] += 1
+                return name
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temporary, path)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+            raise
+
+        with self.lock:
+            self.counters["stored"] += 1
+            self.counters["stored_bytes"] += size
+        return name
+
+    def collect(self) -> dict:
+        """ Removes the expired files and then the oldest files until the store fits in max_bytes.
+
+        Returns:
+            dict: Number of removed files and freed bytes of this run.
+        """
+        result = collect_directory(self.directory, self.ttl, self.max_bytes)
+        with self.lock:
+            self.counters["collections"] += 1
+            self.counters["removed"] += result["removed"]
+            self.counters["freed_bytes"] += result["freed_bytes"]
+            self.usage = {"files": result["files"], "bytes": result["bytes"]}
+
+        if result["removed"]:
+            logging.info("Media collector removed %d files (%d bytes).", result["removed"], result["freed_bytes"])
+        return {"removed": result["removed"], "freed_bytes": result["freed_bytes"]}
+
+    def count_spooled(self):
+        """ Counts a clip that was processed in memory only. """
+        with self.lock:
+            self.counters["spooled"] += 1
+
+    def stats(self) -> dict:
+        """ Counters (stored, deduplicated and spooled clips, removed files) and the size of the store at the last
+        collection. """
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(self.usage)
+        return stats
+
+    def start_collector(self, interval: float) -> threading.Thread:
+        """ Runs collect() every interval seconds in a daemon thread. """
+        return start_collector(self.collect, interval, "media-collector")
+
+
+def _files(directory: str) -> list:
+    """ Returns (modification time, size, path) of every file below the directory. """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((info.st_mtime, info.st_size, path))
+    return files
+
+
+def collect_directory(directory: str, ttl: float, max_bytes: int) -> dict:
+    """ Removes the files below the directory that were modified more than ttl seconds ago and then the oldest files
+    until the directory fits in max_bytes. Temporary files (".tmp" prefix) are kept until they expire.
+
+    Returns:
+        dict: Number of removed files and freed bytes, and the number of files and bytes that are left.
+    """
+    files = sorted(_files(directory))
+    total = sum(size for _, size, _ in files)
+    expires = time.time() - ttl
+    removed, freed = 0, 0
+
+    for modified, size, path in files:
+        if modified >= expires and total - freed <= max_bytes:
+            break
+        if os.path.basename(path).startswith(".tmp") and modified >= expires:
+            # A file that is being written
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        except OSError as ex:
+            logging.warning("Could not remove %s: %s", path, ex)
+            continue
+        removed += 1
+        freed += size
+
+    return {"removed": removed, "freed_bytes": freed, "files": len(files) - removed, "bytes": total - freed}
+
+
+def start_collector(collect: Callable[[], dict], interval: float, name: str) -> threading.Thread:
+    """ Runs collect every interval seconds in a daemon thread with the given name. """
+    def run():
+        while True:
+            try:
+                collect()
+            except Exception as ex:
+                logging.error("Collection of %s failed: %s", name, ex)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_media_store() -> MediaStore:
+    """ Returns the media store of this process, configured by MEDIA_ROOT and MEDIA in settings.py. The collector is
+    started with it if MEDIA['COLLECT_INTERVAL'] is set. """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = MediaStore(cfg.MEDIA_ROOT, cfg.MEDIA['TTL'], cfg.MEDIA['MAX_BYTES'])
+            if cfg.MEDIA['COLLECT_INTERVAL']:
+                _store.start_collector(cfg.MEDIA['COLLECT_INTERVAL'])
+        return _store
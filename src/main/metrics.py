@@ -0,0 +1,226 @@
+""" Contains the metrics engine for speech recognition scoring. The truth and hypothesis are integer encoded and
+aligned once with a word level edit distance (with backtrace), all metrics are derived from that single alignment.
+
+The edit operations are computed in C by Levenshtein.editops() (python-Levenshtein, the library jiwer used), on
+strings with one code point per word id; the hits are the words that no operation touches.
+
+IncrementalScorer scores a hypothesis that grows chunk by chunk (live scoring of a recording) against a fixed truth:
+it keeps the last row of the edit distance matrix and adds one row per new hypothesis word, so every chunk costs
+O(n) per new word instead of aligning the whole transcript again.
+"""
+
+from typing import NamedTuple, Sequence, Tuple
+import Levenshtein
+import numpy as np
+
+HIT, SUBSTITUTION, DELETION, INSERTION = 0, 1, 2, 3
+# Word ids are encoded as code points, leaving out the surrogates
+SURROGATES, SURROGATE_COUNT = 0xD800, 0x800
+MAX_CODE_POINTS = 0x110000 - SURROGATE_COUNT
+
+
+class Alignment(NamedTuple):
+    """ Word level alignment of a hypothesis against the truth.
+
+    Attributes:
+        truth (np.ndarray): Integer encoded truth.
+        hypothesis (np.ndarray): Integer encoded hypothesis.
+        truth_hits (np.ndarray): Boolean mask of the truth words that were recognized correctly.
+        hypothesis_hits (np.ndarray): Boolean mask of the hypothesis words that are correct.
+        hits, substitutions, deletions, insertions (int): Number of alignment operations of each kind.
+    """
+    truth: np.ndarray
+    hypothesis: np.ndarray
+    truth_hits: np.ndarray
+    hypothesis_hits: np.ndarray
+    hits: int
+    substitutions: int
+    deletions: int
+    insertions: int
+
+
+def encode(truth: Sequence, hypothesis: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """ Maps the words of both sequences to integer ids (integer arrays are returned as they are). """
+    if isinstance(truth, np.ndarray) and isinstance(hypothesis, np.ndarray):
+        return truth, hypothesis
+
+    vocabulary = {}
+    truth_ids = np.fromiter((vocabulary.setdefault(word, len(vocabulary)) for word in truth),
+                            dtype=np.int64, count=len(truth))
+    hypothesis_ids = np.fromiter((vocabulary.setdefault(word, len(vocabulary)) for word in hypothesis),
+                                 dtype=np.int64, count=len(hypothesis))
+    return truth_ids, hypothesis_ids
+
+
+def _as_text(ids: np.ndarray) -> str:
+    """ Encodes word ids as a string with one code point per word, the sequence type of Levenshtein.editops(). """
+    if len(ids) and ids.max() >= MAX_CODE_POINTS:
+        # Ids of a huge shared vocabulary, number the word types that occur only
+        ids = np.unique(ids, return_inverse=True)[1]
+    # Skip the surrogates, they are not valid code points on their own
+    codes = ids + (ids >= SURROGATES) * SURROGATE_COUNT
+    return codes.astype('<u4').tobytes().decode('utf-32-le')
+
+
+def align(truth: Sequence, hypothesis: Sequence) -> Alignment:
+    """ Aligns the hypothesis against the truth with the minimal number of word edits.
+
+    Arguments:
+        truth (Sequence): Words (or integer ids) of the truth.
+        hypothesis (Sequence): Words (or integer ids) of the hypothesis.
+
+    Returns:
+        The alignment (Alignment).
+    """
+    truth, hypothesis = encode(truth, hypothesis)
+    n, m = len(truth), len(hypothesis)
+    truth_hits = np.ones(n, dtype=bool)
+    hypothesis_hits = np.ones(m, dtype=bool)
+
+    # Both sequences are encoded with the same mapping, so equal words stay equal code points
+    combined = _as_text(np.concatenate([truth, hypothesis]).astype(np.int64))
+    counts = {'replace': 0, 'delete': 0, 'insert': 0}
+    for operation, i, j in Levenshtein.editops(combined[:n], combined[n:]):
+        counts[operation] += 1
+        if operation != 'insert':
+            truth_hits[i] = False
+        if operation != 'delete':
+            hypothesis_hits[j] = False
+
+    return Alignment(truth, hypothesis, truth_hits, hypothesis_hits, n - counts['replace'] - counts['delete'],
+                     counts['replace'], counts['delete'], counts['insert'])
+
+
+def _ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator else 0.0
+
+
+def _macro(ids: np.ndarray, hits: np.ndarray) -> float:
+    """ Average over the word types of the fraction of their occurrences that are hits. """
+    if not len(ids):
+        return 0.0
+    if ids.max() > 4 * len(ids):
+        # Ids of a large shared vocabulary, count the word types that occur only
+        ids = np.unique(ids, return_inverse=True)[1]
+    occurrences = np.bincount(ids)
+    correct = np.bincount(ids[hits], minlength=len(occurrences))
+    present = occurrences > 0
+    return float(np.mean(correct[present] / occurrences[present]))
+
+
+def _f1(precision: float, recall: float) -> float:
+    return _ratio(2 * precision * recall, precision + recall)
+
+
+def score(alignment: Alignment) -> dict:
+    """ Derives all metrics from an alignment.
+
+    Returns:
+        Unrounded metrics (dict): wer, wcr, precision/recall/f1 (micro and macro) and the operation counts.
+    """
+    n, m = len(alignment.truth), len(alignment.hypothesis)
+    errors = alignment.substitutions + alignment.deletions + alignment.insertions
+    metrics = {
+        "wer": _ratio(errors, n),
+        "wcr": _ratio(alignment.hits, n),
+        "precision_micro": _ratio(alignment.hits, m),
+        "recall_micro": _ratio(alignment.hits, n),
+        "precision_macro": _macro(alignment.hypothesis, alignment.hypothesis_hits),
+        "recall_macro": _macro(alignment.truth, alignment.truth_hits),
+        "hits": alignment.hits,
+        "substitutions": alignment.substitutions,
+        "deletions": alignment.deletions,
+        "insertions": alignment.insertions,
+    }
+    metrics["f1_micro"] = _f1(metrics["precision_micro"], metrics["recall_micro"])
+    metrics["f1_macro"] = _f1(metrics["precision_macro"], metrics["recall_macro"])
+    return metrics
+
+
+class IncrementalScorer:
+    """ Aligns a growing hypothesis against a fixed truth, one row of the edit distance matrix per hypothesis word.
+    The cells hold distance * (n + 1) - hits, so among the alignments with the minimal distance the one with the
+    most hits is chosen (align() may pick another one with the same distance when there are several). The chosen
+    operations of every row are kept (n + 1 bytes per hypothesis word) for the backtrace in alignment().
+
+    Arguments:
+        truth (Sequence): Words (or word ids, then extend() takes word ids of the same vocabulary) of the truth.
+    """
+
+    def __init__(self, truth: Sequence):
+        self.vocabulary = {}
+        self.truth = self._encode(truth)
+        self.hypothesis = []
+        self.scale = len(self.truth) + 1
+        self.steps = np.arange(len(self.truth) + 1, dtype=np.int64) * self.scale
+        # Row 0: the first i truth words are deleted
+        self.keys = self.steps.copy()
+        self.operations = [np.full(len(self.truth) + 1, DELETION, dtype=np.uint8)]
+        self._alignment = None
+
+    def _encode(self, words: Sequence) -> np.ndarray:
+        """ Maps the words to ids, word ids (see normalization.py) are used as they are. """
+        if isinstance(words, np.ndarray):
+            return words
+        return np.fromiter((self.vocabulary.setdefault(word, len(self.vocabulary)) for word in words),
+                           dtype=np.int64, count=len(words))
+
+    @property
+    def cells(self) -> int:
+        """ Number of kept operations (bytes). """
+        return len(self.operations) * len(self.keys)
+
+    def extend(self, words: Sequence):
+        """ Appends words to the hypothesis. """
+        for word in self._encode(words):
+            matches = self.truth == word
+            # Hits keep the distance and add a hit, substitutions and insertions add an edit
+            diagonal = self.keys[:-1] + np.where(matches, -1, self.scale)
+            up = self.keys[1:] + self.scale
+            candidate = np.empty_like(self.keys)
+            candidate[0] = self.keys[0] + self.scale
+            np.minimum(diagonal, up, out=candidate[1:])
+
+            # Deletions come from the left within the same row: current[i] = min(candidate[i], current[i - 1] + 1)
+            current = np.minimum.accumulate(candidate - self.steps) + self.steps
+
+            row = np.empty(len(self.keys), dtype=np.uint8)
+            row[0] = INSERTION
+            row[1:] = np.where(diagonal <= up, np.where(matches, HIT, SUBSTITUTION), INSERTION)
+            row[current < candidate] = DELETION
+            self.operations.append(row)
+            self.keys = current
+            self.hypothesis.append(word)
+        self._alignment = None
+
+    def alignment(self) -> Alignment:
+        """ Returns the alignment of the current hypothesis, the backtrace costs O(n + m). """
+        if self._alignment is not None:
+            return self._alignment
+
+        n, m = len(self.truth), len(self.hypothesis)
+        distance = -(-int(self.keys[n]) // self.scale)
+        hits = distance * self.scale - int(self.keys[n])
+        truth_hits = np.zeros(n, dtype=bool)
+        hypothesis_hits = np.zeros(m, dtype=bool)
+        i, j = n, m
+        while i > 0 or j > 0:
+            operation = self.operations[j][i]
+            if operation == HIT:
+                truth_hits[i - 1] = hypothesis_hits[j - 1] = True
+            if operation != INSERTION:
+                i -= 1
+            if operation != DELETION:
+                j -= 1
+
+        # Every truth word is a hit, a substitution or a deletion, every hypothesis word a hit, a substitution or
+        # an insertion
+        deletions = distance - (m - hits)
+        insertions = distance - (n - hits)
+        self._alignment = Alignment(self.truth, np.array(self.hypothesis, dtype=np.int64), truth_hits,
+                                    hypothesis_hits, hits, n - hits - deletions, deletions, insertions)
+        return self._alignment
+
+    def score(self) -> dict:
+        """ Metrics of the current hypothesis, see score(). """
+        return score(self.alignment())
@@ -0,0 +1,19 @@
+""" Contains the database models of the main app. """
+
+from django.db import models
+
+
+class TranscriptSegment(models.Model):
+    """ One recognized piece of a session's transcript. Segments are only ever appended, they are written to the
+    database in batches by the TranscriptStore (see transcripts.py). """
+    session_key = models.CharField(max_length=40, db_index=True)
+    index = models.PositiveIntegerField()
+    text = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['session_key', 'index']
+        unique_together = [['session_key', 'index']]
+
+    def __str__(self):
+        return "{} #{}".format(self.session_key, self.index)
@@ -0,0 +1,121 @@
+""" Contains the text normalization of transcripts for scoring. A transcript is lower cased, the ASCII punctuation is
+removed and it is split at whitespace: the steps of the jiwer pipeline that was used before, done in one pass over the
+string with a translation table that is built once (str.translate), instead of a chain of transformations.
+
+Words are mapped to integer ids of a vocabulary that is shared by the process, so the metrics engine (metrics.py)
+aligns the id arrays directly. Ids are only comparable when they come from the same Normalizer: get_normalizer()
+starts a new one (with a new vocabulary) when the vocabulary has more than NORMALIZATION['MAX_WORDS'] words, users
+that keep ids (e.g. the live scores in scoring.py) keep their Normalizer. Reference texts, which are scored again and
+again, are memoized.
+"""
+
+import string
+import threading
+from collections import OrderedDict
+from typing import Iterable, List
+import numpy as np
+from src.main.instrumentation import timed
+import src.recorder.settings as cfg
+
+# Separates the texts of a batch, inside a text it separates words like whitespace
+SEPARATOR = "\0"
+PUNCTUATION = str.maketrans("", "", string.punctuation)
+WORDS = str.maketrans(dict(dict.fromkeys(string.punctuation), **{SEPARATOR: " "}))
+
+
+def split_words(text: str) -> List[str]:
+    """ Normalizes a text (lower case, no punctuation) and splits it into words. """
+    return text.lower().translate(WORDS).split()
+
+
+class Vocabulary:
+    """ Maps words to integer ids, new words get the next id. """
+
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def encode(self, words: List[str]) -> np.ndarray:
+        """ Returns the ids (np.ndarray of int64) of the words, unknown words are added. """
+        ids = self.ids
+        try:
+            return np.fromiter((ids[word] for word in words), dtype=np.int64, count=len(words))
+        except KeyError:
+            with self.lock:
+                return np.fromiter((ids.setdefault(word, len(ids)) for word in words), dtype=np.int64,
+                                   count=len(words))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Normalizer:
+    """ Normalizes texts to word ids of one vocabulary.
+
+    Arguments:
+        memo_size (int): Number of memoized texts (see ids()), the least recently used one is dropped.
+    """
+
+    def __init__(self, memo_size: int):
+        self.vocabulary = Vocabulary()
+        self.memo_size = memo_size
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+
+    @timed("normalize")
+    def ids(self, text: str, memoize: bool = False) -> np.ndarray:
+        """ Normalizes a text to word ids.
+
+        Arguments:
+            text (str): The text.
+            memoize (bool): Keep the result for the next call with the same text (for reference texts).
+
+        Returns:
+            The word ids (np.ndarray of int64), memoized arrays are read-only.
+        """
+        if not memoize:
+            return self.vocabulary.encode(split_words(text))
+
+        with self.lock:
+            ids = self.memo.get(text)
+            if ids is not None:
+                self.memo.move_to_end(text)
+                return ids
+
+        ids = self.vocabulary.encode(split_words(text))
+        ids.setflags(write=False)
+        with self.lock:
+            self.memo[text] = ids
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return ids
+
+    @timed("normalize")
+    def batch(self, texts: Iterable[str]) -> List[np.ndarray]:
+        """ Normalizes many texts (e.g. the references of a corpus) at once: the texts are lower cased and stripped of
+        punctuation in one pass, all words are encoded in one array and repeated texts are normalized once.
+
+        Returns:
+            list: The word ids (np.ndarray of int64) of every text.
+        """
+        texts = list(texts)
+        unique = list(OrderedDict.fromkeys(texts))
+        joined = SEPARATOR.join(text.replace(SEPARATOR, " ") for text in unique)
+        words = [text.split() for text in joined.lower().translate(PUNCTUATION).split(SEPARATOR)]
+        ids = self.vocabulary.encode([word for text in words for word in text])
+        parts = dict(zip(unique, np.split(ids, np.cumsum([len(text) for text in words])[:-1])))
+        return [parts[text] for text in texts]
+
+
+_normalizer = None
+_normalizer_lock = threading.Lock()
+
+
+def get_normalizer() -> Normalizer:
+    """ Returns the normalizer of this process, configured by NORMALIZATION in settings.py. A new one is started when
+    the vocabulary has more than NORMALIZATION['MAX_WORDS'] words. """
+    global _normalizer
+    with _normalizer_lock:
+        if _normalizer is None or len(_normalizer.vocabulary) > cfg.NORMALIZATION['MAX_WORDS']:
+            _normalizer = Normalizer(cfg.NORMALIZATION['MEMO_SIZE'])
+        return _normalizer
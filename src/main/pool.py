@@ -0,0 +1,330 @@
+""" Contains the pool of clients of a recognition backend. get_recognizer() (see recognizers.py) returns a pool, which
+is a Recognizer itself and is configured by the POOL of the backend in ASR_BACKENDS (defaults: RECOGNIZER_POOL in
+settings.py):
+
+- CLIENTS instances of the backend are created once per process (each with its own connection) and used in turn.
+- At most MAX_CONCURRENCY requests to the backend run at the same time in this process, other requests wait for a
+  slot in FIFO order. Async requests wait without occupying a thread.
+- Requests that failed for a transient reason (TransientRecognitionError: connection errors, timeouts, overloaded
+  services; or an OSError) are retried up to RETRIES times after an exponential backoff with full jitter (up to
+  BACKOFF seconds, doubled for every retry), but only if the retry can still finish within DEADLINE seconds after the
+  request started, judging by the median latency of the backend. Other errors (a rejected request, an invalid
+  answer) would fail again, they are raised right away.
+- With HEDGE set, a request that is slower than the HEDGE_PERCENTILE of the recent latencies gets a second attempt on
+  the next client if a slot is free. The first result is used, the other attempt is abandoned (cancelled if it is
+  async). Only enable it for backends where sending a request twice is harmless.
+"""
+
+import asyncio
+import itertools
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Union
+import numpy as np
+from src.main.audio import DecodedAudio
+from src.main.recognizers import RecognitionError, Recognizer, TransientRecognitionError
+
+# Errors of an attempt that are worth a retry (backends raise timeouts and connection errors as transient errors or
+# OSErrors)
+RETRYABLE = (TransientRecognitionError, OSError)
+# Latencies that are needed before they are used for hedging and for the deadline of retries
+MIN_SAMPLES = 20
+
+
+class ConcurrencyLimit:
+    """ Semaphore that can be acquired by threads and by coroutines, the waiters are served in FIFO order. A released
+    slot is handed to the first waiter directly.
+
+    Arguments:
+        slots (int): Number of holders at the same time.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active = 0
+        self.waiters = deque()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """ Takes a slot if one is free right now. """
+        with self.lock:
+            if self.active < self.slots and not self.waiters:
+                self.active += 1
+                return True
+            return False
+
+    def _abandon(self, grant: Callable) -> bool:
+        """ Removes a waiter that stopped waiting. Returns False if it got a slot in the meantime. """
+        with self.lock:
+            try:
+                self.waiters.remove(grant)
+                return True
+            except ValueError:
+                return False
+
+    def acquire(self, timeout: float = None) -> bool:
+        """ Waits for a slot, at most timeout seconds. Returns whether a slot was taken. """
+        with self.lock:
+            if self.active < self.slots and not self.waiters:
+                self.active += 1
+                return True
+            granted = threading.Event()
+            grant = granted.set
+            self.waiters.append(grant)
+
+        return granted.wait(timeout) or not self._abandon(grant)
+
+    async def acquire_async(self, timeout: float = None) -> bool:
+        """ Waits for a slot like acquire(), without blocking the event loop. """
+        loop = asyncio.get_event_loop()
+        with self.lock:
+            if self.active < self.slots and not self.waiters:
+                self.active += 1
+                return True
+            granted = loop.create_future()
+
+            def grant():
+                loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+            self.waiters.append(grant)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if not self._abandon(grant):
+                # The slot was handed over while the waiter gave up
+                self.release()
+            if isinstance(ex, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self):
+        """ Hands the slot to the first waiter or frees it. """
+        with self.lock:
+            while self.waiters:
+                grant = self.waiters.popleft()
+                try:
+                    grant()
+                    return
+                except RuntimeError:
+                    # The event loop of the waiter is closed
+                    continue
+            self.active -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"active": self.active, "waiting": len(self.waiters), "slots": self.slots}
+
+
+class LatencyWindow:
+    """ The most recent latencies of successful attempts.
+
+    Arguments:
+        size (int): Number of latencies that are kept.
+    """
+
+    def __init__(self, size: int):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Union[float, None]:
+        """ Returns the q-th percentile in seconds, None if there are fewer than MIN_SAMPLES latencies. """
+        with self.lock:
+            samples = list(self.samples)
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, q))
+
+
+class RecognizerPool(Recognizer):
+    """ Long-lived clients of one backend with a concurrency limit, retries and hedged requests (see above).
+
+    Arguments:
+        factory (Callable): Creates a client of the backend.
+        clients (int): Number of clients.
+        max_concurrency (int): Maximum number of requests to the backend at the same time.
+        deadline (float): Seconds after which a request is not retried anymore.
+        retries (int): Maximum number of retries of a request.
+        backoff (float): Maximum backoff before the first retry in seconds, doubled for every retry.
+        hedge (bool): Send a second attempt when the first one is slow.
+        hedge_percentile (float): Percentile of the recent latencies after which the second attempt is sent.
+        window (int): Number of recent latencies that are kept.
+    """
+
+    def __init__(self, factory: Callable[[], Recognizer], clients: int = 1, max_concurrency: int = 16,
+                 deadline: float = 60.0, retries: int = 2, backoff: float = 0.2, hedge: bool = False,
+                 hedge_percentile: float = 95.0, window: int = 200):
+        self.clients = [factory() for _ in range(max(clients, 1))]
+        self.ENCODINGS = self.clients[0].ENCODINGS
+        self.turn = itertools.count()
+        self.limit = ConcurrencyLimit(max_concurrency)
+        self.latencies = LatencyWindow(window)
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.executor = ThreadPoolExecutor(max_workers=2 * max_concurrency, thread_name_prefix="hedge") \
+            if hedge else None
+        self.random = random.Random()
+        self.counters = Counter()
+        self.counters_lock = threading.Lock()
+
+    def _client(self) -> Recognizer:
+        return self.clients[next(self.turn) % len(self.clients)]
+
+    def _count(self, counter: str):
+        with self.counters_lock:
+            self.counters[counter] += 1
+
+    def _retry_delay(self, retry: int, deadline: float) -> Union[float, None]:
+        """ Returns the backoff before a retry, None if the retry would not finish before the deadline. """
+        if retry > self.retries:
+            return None
+        delay = self.random.uniform(0, self.backoff * 2 ** (retry - 1))
+        if time.monotonic() + delay + (self.latencies.percentile(50) or 0.0) >= deadline:
+            return None
+        return delay
+
+    def _hedge_delay(self) -> Union[float, None]:
+        return self.latencies.percentile(self.hedge_percentile) if self.hedge else None
+
+    def _winner(self, done: set, pending: set, hedge):
+        """ Returns the finished attempt whose result is used: the first successful one, or a failed one when no
+        attempt is pending anymore. None if the pending attempts have to be waited for. """
+        for attempt in done:
+            if attempt.exception() is None:
+                if attempt is hedge:
+                    self._count("hedge_wins")
+                return attempt
+        return next(iter(done)) if not pending else None
+
+    def _attempt(self, audio: DecodedAudio, language_code: str, session_id: str, deadline: float,
+                 acquired: bool = False) -> str:
+        """ Sends one request to the next client, in a slot. """
+        if not acquired and not self.limit.acquire(max(0.0, deadline - time.monotonic())):
+            raise TransientRecognitionError("No recognizer was available before the deadline.")
+        start = time.monotonic()
+        try:
+            text = self._client().recognize(audio, language_code, session_id)
+        finally:
+            self.limit.release()
+        self.latencies.add(time.monotonic() - start)
+        return text
+
+    def _hedged(self, audio: DecodedAudio, language_code: str, session_id: str, deadline: float) -> str:
+        """ Runs an attempt and a second one if the first is slower than the hedge delay. """
+        delay = self._hedge_delay()
+        if delay is None:
+            return self._attempt(audio, language_code, session_id, deadline)
+
+        first = self.executor.submit(self._attempt, audio, language_code, session_id, deadline)
+        if wait([first], timeout=delay).done or not self.limit.try_acquire():
+            return first.result()
+
+        self._count("hedges")
+        second = self.executor.submit(self._attempt, audio, language_code, session_id, deadline, True)
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            attempt = self._winner(done, pending, second)
+            if attempt is not None:
+                return attempt.result()
+
+    def recognize(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        deadline = time.monotonic() + self.deadline
+        retry = 0
+        while True:
+            try:
+                return self._hedged(audio, language_code, session_id, deadline)
+            except RETRYABLE:
+                retry += 1
+                delay = self._retry_delay(retry, deadline)
+                if delay is None:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                time.sleep(delay)
+            except RecognitionError:
+                self._count("failures")
+                raise
+
+    async def _attempt_async(self, audio: DecodedAudio, language_code: str, session_id: str, deadline: float,
+                             acquired: bool = False) -> str:
+        if not acquired and not await self.limit.acquire_async(max(0.0, deadline - time.monotonic())):
+            raise TransientRecognitionError("No recognizer was available before the deadline.")
+        start = time.monotonic()
+        try:
+            text = await asyncio.wait_for(self._client().recognize_async(audio, language_code, session_id),
+                                          max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise TransientRecognitionError("The recognizer did not answer before the deadline.")
+        finally:
+            self.limit.release()
+        self.latencies.add(time.monotonic() - start)
+        return text
+
+    async def _hedged_async(self, audio: DecodedAudio, language_code: str, session_id: str, deadline: float) -> str:
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self._attempt_async(audio, language_code, session_id, deadline)
+
+        first = asyncio.ensure_future(self._attempt_async(audio, language_code, session_id, deadline))
+        attempts = [first]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if done or not self.limit.try_acquire():
+                return await first
+
+            self._count("hedges")
+            second = asyncio.ensure_future(self._attempt_async(audio, language_code, session_id, deadline, True))
+            attempts.append(second)
+            pending = set(attempts)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                attempt = self._winner(done, pending, second)
+                if attempt is not None:
+                    return attempt.result()
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def recognize_async(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        deadline = time.monotonic() + self.deadline
+        retry = 0
+        while True:
+            try:
+                return await self._hedged_async(audio, language_code, session_id, deadline)
+            except RETRYABLE:
+                retry += 1
+                delay = self._retry_delay(retry, deadline)
+                if delay is None:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                await asyncio.sleep(delay)
+            except RecognitionError:
+                self._count("failures")
+                raise
+
+    def streaming_recognize(self, frames, sample_rate: int, language_code: str = "en", session_id: str = "me"):
+        # Streams last as long as the recording, they are neither limited nor retried
+        return self._client().streaming_recognize(frames, sample_rate, language_code, session_id)
+
+    def stats(self) -> dict:
+        """ Slots in use, waiting requests, retries, hedges and the recent latency percentiles (ms). """
+        with self.counters_lock:
+            stats = dict(self.counters)
+        stats.update(self.limit.stats())
+        for q in (50, 95, 99):
+            latency = self.latencies.percentile(q)
+            if latency is not None:
+                stats["p{}_ms".format(q)] = round(latency * 1000, 1)
+        return stats
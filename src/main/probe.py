@@ -0,0 +1,362 @@
+""" Contains a fast metadata probe for audio files. The sample rate, channel count and duration are read from the
+container header of WAV, FLAC, MP3, WebM/Matroska and Ogg Opus files without decoding any audio (MP3 files are
+recognized by an ID3 tag or their name, their first frame is only trusted if the next frames follow it). Only when
+the header is missing or can not be trusted the file is decoded as a stream (in fixed size chunks, so memory use stays
+bounded) to count the samples. Results are memoized per file (path, size and modification time).
+"""
+
+import logging
+import os
+import struct
+import subprocess
+from functools import lru_cache
+from typing import NamedTuple, Union
+import src.recorder.settings as cfg
+
+# Number of bytes read from the start of a file to find its header
+HEADER_BYTES = 1 << 18
+# Chunk size used when the duration has to be determined by decoding
+DECODE_CHUNK_BYTES = 1 << 16
+
+
+class AudioInfo(NamedTuple):
+    """ Metadata of an audio file.
+
+    Attributes:
+        codec (str): Container/codec name (wav, flac, mp3, opus, the WebM codec id or the file extension).
+        sample_rate (int): Sample rate in Hz.
+        channels (int): Number of channels.
+        duration (float): Duration in seconds.
+        from_header (bool): True if the values were read from the header, False if the audio had to be decoded.
+    """
+    codec: str
+    sample_rate: int
+    channels: int
+    duration: float
+    from_header: bool = True
+
+
+def _probe_wav(header: bytes, file_size: int) -> Union[AudioInfo, None]:
+    """ Reads the fmt and data chunks of a RIFF/WAVE file. """
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', header, offset)
+        offset += 8
+        if chunk_id == b'fmt ' and offset + 16 <= len(header):
+            fmt = struct.unpack_from('<HHIIHH', header, offset)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            _, channels, sample_rate, byte_rate, _, _ = fmt
+            # Streamed WAV files often have an empty or maximal data size, trust the file size instead
+            available = file_size - offset
+            if chunk_size in (0, 0xFFFFFFFF) or chunk_size > available:
+                chunk_size = available
+            if not byte_rate or not sample_rate:
+                return None
+            return AudioInfo('wav', sample_rate, channels, chunk_size / float(byte_rate))
+        offset += chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def _probe_flac(header: bytes) -> Union[AudioInfo, None]:
+    """ Reads the STREAMINFO metadata block of a FLAC file. """
+    if len(header) < 8 + 34 or header[4] & 0x7F != 0:
+        return None
+
+    # Bytes 10-17 of STREAMINFO: sample rate (20 bits), channels-1 (3), bits per sample-1 (5), total samples (36)
+    packed = int.from_bytes(header[8 + 10:8 + 18], 'big')
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+
+    return AudioInfo('flac', sample_rate, channels, total_samples / float(sample_rate))
+
+
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_BITRATES[(2, 3)] = _MP3_BITRATES[(2, 2)]
+_MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+# Files that are probed as MP3 although they do not start with an ID3 tag
+MP3_EXTENSIONS = ('.mp3', '.mp2', '.mpga')
+MP3_CONTENT_TYPES = ('audio/mpeg', 'audio/mp3', 'audio/mpeg3')
+# Frames in a row that have to be found at the offsets their lengths predict, unless the file has a tag or a VBR header
+MP3_SYNC_FRAMES = 3
+
+
+class _MpegFrame(NamedTuple):
+    """ An MPEG audio frame header, length is the length of the frame in bytes. """
+    version: float
+    layer: int
+    sample_rate: int
+    bitrate: int
+    channels: int
+    length: int
+
+
+def _mpeg_frame(header: bytes, offset: int) -> Union[_MpegFrame, None]:
+    """ Parses the MPEG audio frame header at offset, None if there is none. """
+    if offset + 4 > len(header) or header[offset] != 0xFF or header[offset + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2, b3 = header[offset + 1], header[offset + 2], header[offset + 3]
+    version = {0: 2.5, 2: 2, 3: 1}.get((b1 >> 3) & 0x3)
+    layer = {1: 3, 2: 2, 3: 1}.get((b1 >> 1) & 0x3)
+    bitrate_index, rate_index, padding = b2 >> 4, (b2 >> 2) & 0x3, (b2 >> 1) & 0x1
+    if not version or not layer or not 0 < bitrate_index < 15 or rate_index == 3:
+        return None
+
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        length = (72 if layer == 3 and version != 1 else 144) * bitrate // sample_rate + padding
+    return _MpegFrame(version, layer, sample_rate, bitrate, 1 if b3 >> 6 == 3 else 2, length)
+
+
+def _in_sync(header: bytes, offset: int, frame: _MpegFrame) -> bool:
+    """ True if the frames that follow the one at offset start where the length of the previous frame predicts. """
+    for _ in range(MP3_SYNC_FRAMES - 1):
+        offset += frame.length
+        following = _mpeg_frame(header, offset)
+        if following is None or following[:3] != frame[:3]:
+            return False
+        frame = following
+    return True
+
+
+def _vbr_frames(header: bytes, offset: int, frame: _MpegFrame) -> Union[int, None]:
+    """ Returns the number of frames in the Xing/Info (after the side info) or VBRI header of variable bitrate files,
+    None if the frame at offset has none. """
+    side_info = (17 if frame.channels == 1 else 32) if frame.version == 1 else (9 if frame.channels == 1 else 17)
+    xing = offset + 4 + side_info
+    if header[xing:xing + 4] in (b'Xing', b'Info') and len(header) >= xing + 12:
+        if struct.unpack_from('>I', header, xing + 4)[0] & 0x1:
+            return struct.unpack_from('>I', header, xing + 8)[0] or None
+    elif header[offset + 36:offset + 40] == b'VBRI' and len(header) >= offset + 54:
+        return struct.unpack_from('>I', header, offset + 50)[0] or None
+    return None
+
+
+def _probe_mp3(header: bytes, file_size: int) -> Union[AudioInfo, None]:
+    """ Reads the first MPEG audio frame header and its Xing/Info/VBRI header if there is one. Other data can look
+    like a frame header, so a frame is only trusted after an ID3 tag, with a VBR header, or if the next frames follow
+    it where its length predicts. """
+    offset = 0
+    tagged = header[:3] == b'ID3' and len(header) >= 10
+    if tagged:
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        offset = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+    while offset + 4 <= len(header):
+        frame = _mpeg_frame(header, offset)
+        if frame is not None and (tagged or _vbr_frames(header, offset, frame) or _in_sync(header, offset, frame)):
+            break
+        offset += 1
+    else:
+        return None
+
+    sample_rate, channels = frame.sample_rate, frame.channels
+    samples_per_frame = 384 if frame.layer == 1 else 1152 if frame.layer == 2 or frame.version == 1 else 576
+    frames = _vbr_frames(header, offset, frame)
+    if frames:
+        duration = frames * samples_per_frame / float(sample_rate)
+    else:
+        duration = (file_size - offset) * 8 / float(frame.bitrate)
+
+    return AudioInfo('mp3', sample_rate, channels, duration)
+
+
+def _read_vint(data: bytes, offset: int, keep_marker: bool) -> Union[tuple, None]:
+    """ Reads an EBML variable length integer, returns (value, length) or None at the end of the data. """
+    if offset >= len(data) or data[offset] == 0:
+        return None
+    length = 8 - data[offset].bit_length() + 1
+    if offset + length > len(data):
+        return None
+    value = int.from_bytes(data[offset:offset + length], 'big')
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+    return value, length
+
+
+def _ebml_elements(data: bytes, start: int, end: int):
+    """ Yields (id, data start, data end) for the EBML elements between start and end. Elements with an unknown
+    size (as written by live recorders) extend to the end of the parent. """
+    offset = start
+    while offset < end:
+        element_id = _read_vint(data, offset, keep_marker=True)
+        if element_id is None:
+            return
+        size = _read_vint(data, offset + element_id[1], keep_marker=False)
+        if size is None:
+            return
+        data_start = offset + element_id[1] + size[1]
+        unknown_size = size[0] == (1 << (7 * size[1])) - 1
+        data_end = end if unknown_size else min(data_start + size[0], end)
+        yield element_id[0], data_start, data_end
+        offset = data_end
+
+
+def _ebml_float(data: bytes) -> float:
+    return struct.unpack('>f' if len(data) == 4 else '>d', data)[0]
+
+
+def _probe_webm(header: bytes) -> Union[AudioInfo, None]:
+    """ Reads the Info and Tracks elements of a WebM/Matroska file. """
+    segment = next((e for e in _ebml_elements(header, 0, len(header)) if e[0] == 0x18538067), None)
+    if segment is None:
+        return None
+
+    timecode_scale, duration, sample_rate, channels, codec = 1000000, None, None, 1, 'webm'
+    for element_id, start, end in _ebml_elements(header, segment[1], segment[2]):
+        if element_id == 0x1549A966:  # Info
+            for child_id, child_start, child_end in _ebml_elements(header, start, end):
+                if child_id == 0x2AD7B1:
+                    timecode_scale = int.from_bytes(header[child_start:child_end], 'big')
+                elif child_id == 0x4489:
+                    duration = _ebml_float(header[child_start:child_end])
+        elif element_id == 0x1654AE6B:  # Tracks
+            for track_id, track_start, track_end in _ebml_elements(header, start, end):
+                if track_id != 0xAE or sample_rate:
+                    continue
+                for child_id, child_start, child_end in _ebml_elements(header, track_start, track_end):
+                    if child_id == 0x86:
+                        codec = header[child_start:child_end].decode('ascii', 'replace').lower()
+                    elif child_id == 0xE1:  # Audio
+                        for audio_id, audio_start, audio_end in _ebml_elements(header, child_start, child_end):
+                            if audio_id == 0xB5:
+                                sample_rate = int(_ebml_float(header[audio_start:audio_end]))
+                            elif audio_id == 0x9F:
+                                channels = int.from_bytes(header[audio_start:audio_end], 'big')
+        elif element_id == 0x1F43B675:  # Cluster, the header is over
+            break
+
+    if not sample_rate:
+        return None
+
+    # Recordings from MediaRecorder have no duration, they have to be decoded
+    if not duration:
+        return AudioInfo(codec, sample_rate, channels, 0.0, from_header=False)
+
+    return AudioInfo(codec, sample_rate, channels, duration * timecode_scale / 1e9)
+
+
+def _probe_ogg(header: bytes) -> Union[AudioInfo, None]:
+    """ Reads the OpusHead packet of an Ogg Opus file (the duration is only known at the end of the file). """
+    segments = header[26]
+    packet = header[27 + segments:]
+    if packet[:8] != b'OpusHead':
+        return None
+
+    # Opus is always decoded at 48 kHz, whatever the sample rate of the input was
+    return AudioInfo('opus', 48000, packet[9], 0.0, from_header=False)
+
+
+def _is_mp3(header: bytes, name: str = None, content_type: str = None) -> bool:
+    """ MPEG audio has no magic bytes, a file is probed as MP3 if it starts with an ID3 tag or its name or content
+    type says it is one. """
+    return header[:3] == b'ID3' or os.path.splitext(name or "")[1].lower() in MP3_EXTENSIONS \
+        or (content_type or "").split(';')[0].strip().lower() in MP3_CONTENT_TYPES
+
+
+def _probe_header(header: bytes, file_size: int, name: str = None,
+                  content_type: str = None) -> Union[AudioInfo, None]:
+    """ Detects the container from its magic bytes (or the name or content type of MP3 files) and reads its
+    header. """
+    try:
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            return _probe_wav(header, file_size)
+        if header[:4] == b'fLaC':
+            return _probe_flac(header)
+        if header[:4] == b'\x1a\x45\xdf\xa3':
+            return _probe_webm(header)
+        if header[:4] == b'OggS':
+            return _probe_ogg(header)
+        if _is_mp3(header, name, content_type):
+            return _probe_mp3(header, file_size)
+        return None
+
+    except (struct.error, IndexError, ValueError) as ex:
+        logging.warning("Could not parse the audio header: %s", ex)
+        return None
+
+
+def probe_header(data: bytes, file_size: int = None, name: str = None,
+                 content_type: str = None) -> Union[AudioInfo, None]:
+    """ Reads the header of an audio file that is in memory, without decoding it.
+
+    Arguments:
+        data (bytes): The file, or only its start if it is still being received.
+        file_size (int): Size of the complete file (or an upper bound of it), defaults to the size of data.
+        name (str): Name of the file, MP3 files are recognized by their extension (if they have no ID3 tag).
+        content_type (str): Content type of the file, audio/mpeg is probed as MP3 too.
+
+    Returns:
+        The metadata in the header (AudioInfo) or None if the format is unknown. The duration is 0.0 and from_header
+        is False if the header does not contain it.
+    """
+    return _probe_header(data[:HEADER_BYTES], file_size or len(data), name, content_type)
+
+
+def _decode_duration(file_path: str, sample_rate: int) -> float:
+    """ Decodes the file as a stream and counts the samples, keeping only one chunk in memory at a time. """
+    command = [cfg.FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-i', file_path,
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    decoded_bytes = 0
+    with process.stdout:
+        for chunk in iter(lambda: process.stdout.read(DECODE_CHUNK_BYTES), b''):
+            decoded_bytes += len(chunk)
+
+    if process.wait() != 0 or not decoded_bytes:
+        raise ValueError("The audio could not be decoded (is the file valid?).")
+
+    return decoded_bytes / 2.0 / sample_rate
+
+
+@lru_cache(maxsize=1024)
+def _probe_cached(file_path: str, file_size: int, modified: int) -> AudioInfo:
+    with open(file_path, 'rb') as audio_file:
+        header = audio_file.read(HEADER_BYTES)
+
+    info = _probe_header(header, file_size, file_path)
+    if info is not None and info.from_header and info.duration > 0:
+        return info
+
+    logging.debug("No usable header in %s, decoding it to find the duration.", file_path)
+    sample_rate = info.sample_rate if info is not None else cfg.SAMPLE_RATE
+    duration = _decode_duration(file_path, sample_rate)
+    return AudioInfo(info.codec if info is not None else os.path.splitext(file_path)[1].lstrip('.'),
+                     sample_rate, info.channels if info is not None else 1, duration, from_header=False)
+
+
+def probe_audio(file_path: str) -> AudioInfo:
+    """ Gets the metadata of an audio file, preferably from its header only.
+
+    Arguments:
+        file_path (str): Path to the audio file.
+
+    Returns:
+        The metadata of the file (AudioInfo).
+
+    Raises:
+        ValueError: If there is no usable header and the file could not be decoded.
+    """
+    file_path = os.path.realpath(file_path)
+    stat = os.stat(file_path)
+    return _probe_cached(file_path, stat.st_size, stat.st_mtime_ns)
+
+
+def clear_probe_cache():
+    """ Forgets the memoized results of probe_audio(). """
+    _probe_cached.cache_clear()
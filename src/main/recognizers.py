@@ -0,0 +1,463 @@
+""" Contains the speech recognition backends. Every backend offers a batch API (recognize a complete DecodedAudio
+buffer) and a streaming API (consume an iterator of raw mono 16-bit PCM frames while they are being recorded and
+yield partial and final hypotheses as soon as they are available).
+
+Backends are configured in ASR_BACKENDS in settings.py and the one that is used is selected with ASR_BACKEND.
+Besides the Dialogflow adapter there is a local stand-in ("fake") with configurable latency, jitter, error rate and
+canned transcripts, so the pipeline can be tested and benchmarked without the cloud service, an HTTP client ("http")
+for recognition services such as the stand-in server of "manage.py fakerecognizer" and an offline backend ("local")
+with a local Keras model (see inference.py).
+
+The batch API has an async variant for async views, recognize_async(). It waits for the backend without blocking a
+thread; backends without an asynchronous client fall back to running recognize() in a worker thread.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Iterable, Iterator, NamedTuple
+from asgiref.sync import sync_to_async
+from django.utils.module_loading import import_string
+from src.main.audio import DecodedAudio
+from src.main.encoding import FLAC, LINEAR16, OGG_OPUS, encode_payload, encode_payload_async
+from src.main.inference import get_model_registry
+import src.recorder.settings as cfg
+
+GOOGLE_AUTHENTICATION_FILE_NAME = "dialogflow.json"
+
+
+class RecognitionError(Exception):
+    """ Raised when a backend fails to recognize the audio. """
+
+
+class TransientRecognitionError(RecognitionError):
+    """ Raised when a backend fails for a reason that may go away, such as a connection error, a timeout or an
+    overloaded service (5xx, 429), so the request is worth a retry (see pool.py). """
+
+
+class Hypothesis(NamedTuple):
+    """ A (partial) recognition result.
+
+    Attributes:
+        text (str): The transcript recognized so far for the current utterance.
+        is_final (bool): True if the text will not change anymore.
+    """
+    text: str
+    is_final: bool
+
+
+class Recognizer:
+    """ Base class of the speech recognition backends.
+
+    Attributes:
+        ENCODINGS (tuple): Payload encodings the backend accepts in recognize() (see encoding.py).
+    """
+
+    ENCODINGS = (LINEAR16,)
+
+    def recognize(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        """ Recognizes a complete audio buffer.
+
+        Arguments:
+            audio (DecodedAudio): The audio to recognize.
+            language_code (str): Language of the speech.
+            session_id (str): Session id, using the same id between requests allows continuation.
+
+        Returns:
+            The transcript (str).
+        """
+        raise NotImplementedError
+
+    async def recognize_async(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        """ Recognizes a complete audio buffer like recognize(), without blocking the event loop. Backends without an
+        asynchronous client run recognize() in a worker thread. """
+        return await sync_to_async(self.recognize, thread_sensitive=False)(audio, language_code, session_id)
+
+    def streaming_recognize(self, frames: Iterable[bytes], sample_rate: int, language_code: str = "en",
+                            session_id: str = "me") -> Iterator[Hypothesis]:
+        """ Recognizes audio while it is being recorded.
+
+        Arguments:
+            frames (Iterable[bytes]): Mono 16-bit little-endian PCM frames.
+            sample_rate (int): Sample rate of the frames in Hz.
+            language_code (str): Language of the speech.
+            session_id (str): Session id, using the same id between requests allows continuation.
+
+        Returns:
+            An iterator of hypotheses, the last one is final.
+        """
+        raise NotImplementedError
+
+
+class FakeRecognizer(Recognizer):
+    """ Offline, deterministic stand-in for a recognition backend. The transcript of an audio buffer is picked from
+    the canned transcripts by the hash of its samples, so the same audio always gives the same text. Streams
+    "recognize" the words of a transcript at a fixed speaking rate.
+
+    Arguments:
+        transcripts (list): Canned transcripts.
+        latency (float): Base latency of a batch request in seconds.
+        jitter (float): Spread of the latency, its meaning depends on the distribution.
+        distribution (str): Latency distribution: "uniform" (latency +/- jitter seconds), "lognormal" (median latency,
+            jitter is the standard deviation of its logarithm) or "exponential" (latency plus an exponential tail
+            with a mean of jitter seconds).
+        realtime_factor (float): Extra latency per second of audio.
+        error_rate (float): Fraction of the requests that fail with a TransientRecognitionError.
+        words_per_second (float): Speaking rate used for streaming recognition.
+        seed (int): Seed of the random generator used for the jitter and the errors, None seeds it from the system so
+            that every instance (every client of a pool, every worker process) draws its own sequence.
+    """
+
+    DISTRIBUTIONS = ("uniform", "lognormal", "exponential")
+
+    def __init__(self, transcripts: list = None, latency: float = 0.0, jitter: float = 0.0,
+                 realtime_factor: float = 0.0, error_rate: float = 0.0, words_per_second: float = 2.5,
+                 seed: int = None, distribution: str = "uniform"):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError("Unknown latency distribution '{}', choose one of: {}.".format(
+                distribution, ", ".join(self.DISTRIBUTIONS)))
+
+        self.transcripts = list(transcripts) if transcripts else [""]
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.realtime_factor = realtime_factor
+        self.error_rate = error_rate
+        self.words_per_second = words_per_second
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.streams = 0
+
+    def _latency(self, duration: float) -> tuple:
+        """ Draws the simulated latency of a request in seconds and whether it fails. """
+        with self.lock:
+            if self.distribution == "lognormal":
+                latency = self.random.lognormvariate(0.0, self.jitter) * self.latency if self.jitter else self.latency
+            elif self.distribution == "exponential":
+                latency = self.latency + (self.random.expovariate(1.0 / self.jitter) if self.jitter else 0.0)
+            else:
+                latency = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            fail = self.random.random() < self.error_rate
+
+        return max(0.0, latency + self.realtime_factor * duration), fail
+
+    def _wait(self, duration: float):
+        """ Simulates the latency of a request and fails a fraction of them. """
+        latency, fail = self._latency(duration)
+        time.sleep(latency)
+        if fail:
+            raise TransientRecognitionError("Simulated recognition failure.")
+
+    def _transcript(self, audio: DecodedAudio) -> str:
+        digest = hashlib.sha1(audio.pcm).digest()
+        return self.transcripts[int.from_bytes(digest[:4], 'big') % len(self.transcripts)]
+
+    def recognize(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        self._wait(audio.duration)
+        return self._transcript(audio)
+
+    async def recognize_async(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        latency, fail = self._latency(audio.duration)
+        await asyncio.sleep(latency)
+        if fail:
+            raise TransientRecognitionError("Simulated recognition failure.")
+        return self._transcript(audio)
+
+    def streaming_recognize(self, frames: Iterable[bytes], sample_rate: int, language_code: str = "en",
+                            session_id: str = "me") -> Iterator[Hypothesis]:
+        with self.lock:
+            words = self.transcripts[self.streams % len(self.transcripts)].split()
+            self.streams += 1
+
+        received = 0
+        text = ""
+        for frame in frames:
+            received += len(frame)
+            count = int(received / 2.0 / sample_rate * self.words_per_second)
+            new_text = " ".join(words[i % len(words)] for i in range(count)) if words else ""
+            if new_text != text:
+                text = new_text
+                self._wait(0.0)
+                yield Hypothesis(text, False)
+
+        yield Hypothesis(text, True)
+
+
+class DialogflowRecognizer(Recognizer):
+    """ Recognition backend using Dialogflow's detect_intent and streaming_detect_intent. The audio of detect_intent is
+    sent in the most compact encoding of PAYLOAD_ENCODINGS in settings.py and Dialogflow is told which one it is.
+
+    Arguments:
+        project_id (str): Dialogflow project id.
+        credentials (str): Path to the service account file, defaults to main/dialogflow.json.
+        timeout (float): Seconds recognize_async() waits for detect_intent.
+    """
+
+    ENCODINGS = (OGG_OPUS, FLAC, LINEAR16)
+    AUDIO_ENCODINGS = {OGG_OPUS: 'AUDIO_ENCODING_OGG_OPUS', FLAC: 'AUDIO_ENCODING_FLAC',
+                       LINEAR16: 'AUDIO_ENCODING_LINEAR_16'}
+
+    # gRPC status codes of failures that are worth a retry (see pool.py), they are raised as TransientRecognitionError
+    TRANSIENT_CODES = ('UNAVAILABLE', 'DEADLINE_EXCEEDED', 'RESOURCE_EXHAUSTED', 'INTERNAL', 'ABORTED')
+
+    def __init__(self, project_id: str, credentials: str = None, timeout: float = 220.0):
+        import dialogflow_v2 as dialogflow
+        import grpc
+        from google.api_core import exceptions
+
+        if credentials is None:
+            credentials = os.path.join(os.path.dirname(os.path.realpath(__file__)), GOOGLE_AUTHENTICATION_FILE_NAME)
+        os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", credentials)
+
+        self.dialogflow = dialogflow
+        self.transient_codes = {getattr(grpc.StatusCode, code) for code in self.TRANSIENT_CODES}
+        self.transient_errors = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded,
+                                 exceptions.ResourceExhausted, exceptions.InternalServerError, exceptions.Aborted)
+        self.project_id = project_id
+        self.timeout = timeout
+        self.session_client = dialogflow.SessionsClient()
+
+    def _query_input(self, payload, language_code: str):
+        audio_config = self.dialogflow.types.InputAudioConfig(
+            audio_encoding=getattr(self.dialogflow.enums.AudioEncoding, self.AUDIO_ENCODINGS[payload.encoding]),
+            language_code=language_code, sample_rate_hertz=payload.sample_rate)
+        return self.dialogflow.types.QueryInput(audio_config=audio_config)
+
+    def recognize(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        payload = encode_payload(audio, self.ENCODINGS)
+        try:
+            response = self.session_client.detect_intent(
+                session=self.session_client.session_path(self.project_id, session_id),
+                query_input=self._query_input(payload, language_code),
+                input_audio=payload.data)
+        except self.transient_errors as ex:
+            raise TransientRecognitionError("Dialogflow failed: {}".format(ex))
+
+        return response.query_result.query_text
+
+    async def recognize_async(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        payload = await encode_payload_async(audio, self.ENCODINGS)
+        request = self.dialogflow.types.DetectIntentRequest(
+            session=self.session_client.session_path(self.project_id, session_id),
+            query_input=self._query_input(payload, language_code),
+            input_audio=bytes(payload.data))
+
+        # The call runs on the threads of gRPC, its result is handed to the event loop when it arrives
+        call = self.session_client.transport.detect_intent.future(request, timeout=self.timeout)
+        loop = asyncio.get_event_loop()
+        result = loop.create_future()
+
+        def resolve(done_call):
+            def set_result():
+                if result.done():
+                    return
+                error = done_call.exception()
+                if error is not None and done_call.code() in self.transient_codes:
+                    result.set_exception(TransientRecognitionError("Dialogflow failed: {}".format(error)))
+                elif error is not None:
+                    result.set_exception(error)
+                else:
+                    result.set_result(done_call.result())
+            loop.call_soon_threadsafe(set_result)
+
+        call.add_done_callback(resolve)
+        try:
+            response = await result
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+
+        return response.query_result.query_text
+
+    def streaming_recognize(self, frames: Iterable[bytes], sample_rate: int, language_code: str = "en",
+                            session_id: str = "me") -> Iterator[Hypothesis]:
+        types = self.dialogflow.types
+        audio_config = types.InputAudioConfig(
+            audio_encoding=self.dialogflow.enums.AudioEncoding.AUDIO_ENCODING_LINEAR_16,
+            language_code=language_code, sample_rate_hertz=sample_rate)
+        session = self.session_client.session_path(self.project_id, session_id)
+
+        def requests():
+            yield types.StreamingDetectIntentRequest(
+                session=session, query_input=types.QueryInput(audio_config=audio_config))
+            for frame in frames:
+                yield types.StreamingDetectIntentRequest(input_audio=frame)
+
+        text, is_final = "", False
+        for response in self.session_client.streaming_detect_intent(requests=requests()):
+            result = response.recognition_result
+            if result.transcript:
+                text, is_final = result.transcript, result.is_final
+                yield Hypothesis(text, is_final)
+
+        if not is_final:
+            yield Hypothesis(text, True)
+
+
+class HttpRecognizer(Recognizer):
+    """ Recognition backend that posts the audio to an HTTP recognition service. The body is the encoded audio, its
+    encoding, sample rate, language and session are query parameters and the service answers with {"text": ...}.
+    Streams are collected and recognized at once when they end.
+
+    Arguments:
+        url (str): URL of the recognition endpoint.
+        timeout (float): Seconds to wait for an answer.
+    """
+
+    ENCODINGS = (OGG_OPUS, FLAC, LINEAR16)
+    # Answers of an overloaded or failing service that are worth a retry, other errors are permanent
+    TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+    STATUS_LINE = re.compile(rb'HTTP/1\.[01] ([1-5][0-9][0-9])(?: [^\r\n]*)?')
+
+    def __init__(self, url: str, timeout: float = 30.0):
+        self.url = url
+        self.timeout = timeout
+
+    @staticmethod
+    def _query(payload, language_code: str, session_id: str) -> str:
+        return urllib.parse.urlencode({"encoding": payload.encoding, "sample_rate": payload.sample_rate,
+                                       "language_code": language_code, "session_id": session_id})
+
+    def recognize(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        payload = encode_payload(audio, self.ENCODINGS)
+        query = self._query(payload, language_code, session_id)
+        request = urllib.request.Request("{}?{}".format(self.url, query), data=bytes(payload.data), method='POST',
+                                         headers={"Content-Type": "application/octet-stream"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode())["text"]
+
+        except urllib.error.HTTPError as ex:
+            raise self._status_error(ex.code)
+        except OSError as ex:
+            # URLError and timeouts are OSErrors
+            raise TransientRecognitionError("The recognition service failed: {}".format(ex))
+        except (ValueError, KeyError) as ex:
+            raise RecognitionError("The recognition service sent an invalid answer: {}".format(ex))
+
+    def _status_error(self, status: int) -> RecognitionError:
+        """ Returns the error of an answer that is not a success, transient or permanent depending on its status. """
+        error = TransientRecognitionError if status in self.TRANSIENT_STATUS else RecognitionError
+        return error("The recognition service answered with status {}.".format(status))
+
+    async def recognize_async(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        payload = await encode_payload_async(audio, self.ENCODINGS)
+        url = urllib.parse.urlsplit("{}?{}".format(self.url, self._query(payload, language_code, session_id)))
+        try:
+            status, body = await asyncio.wait_for(self._post_async(url, bytes(payload.data)), self.timeout)
+            if status != 200:
+                raise self._status_error(status)
+            return json.loads(body.decode())["text"]
+
+        except (OSError, asyncio.TimeoutError) as ex:
+            raise TransientRecognitionError("The recognition service failed: {}".format(ex))
+        except (ValueError, KeyError) as ex:
+            raise RecognitionError("The recognition service sent an invalid answer: {}".format(ex))
+
+    @classmethod
+    async def _post_async(cls, url, data: bytes) -> tuple:
+        """ Posts the data with asyncio streams (HTTP/1.0, so the response is never chunked).
+
+        Returns:
+            tuple: The status code (int) and the body (bytes) of the response.
+
+        Raises:
+            RecognitionError: If the response has no valid status line, TransientRecognitionError if it is empty
+                (the connection was closed).
+        """
+        secure = url.scheme == 'https'
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or (443 if secure else 80),
+                                                       ssl=secure or None)
+        try:
+            writer.write("POST {}?{} HTTP/1.0\r\nHost: {}\r\nContent-Type: application/octet-stream\r\n"
+                         "Content-Length: {}\r\n\r\n".format(url.path or "/", url.query, url.netloc, len(data))
+                         .encode() + data)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        if not response:
+            raise TransientRecognitionError("The recognition service closed the connection without an answer.")
+        head, separator, body = response.partition(b"\r\n\r\n")
+        status = cls.STATUS_LINE.fullmatch(head.split(b"\r\n", 1)[0])
+        if not separator or status is None:
+            raise RecognitionError("The recognition service sent an invalid response: {!r}".format(response[:80]))
+        return int(status.group(1)), body
+
+    def streaming_recognize(self, frames: Iterable[bytes], sample_rate: int, language_code: str = "en",
+                            session_id: str = "me") -> Iterator[Hypothesis]:
+        audio = DecodedAudio(b"".join(frames), sample_rate)
+        yield Hypothesis(self.recognize(audio, language_code, session_id), True)
+
+
+class LocalModelRecognizer(Recognizer):
+    """ Offline recognition backend with a local Keras model of MODELS in settings.py (see inference.py): a classifier
+    recognizes the label of the audio (e.g. a command or an intent), a CTC model its characters. The model is loaded
+    once per process and concurrent requests are predicted in micro-batches. Streams are collected and recognized at
+    once when they end.
+
+    Arguments:
+        model (str): Name of the model in MODELS.
+    """
+
+    def __init__(self, model: str):
+        self.model = get_model_registry().get(model)
+
+    def recognize(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        return self.model.transcribe(audio)
+
+    async def recognize_async(self, audio: DecodedAudio, language_code: str = "en", session_id: str = "me") -> str:
+        return await self.model.transcribe_async(audio)
+
+    def streaming_recognize(self, frames: Iterable[bytes], sample_rate: int, language_code: str = "en",
+                            session_id: str = "me") -> Iterator[Hypothesis]:
+        audio = DecodedAudio(b"".join(frames), sample_rate)
+        yield Hypothesis(self.recognize(audio, language_code, session_id), True)
+
+
+_recognizers = {}
+_recognizers_lock = threading.Lock()
+
+
+def get_recognizer(name: str = None) -> Recognizer:
+    """ Returns the recognition backend configured in ASR_BACKENDS in settings.py. Every backend is created (and its
+    client libraries are imported) on first use and then shared by all threads of the process, as a pool of
+    long-lived clients with a concurrency limit, retries and optional hedged requests (see pool.py).
+
+    Arguments:
+        name (str): Name of the backend, defaults to ASR_BACKEND in settings.py.
+
+    Returns:
+        The recognizer (Recognizer).
+    """
+    name = name or cfg.ASR_BACKEND
+    try:
+        backend = cfg.ASR_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown ASR backend '{}', choose one of: {}.".format(name, ", ".join(cfg.ASR_BACKENDS)))
+
+    with _recognizers_lock:
+        if name not in _recognizers:
+            # pool.py builds on this module
+            from src.main.pool import RecognizerPool
+
+            pool = dict(cfg.RECOGNIZER_POOL, **backend.get('POOL', {}))
+            _recognizers[name] = RecognizerPool(
+                lambda: import_string(backend['CLASS'])(**backend.get('OPTIONS', {})),
+                **{key.lower(): value for key, value in pool.items()})
+        return _recognizers[name]
+
+
+def recognizer_stats(name: str = None) -> dict:
+    """ Returns the statistics of the pool of a backend (see pool.py), empty if it was not used yet. """
+    pool = _recognizers.get(name or cfg.ASR_BACKEND)
+    return pool.stats() if pool is not None else {}
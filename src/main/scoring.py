@@ -0,0 +1,115 @@
+""" Contains the live scoring of the recording sessions. The recorder posts the reference text after every chunk, so
+the transcript of a session is scored again and again while it grows. Instead of normalizing and aligning the whole
+transcript every time, every session keeps an IncrementalScorer (see metrics.py) for its reference text: only the
+segments that were appended since the last score are normalized and added to the alignment. The reference text and
+the segments are encoded as word ids of the Normalizer (see normalization.py) that the scorer was started with.
+
+The scorers are kept per process, up to SCORING['MAX_CELLS'] alignment cells (bytes) for all sessions together; the
+least recently scored sessions are dropped first and are scored from scratch when they come back (e.g. on another
+worker, or after the reference text or the transcript was reset).
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from src.main.instrumentation import timed
+from src.main.metrics import IncrementalScorer
+from src.main.normalization import Normalizer, get_normalizer
+from src.main.transcripts import get_transcript_store
+import src.recorder.settings as cfg
+
+
+class _LiveScore:
+    """ Scorer of one session, for one reference text and transcript start. """
+
+    def __init__(self, truth_key: str, start: int, normalizer: Normalizer, truth: str):
+        self.truth_key = truth_key
+        self.start = start
+        self.scored = start  # Index of the next segment that is not in the alignment yet
+        self.normalizer = normalizer
+        self.scorer = IncrementalScorer(normalizer.ids(truth, memoize=True))
+        self.lock = threading.Lock()
+
+
+class SessionScorers:
+    """ Per session incremental scorers, least recently used first.
+
+    Arguments:
+        max_cells (int): Maximum number of alignment cells (bytes) of all scorers together.
+    """
+
+    def __init__(self, max_cells: int):
+        self.max_cells = max_cells
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, session_key: str, truth_key: str, truth: str, start: int) -> _LiveScore:
+        with self.lock:
+            live = self.scores.get(session_key)
+            if live is None or live.truth_key != truth_key or live.start != start:
+                live = _LiveScore(truth_key, start, get_normalizer(), truth)
+                self.scores[session_key] = live
+            self.scores.move_to_end(session_key)
+            return live
+
+    def _evict(self):
+        """ Drops the least recently scored sessions until the scorers fit in max_cells. """
+        with self.lock:
+            cells = sum(live.scorer.cells for live in self.scores.values())
+            while self.scores and cells > self.max_cells:
+                _, live = self.scores.popitem(last=False)
+                cells -= live.scorer.cells
+
+    def score(self, session_key: str, truth: str, start: int = 0) -> dict:
+        """ Scores the transcript of a session from segment start on against the reference text.
+
+        Arguments:
+            session_key (str): Session of the transcript (see transcripts.py).
+            truth (str): Reference text, as it was entered.
+            start (int): Index of the first segment of the transcript.
+
+        Returns:
+            Unrounded metrics (dict), see metrics.score().
+        """
+        truth_key = hashlib.sha256(truth.encode()).hexdigest()
+        live = self._get(session_key, truth_key, truth, start)
+        with live.lock:
+            segments = get_transcript_store().segments(session_key, live.scored)
+            if segments:
+                live.scorer.extend(live.normalizer.ids(" ".join(segments)))
+                live.scored += len(segments)
+            metrics = live.scorer.score()
+
+        self._evict()
+        return metrics
+
+    def __len__(self):
+        return len(self.scores)
+
+
+@timed("metrics")
+def score_session(context: dict, session_key: str, truth: str) -> dict:
+    """ Adds the live metrics of the current transcript of a session (from context['transcript_start'] on) to the
+    context, like calculate_metrics().
+
+    Returns:
+        The context (dict) with the rounded metrics and the hit/substitution/deletion/insertion counts.
+    """
+    metrics = get_session_scorers().score(session_key, truth, context.get('transcript_start', 0))
+    for key, value in metrics.items():
+        context[key] = round(value, 2) if isinstance(value, float) else value
+
+    return context
+
+
+_scorers = None
+_scorers_lock = threading.Lock()
+
+
+def get_session_scorers() -> SessionScorers:
+    """ Returns the session scorers of this process, configured by SCORING in settings.py. """
+    global _scorers
+    with _scorers_lock:
+        if _scorers is None:
+            _scorers = SessionScorers(cfg.SCORING['MAX_CELLS'])
+        return _scorers
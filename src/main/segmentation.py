@@ -0,0 +1,101 @@
+""" Contains the segmentation of long audio. A recognition request takes longer the longer the audio is, and backends
+refuse audio past a maximum duration, so long files are split into segments of MIN_SECONDS to MAX_SECONDS
+(SEGMENTATION in settings.py). Every cut is made at the quietest frame of that range, so words are not cut in half.
+
+The frame energies are computed block by block from the (memory-mapped) PCM, so a long file is never copied as a
+whole. The segments are recognized concurrently (at most WORKERS at a time) and returned in order with their
+timestamps, so a long file takes about as long as its slowest segment instead of the sum of all of them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Tuple
+import numpy as np
+from src.main.audio import DecodedAudio
+from src.main.vad import frame_features
+from src.main.instrumentation import timed
+import src.recorder.settings as cfg
+
+# Number of frames of which the energy is computed at once
+BLOCK_FRAMES = 4096
+
+
+class Segment(NamedTuple):
+    """ A recognized segment of a long audio file.
+
+    Attributes:
+        index (int): Position of the segment.
+        start (float): Start of the segment in the audio in seconds.
+        end (float): End of the segment in the audio in seconds.
+        text (str): Transcript of the segment.
+        rtf (float): RTF of the recognition of the segment.
+    """
+    index: int
+    start: float
+    end: float
+    text: str
+    rtf: float
+
+
+def needs_segmentation(audio: DecodedAudio) -> bool:
+    """ Returns True if the audio is longer than one segment may be. """
+    return cfg.SEGMENTATION['ENABLED'] and audio.duration > cfg.SEGMENTATION['MAX_SECONDS']
+
+
+def frame_energy(samples: np.ndarray, frame_length: int) -> np.ndarray:
+    """ Calculates the energy (dBFS) of every frame, BLOCK_FRAMES frames at a time. """
+    block = BLOCK_FRAMES * frame_length
+    return np.concatenate([frame_features(samples[offset:offset + block], frame_length)[0]
+                           for offset in range(0, len(samples), block)] or [np.empty(0)])
+
+
+def split_at_silence(audio: DecodedAudio) -> List[Tuple[int, int]]:
+    """ Finds the segment boundaries: every segment ends at the quietest frame between MIN_SECONDS and MAX_SECONDS
+    after its start, the last one ends at the end of the audio.
+
+    Returns:
+        list: (first sample, sample after the last one) of every segment.
+    """
+    frame_length = max(1, int(audio.sample_rate * cfg.VAD['FRAME_MS'] / 1000))
+    energy = frame_energy(audio.samples, frame_length)
+    min_frames = max(1, int(cfg.SEGMENTATION['MIN_SECONDS'] * audio.sample_rate / frame_length))
+    max_frames = max(min_frames + 1, int(cfg.SEGMENTATION['MAX_SECONDS'] * audio.sample_rate / frame_length))
+
+    bounds, position = [], 0
+    while len(energy) - position > max_frames:
+        cut = position + min_frames + int(np.argmin(energy[position + min_frames:position + max_frames]))
+        bounds.append((position * frame_length, cut * frame_length))
+        position = cut
+
+    bounds.append((position * frame_length, len(audio)))
+    return bounds
+
+
+def recognize_segments(audio: DecodedAudio, recognize: Callable[[DecodedAudio], Tuple[str, float]],
+                       workers: int = None) -> List[Segment]:
+    """ Splits the audio at silence and recognizes the segments concurrently.
+
+    Arguments:
+        audio (DecodedAudio): The (long) audio.
+        recognize (Callable): Returns the text and RTF of one segment.
+        workers (int): Maximum number of segments that are recognized at the same time, defaults to
+            SEGMENTATION['WORKERS'] in settings.py.
+
+    Returns:
+        list: The recognized segments (Segment), in order.
+    """
+    with timed("segment"):
+        bounds = split_at_silence(audio)
+    width = DecodedAudio.SAMPLE_WIDTH
+
+    def run(index: int) -> Segment:
+        start, end = bounds[index]
+        segment = DecodedAudio(audio.pcm[start * width:end * width], audio.sample_rate,
+                               "{}#{}".format(audio.name, index), audio.source,
+                               audio.offset + start / float(audio.sample_rate))
+        text, rtf = recognize(segment)
+        return Segment(index, round(start / float(audio.sample_rate), 3), round(end / float(audio.sample_rate), 3),
+                       text, rtf)
+
+    workers = min(workers or cfg.SEGMENTATION['WORKERS'], len(bounds))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="segment") as executor:
+        return list(executor.map(run, range(len(bounds))))
@@ -1,6 +1,7 @@
 let counting, counter, elem, timer, i, limit, rec, should_record, mediaRecorder, error, full_text, oldContent, seconds_per_cut;
 let wer, wcr, rtf, precision_micro, precision_macro, recall_micro, recall_macro, f1_micro, f1_macro, reset_text, input_text;
 let recordedChunks = [];
+let socket;
 
 window.onload = function () {
     // Initialize variables
@@ -100,7 +101,7 @@ function start() {
 
 function increase() {
     if (i < limit * 100 && i > 0) {
-        if (i % (seconds_per_cut.value * 100) === 0) {
+        if (!USE_STREAMING && i % (seconds_per_cut.value * 100) === 0) {
             if ((i / (seconds_per_cut.value * 100)) < 2) {
                 reset_text = true;
             } else {
@@ -150,6 +151,9 @@ const handleSuccess = function (stream) {
     if (should_record === true) {
         console.log("Started Recording");
         mediaRecorder.start();
+        if (USE_STREAMING) {
+            startStreaming(context, processor);
+        }
     }
 
     mediaRecorder.addEventListener('dataavailable', function (e) {
@@ -160,6 +164,10 @@ const handleSuccess = function (stream) {
 
     mediaRecorder.addEventListener('stop', function () {
         console.log("Stopped recording");
+        if (USE_STREAMING) {
+            stopStreaming();
+            return;
+        }
         console.log("Resetting text: " + reset_text.toString())
         postData("audio_recording", '', recordedChunks, reset_text).then((data) => {
             full_text.innerHTML = data['text'];
@@ -168,8 +176,54 @@ const handleSuccess = function (stream) {
     })
 };
 
+function startStreaming(audioContext, processor) {
+    // Stream raw 16-bit PCM to the server and show the hypotheses while they arrive
+    const protocol = window.location.protocol === "https:" ? "wss://" : "ws://";
+    let final_text = "";
+    socket = new WebSocket(protocol + window.location.host + STREAMING_PATH);
+    socket.binaryType = "arraybuffer";
+
+    socket.onopen = function () {
+        socket.send(JSON.stringify({sample_rate: audioContext.sampleRate}));
+    };
+
+    socket.onmessage = function (e) {
+        const data = JSON.parse(e.data);
+        full_text.innerHTML = (final_text + " " + data['text']).trim();
+        if (data['type'] === "final") {
+            final_text = full_text.innerHTML;
+        }
+    };
+
+    processor.onaudioprocess = function (e) {
+        if (!should_record || socket.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        const input = e.inputBuffer.getChannelData(0);
+        const pcm = new Int16Array(input.length);
+        for (let j = 0; j < input.length; j++) {
+            const sample = Math.max(-1, Math.min(1, input[j]));
+            pcm[j] = sample < 0 ? sample * 0x8000 : sample * 0x7FFF;
+        }
+        socket.send(pcm.buffer);
+    };
+}
+
+function stopStreaming() {
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({event: "stop"}));
+    }
+}
+
 async function postData(name = '', url = '', data, reset = true) {
     let fd = new FormData;
+    // The fields come before the audio: uploads can be rejected before the audio is received completely
+    fd.append("csrfmiddlewaretoken", CSRF_TOKEN);
+    fd.append("reset", reset.toString());
+    if (name === "audio_recording" || name === "audio_upload") {
+        // Audio is transcribed by the job queue, the result is polled for below
+        fd.append("async", "true");
+    }
 
     if (name === "audio_recording") {
         fd.append(name, new Blob(data));
@@ -177,19 +231,35 @@ async function postData(name = '', url = '', data, reset = true) {
     } else {
         fd.append(name, data);
     }
-    fd.append("reset", reset.toString());
-
-    fd.append("csrfmiddlewaretoken", CSRF_TOKEN);
     const response = await fetch(url, {method: "POST", body: fd, credentials: 'same-origin',});
 
     if (response.status === 200) {
         return await response.json()
+    } else if (response.status === 202) {
+        return await pollJob((await response.json())['job']);
+    } else if (response.status === 429) {
+        console.error((await response.json()).error);
+        throw response.status;
     } else if (response.status === 400) {
         alert((await response.json()).error);
         throw response.status;
     }
 }
 
+async function pollJob(job_id) {
+    // Long-poll until the transcription job is finished
+    while (true) {
+        const response = await fetch("/jobs/" + job_id + "?wait=10", {credentials: 'same-origin'});
+        const data = await response.json();
+        if (data['status'] === "done") {
+            return data;
+        } else if (response.status !== 200 || data['status'] === "failed") {
+            alert(data['error']);
+            throw response.status;
+        }
+    }
+}
+
 function upload_audio(data) {
     postData("audio_upload", '', data, true).then((data) => {
         full_text.innerHTML = data['text'];
@@ -0,0 +1,183 @@
+""" Contains the WebSocket endpoint for live (streaming) transcription, it is served by recorder/asgi.py.
+
+Protocol:
+    - The client connects to STREAMING_PATH and may send a JSON text message with the audio settings first,
+      e.g. {"sample_rate": 48000, "language_code": "en"}.
+    - Audio is sent as binary messages containing mono 16-bit little-endian PCM frames.
+    - The client sends {"event": "stop"} (or simply disconnects) when the recording is done.
+    - The server sends {"type": "partial" | "final", "text": "..."} messages as soon as the recognizer has them.
+    - The connection is closed with 1013 (try again later) if STREAMING_MAX_STREAMS streams are open already, and with
+      1003 if the client sends a text message that is not valid JSON settings.
+
+Every stream runs its (blocking) recognizer on a thread of the stream executor for as long as it is open.
+"""
+
+import asyncio
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.main.recognizers import get_recognizer
+import src.recorder.settings as cfg
+
+
+class StreamExecutor:
+    """ The threads of the streaming recognizers, one per open stream.
+
+    Arguments:
+        max_streams (int): Maximum number of streams that are open at the same time.
+    """
+
+    def __init__(self, max_streams: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_streams, thread_name_prefix="streaming")
+        self.slots = threading.BoundedSemaphore(max_streams)
+
+    def reserve(self) -> bool:
+        """ Reserves a thread for a stream, returns False if all threads are taken. """
+        return self.slots.acquire(blocking=False)
+
+    def release(self):
+        self.slots.release()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_stream_executor() -> StreamExecutor:
+    """ Returns the stream executor of this process, configured by STREAMING_MAX_STREAMS in settings.py. """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = StreamExecutor(cfg.STREAMING_MAX_STREAMS)
+        return _executor
+
+
+def _recognize(recognizer, frames: queue.Queue, settings: dict, loop, hypotheses: asyncio.Queue):
+    """ Runs the (blocking) streaming recognizer in a worker thread, hands every hypothesis to the event loop. """
+    def frame_iterator():
+        for frame in iter(frames.get, None):
+            yield frame
+
+    try:
+        for hypothesis in recognizer.streaming_recognize(frame_iterator(), settings["sample_rate"],
+                                                         settings["language_code"]):
+            loop.call_soon_threadsafe(hypotheses.put_nowait, hypothesis)
+
+    except Exception as ex:
+        logging.error("Streaming recognition failed: %s", ex)
+
+    finally:
+        loop.call_soon_threadsafe(hypotheses.put_nowait, None)
+
+
+async def _send_hypotheses(send, hypotheses: asyncio.Queue):
+    """ Sends the hypotheses to the client until the recognizer is done. """
+    while True:
+        hypothesis = await hypotheses.get()
+        if hypothesis is None:
+            return
+        await send({"type": "websocket.send", "text": json.dumps(
+            {"type": "final" if hypothesis.is_final else "partial", "text": hypothesis.text})})
+
+
+async def websocket_application(scope: dict, receive, send):
+    """ ASGI application handling one streaming transcription WebSocket connection.
+
+    Args:
+        scope (dict): ASGI connection scope.
+        receive: ASGI receive callable.
+        send: ASGI send callable.
+    """
+    message = await receive()
+    if message["type"] != "websocket.connect":
+        return
+
+    if scope.get("path") != cfg.STREAMING_PATH:
+        await send({"type": "websocket.close", "code": 4404})
+        return
+
+    await send({"type": "websocket.accept"})
+
+    streams = get_stream_executor()
+    if not streams.reserve():
+        await send({"type": "websocket.close", "code": 1013})
+        return
+
+    try:
+        await _stream(streams, receive, send)
+    finally:
+        streams.release()
+
+
+def _read_settings(text: str, settings: dict) -> bool:
+    """ Applies a settings message to the settings of the stream.
+
+    Returns:
+        bool: True if the message is {"event": "stop"}.
+
+    Raises:
+        ValueError: If the message is not valid settings.
+    """
+    try:
+        data = json.loads(text)
+        if data.get("event") == "stop":
+            return True
+        sample_rate = int(data.get("sample_rate", settings["sample_rate"]))
+        language_code = str(data.get("language_code", settings["language_code"]))
+    except (TypeError, AttributeError) as ex:
+        raise ValueError(ex)
+    if sample_rate <= 0:
+        raise ValueError("Invalid sample rate {}".format(sample_rate))
+
+    settings.update(sample_rate=sample_rate, language_code=language_code)
+    return False
+
+
+async def _stream(streams: StreamExecutor, receive, send):
+    """ Receives the audio of an accepted connection and sends the hypotheses until it is stopped. """
+    loop = asyncio.get_event_loop()
+    frames = queue.Queue()
+    hypotheses = asyncio.Queue()
+    settings = {"sample_rate": cfg.SAMPLE_RATE, "language_code": "en"}
+    recognition = None
+    sender = None
+    code = 1000
+
+    try:
+        while True:
+            message = await receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("text"):
+                try:
+                    if _read_settings(message["text"], settings):
+                        break
+                except ValueError as ex:
+                    logging.warning("Invalid streaming message: %s", ex)
+                    code = 1003
+                    break
+
+            elif message.get("bytes"):
+                if recognition is None:
+                    # Start recognizing at the first frame so the settings message can arrive before it
+                    recognition = loop.run_in_executor(streams.executor, _recognize, get_recognizer(),
+                                                       frames, settings, loop, hypotheses)
+                    sender = asyncio.ensure_future(_send_hypotheses(send, hypotheses))
+                frames.put(message["bytes"])
+
+    finally:
+        frames.put(None)
+
+    disconnected = message["type"] == "websocket.disconnect"
+    if recognition is not None:
+        await recognition
+        if disconnected:
+            sender.cancel()
+        else:
+            await sender
+
+    if not disconnected:
+        await send({"type": "websocket.close", "code": code})
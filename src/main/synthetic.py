@@ -0,0 +1,65 @@
+""" Contains generators of synthetic test data: speech-like audio in several formats and pairs of transcripts with
+recognition errors. They are used by the benchmark and load test commands, so no recorded corpus is needed.
+"""
+
+import subprocess
+import numpy as np
+import src.recorder.settings as cfg
+
+ENCODER_ARGUMENTS = {'wav': ['-c:a', 'pcm_s16le', '-f', 'wav'], 'webm': ['-c:a', 'libopus', '-f', 'webm'],
+                     'mp3': ['-c:a', 'libmp3lame', '-f', 'mp3']}
+
+
+def synthesize_speech(duration: float, sample_rate: int = 16000, seed: int = 0) -> np.ndarray:
+    """ Generates speech-like audio: syllables of a few harmonics with a varying pitch, unvoiced noise bursts and
+    pauses between the "words".
+
+    Returns:
+        np.ndarray: Mono 16-bit samples.
+    """
+    rng = np.random.RandomState(seed)
+    samples = np.zeros(int(duration * sample_rate), dtype=np.float32)
+    position = 0
+    while position < len(samples):
+        for _ in range(rng.randint(1, 4)):
+            length = int(rng.uniform(0.12, 0.3) * sample_rate)
+            t = np.arange(length) / float(sample_rate)
+            pitch = rng.uniform(90, 220) * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(1, 4) * t))
+            phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+            syllable = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, 6))
+            if rng.rand() < 0.3:
+                syllable = syllable + rng.normal(0, 0.6, length)  # fricative
+            syllable *= np.hanning(length)
+            end = min(position + length, len(samples))
+            samples[position:end] = syllable[:end - position] * 0.25
+            position = end
+        position += int(rng.uniform(0.1, 0.5) * sample_rate)
+
+    return (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+
+
+def encode(samples: np.ndarray, sample_rate: int, fmt: str) -> bytes:
+    """ Encodes the samples as a wav, webm or mp3 file, raises a ValueError if FFMPEG fails. """
+    command = [cfg.FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-f', 's16le', '-ar', str(sample_rate),
+               '-ac', '1', '-i', 'pipe:0'] + ENCODER_ARGUMENTS[fmt] + ['pipe:1']
+    process = subprocess.run(command, input=samples.tobytes(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise ValueError("Could not encode the synthetic audio as {}: {}".format(
+            fmt, process.stderr.decode(errors='replace').strip()))
+    return process.stdout
+
+
+def synthesize_transcripts(size: int, error_rate: float = 0.15, seed: int = 0) -> tuple:
+    """ Generates a reference of size words and a hypothesis with substitutions, deletions and insertions. """
+    rng = np.random.RandomState(seed)
+    vocabulary = ["word{}".format(i) for i in range(max(10, size // 5))]
+    truth = [vocabulary[i] for i in rng.randint(0, len(vocabulary), size)]
+    hypothesis = []
+    for word in truth:
+        roll = rng.rand()
+        if roll < error_rate / 3:
+            continue
+        hypothesis.append(vocabulary[rng.randint(len(vocabulary))] if roll < 2 * error_rate / 3 else word)
+        if roll > 1 - error_rate / 3:
+            hypothesis.append(vocabulary[rng.randint(len(vocabulary))])
+    return truth, hypothesis
@@ -1,16 +1,82 @@
 """ Contains the tests for this application """
 
 import io
+import os
 from django.test import TestCase, RequestFactory
 from django.urls import reverse
 from pydub import AudioSegment
+from pydub.generators import Sine
 from src.recorder import settings as cfg
 from src.main.analyzer import *
+from src.main.audio import decode_audio, decode_audio_async, decode_file
+from src.main.probe import probe_audio, probe_header
+from src.main.recognizers import FakeRecognizer, RecognitionError, TransientRecognitionError
+from src.main.jobs import JobQueue, QueueFull
+import threading
+import tempfile
+import shutil
+import time
+import numpy as np
+from src.main.cache import TranscriptionCache, cache_key
+from src.main.transcripts import TranscriptStore, get_transcript_store
+from src.main.metrics import IncrementalScorer, align, score
+from src.main.scoring import SessionScorers
+from src.main.normalization import Normalizer, get_normalizer, split_words
+from src.main.media import MediaStore
+from src.main.audio import StreamingDecoder
+from src.main.uploads import DecodingUploadHandler
+from django.core.files.uploadhandler import StopFutureHandlers, StopUpload
+from django.apps import apps
+from django.core.management import call_command, CommandError
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.core.files.storage import FileSystemStorage
 import json
+import asyncio
+from unittest import mock
+from src.main.streaming import StreamExecutor, websocket_application
+from src.main.warmup import prepare_server, warm_up, STEPS
+from src.main.recognizers import get_recognizer
+from src.main.vad import detect_speech, trim_silence
+from src.main.encoding import Payload, encode_payload, encode_payload_async
+from src.main.segmentation import needs_segmentation, split_at_silence
+from src.main.recognizers import HttpRecognizer, LocalModelRecognizer, Recognizer, recognizer_stats
+from src.main.pool import ConcurrencyLimit, RecognizerPool
+from src.main.management.commands.fakerecognizer import make_server
+from src.main.management.commands.loadtest import SimulatedUser, Statistics, encode_multipart
+from src.main.management.commands.evaluate import score_utterance, summarize
+from django.core.files.base import ContentFile, File
+from src.main.admission import AdmissionController, Overloaded, estimate_duration
+from src.main.features import FeatureStore, compute_features, fix_frames
+from src.main.inference import LocalModel, MicroBatcher, ModelRegistry, load_keras_model
 
 
+_cache_directory = tempfile.TemporaryDirectory()
+_cache_patches = [
+    mock.patch.dict(cfg.TRANSCRIPTION_CACHE, {'DIRECTORY': os.path.join(_cache_directory.name, 'transcripts')}),
+    mock.patch.dict(cfg.FEATURE_STORE, {'DIRECTORY': os.path.join(_cache_directory.name, 'features')}),
+    # The cache of the process keeps the directory it was created with
+    mock.patch('src.main.cache._cache', None),
+]
+
+
+def setUpModule():
+    """ Keeps the transcription cache and the feature stores of the tests out of the source tree. """
+    for patch in _cache_patches:
+        patch.start()
+
+
+def tearDownModule():
+    for patch in reversed(_cache_patches):
+        patch.stop()
+    _cache_directory.cleanup()
+
+
+def tone(duration: float, frame_rate: int = 44100) -> AudioSegment:
+    """ A 440 Hz tone of duration milliseconds, the voice activity detection treats it as speech """
+    return Sine(440, sample_rate=frame_rate).to_audio_segment(duration=duration, volume=-10)
+
+
+@mock.patch.object(cfg, "ASR_BACKEND", "fake")
 class UnitTestCase(TestCase):
     """ Unit test class for main app """
 
@@ -28,7 +94,7 @@ class UnitTestCase(TestCase):
             cls.request.session.setdefault('context', json.load(jsonfile))
 
         # Set up test audio with proper length
-        cls.test_audio = AudioSegment.silent(duration=cfg.MIN_LEN * 1000 + 1)\
+        cls.test_audio = tone(duration=cfg.MIN_LEN * 1000 + 1)\
             .export(io.BytesIO(), format="wav")
         cls.test_audio.name = "testing.wav"
         cls.test_audio.seek(0)
@@ -91,6 +157,143 @@ class UnitTestCase(TestCase):
         if os.path.exists(file_path):
             os.remove(file_path)
 
+    def test_upload_decoded_while_received(self):
+        """ Uploads are decoded by the upload handler while they are received """
+        audio = self.test_audio
+        audio.name = "testing5.wav"
+        audio.seek(0)
+        with mock.patch.object(StreamingDecoder, "result", autospec=True,
+                               side_effect=StreamingDecoder.result) as result:
+            res = self.client.post(reverse("index"), {"audio_upload": audio, "reset": "true"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["text"], "The quick brown fox jumps over the lazy dog")
+        self.assertEqual(result.call_count, 1)
+
+    def test_upload_rejected_while_received(self):
+        """ Too short and invalid uploads are rejected before the rest of the body is read """
+        def handler():
+            upload_handler = DecodingUploadHandler(RequestFactory().post("/"))
+            upload_handler.handle_raw_input(None, {}, 10 ** 7, "boundary")
+            with self.assertRaises(StopFutureHandlers):
+                upload_handler.new_file("audio_upload", "upload.wav", "audio/wav", None)
+            return upload_handler
+
+        short = tone(duration=1000).export(io.BytesIO(), format="wav").getvalue()
+        upload_handler = handler()
+        with self.assertRaises(StopUpload):
+            upload_handler.receive_data_chunk(short[:65536], 0)
+        self.assertIn("too short", upload_handler.request.upload_error)
+
+        upload_handler = handler()
+        with self.assertRaises(StopUpload):
+            for chunk in range(200):
+                upload_handler.receive_data_chunk(os.urandom(65536), chunk * 65536)
+                time.sleep(0.01)
+        self.assertIn("could not be decoded", upload_handler.request.upload_error)
+
+    def test_home_post_async(self):
+        """ Test queued audio processing and polling for the job result (POST + GET) """
+        audio = self.test_audio
+        audio.name = "testing3.wav"
+        audio.seek(0)
+
+        res = self.client.post(reverse("index"), {"audio_upload": audio, "async": "true", "reset": "true"})
+        self.assertEqual(res.status_code, 202)
+
+        job_id = res.json()["job"]
+        res = self.client.get(reverse("job_status", args=[job_id]), {"wait": 10})
+        self.assertEqual(res.json()["status"], "done")
+        self.assertEqual(res.json()["text"], "The quick brown fox jumps over the lazy dog")
+        self.assertGreaterEqual(res.json()["timings"]["total"], res.json()["timings"]["running"])
+
+        # Jobs of other sessions are not visible
+        self.client.cookies.clear()
+        self.assertEqual(self.client.get(reverse("job_status", args=[job_id])).status_code, 404)
+
+        file_path = os.path.join(cfg.MEDIA_ROOT, audio.name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_server_timing_and_metrics(self):
+        """ Uploads report their stages in a Server-Timing header and the histograms are exposed at /metrics """
+        audio = self.test_audio
+        audio.name = "testing4.wav"
+        audio.seek(0)
+        with mock.patch.dict(cfg.TRANSCRIPTION_CACHE, {'ENABLED': False}):
+            res = self.client.post(reverse("index"), {"audio_upload": audio, "reset": "true"})
+
+        stages = [timing.split(";")[0] for timing in res["Server-Timing"].split(", ")]
+        for stage in ("save", "decode", "vad", "recognize", "transcript", "session", "total"):
+            self.assertIn(stage, stages)
+
+        res = self.client.get(reverse("metrics"))
+        self.assertEqual(res.status_code, 200)
+        body = res.content.decode()
+        self.assertIn('speech_stage_seconds_bucket{stage="decode",le="+Inf"}', body)
+        self.assertIn('speech_request_seconds_count{method="POST",view="index"}', body)
+        self.assertIn('speech_job_queue{state="queued"}', body)
+
+        file_path = os.path.join(cfg.MEDIA_ROOT, audio.name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def test_job_queue_full(self):
+        """ The job queue refuses jobs when it is full """
+        jobs = JobQueue(workers=1, max_size=1, result_ttl=60)
+        release = threading.Event()
+        first = jobs.submit(release.wait)
+        time.sleep(0.1)
+        second = jobs.submit(lambda: 42)
+
+        with self.assertRaises(QueueFull):
+            jobs.submit(lambda: 42)
+
+        release.set()
+        self.assertTrue(second.wait(5))
+        self.assertEqual((first.status, second.status, second.result), ("done", "done", 42))
+
+    def test_job_queue_applies_in_order(self):
+        """ The results of an owner are applied once each, in submission order, early results are held back """
+        jobs = JobQueue(workers=2, max_size=4, result_ttl=60)
+        release = threading.Event()
+        first = jobs.submit(lambda: release.wait(5) and "first", owner="session")
+        second = jobs.submit(lambda: "second", owner="session")
+        other = jobs.submit(lambda: "other", owner="other session")
+        self.assertTrue(second.wait(5) and other.wait(5))
+
+        applied = []
+        self.assertIs(jobs.apply(second, lambda job: applied.append(job.result)), first)
+        self.assertIsNone(jobs.apply(other, lambda job: applied.append(job.result)))
+        self.assertEqual(applied, ["other"])
+
+        release.set()
+        self.assertTrue(first.wait(5))
+        self.assertIsNone(jobs.apply(second, lambda job: applied.append(job.result)))
+        self.assertIsNone(jobs.apply(first, lambda job: applied.append(job.result)))
+        self.assertEqual(applied, ["other", "first", "second"])
+
+    def test_analyzer_calculate_metrics(self):
+        """ Analyzer derives all metrics from one word alignment """
+        context = calculate_metrics({}, "a b c d".split(), "a x c d e".split())
+        self.assertEqual((context["hits"], context["substitutions"], context["deletions"], context["insertions"]),
+                         (3, 1, 0, 1))
+        self.assertEqual((context["wer"], context["wcr"]), (0.5, 0.75))
+        self.assertEqual((context["precision_micro"], context["recall_micro"], context["f1_micro"]), (0.6, 0.75, 0.67))
+
+        # An insertion at the start does not shift all following words out of place
+        context = calculate_metrics({}, "the cat sat".split(), "so the cat sat".split())
+        self.assertEqual((context["precision_micro"], context["recall_micro"]), (0.75, 1.0))
+        self.assertEqual((context["precision_macro"], context["recall_macro"]), (0.75, 1.0))
+
+        # Empty transcripts do not raise
+        self.assertEqual(calculate_metrics({}, [], [])["wer"], 0.0)
+
+        # Any word ids can be aligned, also ids of the surrogate range and beyond the Unicode range
+        alignment = align(np.array([0xD800, 2 ** 40, 5]), np.array([0xD800, 5]))
+        self.assertEqual((alignment.hits, alignment.deletions, alignment.truth_hits.tolist()),
+                         (2, 1, [True, False, True]))
+
     def test_info_page(self):
         """ Test info page (GET) """
         # Test info page existence
@@ -101,12 +304,188 @@ class UnitTestCase(TestCase):
     # analyzer.py Tests
 
     def test_analyzer_save_audio_upload(self):
-        """ Analyzer save a wav file with save_recording() """
+        """ Analyzer keeps large uploads in the media store with save_recording(), short ones only in memory """
+        with tempfile.TemporaryDirectory() as directory:
+            store = MediaStore(directory, ttl=60, max_bytes=10 ** 9)
+            self.test_audio.seek(0)
+            context, audio = save_recording(self.request.session['context'], self.test_audio, False, store=store)
+            self.assertIsNone(context["to_be_analyzed"])
+            self.assertAlmostEqual(audio.duration, cfg.MIN_LEN + 0.001, places=2)
+
+            with mock.patch.dict(cfg.MEDIA, {'SPOOL_MAX_BYTES': 0}):
+                self.test_audio.seek(0)
+                context, _ = save_recording({}, self.test_audio, False, store=store)
+                self.assertTrue(os.path.exists(context["to_be_analyzed"]))
+                self.assertTrue(context["to_be_analyzed"].endswith(".wav"))
+
+                # The same upload is stored once
+                self.test_audio.seek(0)
+                duplicate, _ = save_recording({}, self.test_audio, False, store=store)
+                self.assertEqual(duplicate["to_be_analyzed"], context["to_be_analyzed"])
+            self.assertEqual(store.stats()["stored"], 1)
+            self.assertEqual(store.stats()["deduplicated"], 1)
+            self.assertEqual(store.stats()["spooled"], 1)
+
+    def test_analyzer_decode_audio(self):
+        """ Analyzer decodes wav and mp3 in memory to mono PCM at the configured sample rate """
+        for fmt in ("wav", "mp3"):
+            data = AudioSegment.silent(duration=1000, frame_rate=22050).export(io.BytesIO(), format=fmt).getvalue()
+            audio = decode_audio(data)
+            self.assertEqual(audio.sample_rate, cfg.SAMPLE_RATE)
+            self.assertAlmostEqual(audio.duration, 1.0, delta=0.1)
+            self.assertEqual(get_audio_features(audio), (audio.sample_rate, audio.duration))
+
+        with self.assertRaises(ValueError):
+            decode_audio(b"definitely not audio")
+
+    def test_decode_mp4(self):
+        """ MP4 files with the index at the end are decoded from a seekable file, not from the pipe """
+        data = tone(5000).set_channels(2).export(io.BytesIO(), format="ipod", codec="aac", bitrate="256k").getvalue()
+        self.assertGreater(data.find(b"moov"), data.find(b"mdat"))
+        self.assertAlmostEqual(decode_audio(data).duration, 5.0, delta=0.1)
+        self.assertAlmostEqual(asyncio.run(decode_audio_async(data)).duration, 5.0, delta=0.1)
+
+        decoder = StreamingDecoder(name="upload.m4a")
+        for start in range(0, len(data), 65536):
+            self.assertTrue(decoder.feed(data[start:start + 65536]))
+        self.assertAlmostEqual(decoder.result(source=data).duration, 5.0, delta=0.1)
+
+    def test_analyzer_probe_audio(self):
+        """ Analyzer reads sample rate and duration from the file header """
+        for fmt, codec in (("wav", "wav"), ("mp3", "mp3"), ("flac", "flac"), ("webm", "opus"), ("ogg", "opus")):
+            f = AudioSegment.silent(duration=3000, frame_rate=16000)\
+                .export(io.BytesIO(), format=fmt, codec="libopus" if fmt in ("webm", "ogg") else None)
+            file_path = os.path.join(cfg.MEDIA_ROOT, "input", FileSystemStorage(os.path.join(cfg.MEDIA_ROOT, "input"))
+                                     .save("probe." + fmt, f))
+            info = probe_audio(file_path)
+
+            self.assertIn(codec, info.codec)
+            self.assertAlmostEqual(info.duration, 3.0, delta=0.1)
+            self.assertEqual(get_audio_features(file_path)[1], info.duration)
+            os.remove(file_path)
+
+    def test_probe_untrusted_mp3(self):
+        """ Data that only looks like an MPEG frame here and there is not probed as MP3 """
+        m4a = tone(10000).export(io.BytesIO(), format="ipod", codec="aac").getvalue()
+        adts = tone(10000).export(io.BytesIO(), format="adts").getvalue()
+        for data, name in ((m4a, "upload.m4a"), (adts, "upload.aac"), (os.urandom(1 << 18), "upload.mp3"),
+                           (m4a, "upload.mp3")):
+            info = probe_header(data, name=name)
+            self.assertTrue(info is None or not info.from_header, name)
+
+        mp3 = tone(3000).export(io.BytesIO(), format="mp3", tags={"title": "tone"}).getvalue()
+        self.assertEqual(mp3[:3], b"ID3")
+        self.assertAlmostEqual(probe_header(mp3).duration, 3.0, delta=0.1)
+        # Without the tag the frames have to follow each other
+        frames = mp3[mp3.index(b"\xff\xfb"):]
+        self.assertIsNone(probe_header(frames, name="blob"))
+        self.assertAlmostEqual(probe_header(frames, content_type="audio/mpeg").duration, 3.0, delta=0.2)
+
+    def test_analyzer_speech_to_text_fake_backend(self):
+        """ Analyzer recognizes audio with the offline stand-in backend """
+        audio = decode_audio(tone(duration=3000).export(io.BytesIO(), format="wav").getvalue())
+        text, rtf = speech_to_text(audio)
+
+        self.assertEqual(text, "the quick brown fox jumps over the lazy dog")
+        self.assertGreaterEqual(rtf, 0)
+
+    def test_voice_activity_detection(self):
+        """ Silence around speech is trimmed and audio without speech is not recognized """
+        segment = AudioSegment.silent(duration=1000) + tone(duration=1000) + AudioSegment.silent(duration=1000)
+        audio = decode_audio(segment.export(io.BytesIO(), format="wav").getvalue())
+        trimmed, activity = trim_silence(audio)
+
+        self.assertTrue(activity.has_speech)
+        self.assertAlmostEqual(trimmed.duration, 1 + 2 * cfg.VAD['PADDING_MS'] / 1000, delta=0.05)
+        self.assertAlmostEqual(activity.speech_duration, trimmed.duration)
+
+        silence = decode_audio(AudioSegment.silent(duration=3000).export(io.BytesIO(), format="wav").getvalue())
+        self.assertFalse(detect_speech(silence).has_speech)
+        with mock.patch("src.main.recognizers.FakeRecognizer.recognize") as recognize:
+            self.assertEqual(speech_to_text(silence, use_cache=False), ("", 0.0))
+            recognize.assert_not_called()
+
+    def test_segmentation(self):
+        """ Long audio is split at silence, the segments are recognized concurrently and stitched in order """
+        quiet = AudioSegment.silent(duration=1000)
+        segment = tone(duration=3000) + quiet + tone(duration=3000) + quiet + tone(duration=3000)
+        audio = decode_audio(segment.export(io.BytesIO(), format="wav").getvalue(), mapped=True)
+
+        with mock.patch.dict(cfg.SEGMENTATION, {'MIN_SECONDS': 1, 'MAX_SECONDS': 5}):
+            self.assertTrue(needs_segmentation(audio))
+            bounds = [(start / audio.sample_rate, end / audio.sample_rate) for start, end in split_at_silence(audio)]
+            self.assertEqual(len(bounds), 3)
+            self.assertAlmostEqual(bounds[0][1], 3.0, delta=0.1)
+            self.assertAlmostEqual(bounds[1][1], 7.0, delta=0.1)
+            self.assertEqual(bounds[2][1], audio.duration)
+
+            text, rtf, segments = segmented_speech_to_text(audio, use_cache=False)
+
+        self.assertEqual([segment.index for segment in segments], [0, 1, 2])
+        self.assertEqual([segment.start for segment in segments], [0.0] + [segment.end for segment in segments[:-1]])
+        self.assertEqual(text, " ".join(segment.text for segment in segments))
+        self.assertEqual(text.split(), "the quick brown fox jumps over the lazy dog".split() * 3)
+
+    def test_payload_encoding(self):
+        """ Recorded Opus is passed through, other audio is sent as FLAC or PCM, whatever the backend accepts """
+        segment = AudioSegment.silent(duration=500) + tone(duration=2000, frame_rate=48000)
+        recording = decode_audio(segment.export(io.BytesIO(), format="webm", codec="libopus").getvalue())
+        speech, _ = trim_silence(recording)
+
+        opus = encode_payload(speech, ("OGG_OPUS", "FLAC", "LINEAR16"))
+        self.assertEqual(opus.encoding, "OGG_OPUS")
+        self.assertLess(len(opus.data), len(speech.pcm) / 3)
+        self.assertAlmostEqual(decode_audio(opus.data).duration, speech.duration, delta=0.05)
+
+        flac = encode_payload(speech, ("FLAC", "LINEAR16"))
+        self.assertEqual(flac.encoding, "FLAC")
+        self.assertEqual(decode_audio(flac.data).pcm, speech.pcm)
+
+        pcm = encode_payload(speech, ("LINEAR16",))
+        self.assertEqual((pcm.data, pcm.sample_rate), (speech.pcm, cfg.SAMPLE_RATE))
+
+    def test_fake_recognizer(self):
+        """ The stand-in backend is deterministic and fails at the configured error rate """
+        audio = decode_audio(AudioSegment.silent(duration=1000).export(io.BytesIO(), format="wav").getvalue())
+        recognizer = FakeRecognizer(transcripts=["one", "two", "three"], error_rate=0.5, seed=1)
+        texts, errors = set(), 0
+        for _ in range(100):
+            try:
+                texts.add(recognizer.recognize(audio))
+            except RecognitionError:
+                errors += 1
+
+        self.assertEqual(len(texts), 1)
+        self.assertTrue(30 < errors < 70)
 
-        _, file_path = save_recording(self.request.session['context'], self.test_audio, False)
-        exists = os.path.exists(file_path)
-        self.assertTrue(exists)
-        os.remove(file_path)
+    def test_fake_recognizer_seed(self):
+        """ Stand-ins without a seed draw their own latencies, the backend is built once """
+        first, second = FakeRecognizer(latency=1.0, jitter=0.5), FakeRecognizer(latency=1.0, jitter=0.5)
+        self.assertNotEqual([first._latency(0.0) for _ in range(5)], [second._latency(0.0) for _ in range(5)])
+        self.assertIs(get_recognizer("fake"), get_recognizer("fake"))
+
+    def test_warm_up(self):
+        """ Every warm-up step runs and the recognizer is shared afterwards """
+        timings = warm_up()
+
+        self.assertEqual(list(timings), list(STEPS))
+        self.assertNotIn(None, timings.values())
+        self.assertIs(get_recognizer(), get_recognizer())
+
+    def test_prepare_server(self):
+        """ Servers warm up when they load the application, in the forked workers if the master preloads """
+        with mock.patch('src.main.warmup.warm_up') as warm, mock.patch('os.register_at_fork') as register, \
+                self.settings(WARM_UP=True, PRELOAD_MODELS=False):
+            prepare_server()
+            warm.assert_called_once_with()
+            register.assert_not_called()
+
+        with mock.patch('src.main.warmup.warm_up') as warm, mock.patch('os.register_at_fork') as register, \
+                mock.patch('src.main.inference.preload_model_libraries'), \
+                self.settings(WARM_UP=True, PRELOAD_MODELS=True):
+            prepare_server()
+            warm.assert_not_called()
+            register.assert_called_once_with(after_in_child=warm)
 
     def test_analyzer_check_audio_length(self):
         # Test proper length audio file
@@ -117,11 +496,1118 @@ class UnitTestCase(TestCase):
                         .export(io.BytesIO(), format="wav")
         f.name = "testing2.wav"
         f.seek(0)
-        _, file_path = save_recording(self.request.session['context'], f, False)
-        check2 = check_audio_length(file_path)
+        context, audio = save_recording(self.request.session['context'], f, False)
+        check2 = check_audio_length(audio)
 
         self.assertTrue(check1)
         self.assertFalse(check2)
 
-        if os.path.exists(file_path):
-            os.remove(file_path)
+
+class StreamingTestCase(TestCase):
+    """ Tests for the streaming transcription WebSocket endpoint """
+
+    def run_websocket(self, messages: list, path: str = cfg.STREAMING_PATH) -> list:
+        """ Runs the websocket application with the given client messages and returns what it sent """
+        received = asyncio.Queue()
+        for message in messages:
+            received.put_nowait(message)
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        with mock.patch.object(cfg, "ASR_BACKEND", "fake"):
+            asyncio.new_event_loop().run_until_complete(
+                websocket_application({"type": "websocket", "path": path}, received.get, send))
+        return sent
+
+    def test_streaming_partial_and_final(self):
+        """ Partial hypotheses are sent while audio arrives, followed by a final one """
+        frame = b"\0\0" * 1600
+        sent = self.run_websocket([{"type": "websocket.connect"},
+                                   {"type": "websocket.receive", "text": json.dumps({"sample_rate": 16000})}] +
+                                  [{"type": "websocket.receive", "bytes": frame}] * 20 +
+                                  [{"type": "websocket.receive", "text": json.dumps({"event": "stop"})}])
+
+        self.assertEqual(sent[0]["type"], "websocket.accept")
+        self.assertEqual(sent[-1]["type"], "websocket.close")
+        results = [json.loads(message["text"]) for message in sent if message["type"] == "websocket.send"]
+        self.assertEqual(results[0], {"type": "partial", "text": "the"})
+        self.assertEqual(results[-1], {"type": "final", "text": "the quick brown fox jumps"})
+
+    def test_streaming_unknown_path(self):
+        """ Connections to other paths are refused """
+        sent = self.run_websocket([{"type": "websocket.connect"}], path="/other")
+        self.assertEqual(sent, [{"type": "websocket.close", "code": 4404}])
+
+    def test_streaming_invalid_messages(self):
+        """ Text messages that are not valid settings close the connection with 1003 """
+        for text in ("not json", json.dumps({"sample_rate": "fast"}), json.dumps([1]), json.dumps({"sample_rate": 0})):
+            sent = self.run_websocket([{"type": "websocket.connect"},
+                                       {"type": "websocket.receive", "bytes": b"\0\0" * 1600},
+                                       {"type": "websocket.receive", "text": text}])
+            self.assertEqual(sent[-1], {"type": "websocket.close", "code": 1003}, text)
+
+    def test_streaming_limit(self):
+        """ Connections beyond STREAMING_MAX_STREAMS are closed with 1013, their threads are released """
+        streams = StreamExecutor(1)
+        with mock.patch("src.main.streaming._executor", streams):
+            self.assertTrue(streams.reserve())
+            sent = self.run_websocket([{"type": "websocket.connect"}])
+            self.assertEqual(sent, [{"type": "websocket.accept"}, {"type": "websocket.close", "code": 1013}])
+
+            streams.release()
+            sent = self.run_websocket([{"type": "websocket.connect"},
+                                       {"type": "websocket.receive", "text": json.dumps({"event": "stop"})}])
+            self.assertEqual(sent[-1], {"type": "websocket.close", "code": 1000})
+            self.assertTrue(streams.reserve())
+
+
+class EvaluateCommandTestCase(TestCase):
+    """ Tests for the evaluate management command """
+
+    def test_evaluate_corpus_directory(self):
+        """ Every utterance gets a row and the corpus metrics are reported """
+        with tempfile.TemporaryDirectory() as corpus:
+            for i, reference in enumerate(["the quick brown fox", "jumps over the lazy dog"]):
+                tone(duration=1000 * (i + 1)).export(os.path.join(corpus, "{}.wav".format(i)), format="wav")
+                with open(os.path.join(corpus, "{}.txt".format(i)), "w") as text_file:
+                    text_file.write(reference)
+            output_path = os.path.join(corpus, "results.jsonl")
+            out = io.StringIO()
+
+            call_command("evaluate", corpus, output=output_path, workers=2, backend="fake", stdout=out)
+
+            with open(output_path) as output:
+                rows = [json.loads(line) for line in output]
+            summary = json.loads(out.getvalue())
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row["id"] for row in rows}, {"0", "1"})
+        self.assertEqual(summary["utterances"], 2)
+        self.assertEqual(summary["audio_seconds"], 3.0)
+        self.assertIn("rtf_p95", summary)
+        self.assertLess(summary["wer_micro_avg"], summary["wer_macro_avg"])
+
+    def test_summarize_from_counts(self):
+        """ Micro averages are calculated from the summed alignment counts, not from rounded ratios """
+        normalizer = get_normalizer()
+        truth = normalizer.ids("one two three")
+        rows = [score_utterance({'id': str(i), 'rtf': 0.1, 'duration': 1.0, 'hypothesis': "one two four"}, truth,
+                                normalizer) for i in range(2)]
+        self.assertEqual(rows[0]['wer'], 0.33)
+
+        summary = summarize(rows)
+        self.assertEqual((summary["hits"], summary["substitutions"]), (4, 2))
+        self.assertEqual((summary["wer_micro_avg"], summary["wcr_micro_avg"]), (0.3333, 0.6667))
+        self.assertEqual(summary["f1_micro_micro_avg"], 0.6667)
+
+
+class BenchmarkCommandTestCase(TestCase):
+    """ Tests for the benchmark management command """
+
+    def test_benchmark_baseline_and_regression(self):
+        """ Results are stored as a baseline and a slower run fails, a run without a baseline fails too """
+        with tempfile.TemporaryDirectory() as directory:
+            baseline_path = os.path.join(directory, "baseline.json")
+            with self.assertRaisesMessage(CommandError, "No baseline found"):
+                call_command("benchmark", quick=True, repeat=1, baseline=baseline_path,
+                             stdout=io.StringIO(), stderr=io.StringIO())
+
+            call_command("benchmark", quick=True, repeat=1, baseline=baseline_path, save_baseline=True,
+                         stdout=io.StringIO(), stderr=io.StringIO())
+            with open(baseline_path) as baseline_file:
+                baseline = json.load(baseline_file)
+            self.assertIn("save_recording/5s.webm", baseline["results"])
+            self.assertIn("calculate_metrics/100_words", baseline["results"])
+
+            # A baseline that is a lot faster makes the current run a regression
+            for timing in baseline["results"].values():
+                timing["median"] /= 1000
+            with open(baseline_path, "w") as baseline_file:
+                json.dump(baseline, baseline_file)
+            with self.assertRaisesMessage(CommandError, "Performance regression"):
+                call_command("benchmark", quick=True, repeat=1, baseline=baseline_path,
+                             stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class LoadTestingTestCase(TestCase):
+    """ Tests for the stand-in recognition service and the load test helpers """
+
+    def serve(self, recognizer: FakeRecognizer) -> HttpRecognizer:
+        server = make_server("127.0.0.1", 0, recognizer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return HttpRecognizer("http://{}:{}/recognize".format(*server.server_address), timeout=5)
+
+    def test_http_recognizer(self):
+        """ Audio is posted to the service and its transcript is returned """
+        recognizer = self.serve(FakeRecognizer(transcripts=["hello world"]))
+        audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+        self.assertEqual(recognizer.recognize(audio), "hello world")
+
+    def test_http_recognizer_failure(self):
+        """ Injected failures of the service (503) are transient, rejected requests are not """
+        recognizer = self.serve(FakeRecognizer(transcripts=["hello world"], error_rate=1.0))
+        audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+        with self.assertRaises(TransientRecognitionError):
+            recognizer.recognize(audio)
+        with self.assertRaises(TransientRecognitionError):
+            asyncio.run(recognizer.recognize_async(audio))
+
+        # The service can not decode the audio (400)
+        with mock.patch("src.main.recognizers.encode_payload", return_value=Payload(b"not audio", "FLAC", 16000)):
+            with self.assertRaises(RecognitionError) as failure:
+                recognizer.recognize(audio)
+        self.assertNotIsInstance(failure.exception, TransientRecognitionError)
+
+    def test_latency_distributions(self):
+        """ Unknown latency distributions are refused """
+        with self.assertRaises(ValueError):
+            FakeRecognizer(distribution="pareto")
+
+    def test_chunk_schedule(self):
+        """ Simulated users send their chunks on schedule while earlier ones are slow, and score after all of them """
+        sent = []
+
+        def request(endpoint, path, fields=None, files=None):
+            sent.append((endpoint, time.time()))
+            if endpoint == "index:get":
+                return 200, b'CSRF_TOKEN = "token"'
+            if endpoint == "index:audio_recording":
+                time.sleep(0.3)
+            return 200, b'{}'
+
+        statistics = Statistics()
+        user = SimulatedUser("http://testserver", [b"chunk"], {"chunks": 3, "chunk_seconds": 0.05, "timeout": 5},
+                             statistics, 0)
+        with mock.patch.object(user, "request", side_effect=request):
+            user.run(time.time() + 0.5)
+
+        endpoints = [endpoint for endpoint, _ in sent]
+        self.assertEqual(endpoints[:5], ["index:get"] + ["index:audio_recording"] * 3 + ["index:text_upload"])
+        chunks = [at for endpoint, at in sent if endpoint == "index:audio_recording"]
+        self.assertLess(chunks[-1] - chunks[0], 0.2)
+        self.assertGreater(sent[4][1] - chunks[-1], 0.25)
+        self.assertEqual(statistics.report(1.0)["transcription"]["requests"], 3)
+
+    def test_multipart_upload(self):
+        """ The simulated uploads are accepted by the view like the ones of the recorder """
+        audio = tone(1000).export(io.BytesIO(), format="wav").getvalue()
+        body, content_type = encode_multipart({"async": "false", "reset": "true"}, {"audio_recording": ("blob", audio)})
+        with mock.patch.object(cfg, "ASR_BACKEND", "fake"):
+            response = self.client.post(reverse("index"), body, content_type=content_type)
+        self.assertEqual(response.status_code, 200)
+
+    def test_statistics(self):
+        """ Percentiles and error rates are reported per endpoint """
+        statistics = Statistics()
+        for number in range(100):
+            statistics.add("jobs", (number + 1) / 1000, number % 10 != 0)
+        report = statistics.report(10.0)
+        self.assertEqual(report["jobs"]["requests"], 100)
+        self.assertEqual(report["jobs"]["per_second"], 10.0)
+        self.assertEqual(report["jobs"]["error_rate"], 0.1)
+        self.assertAlmostEqual(report["jobs"]["p50"], 50.5, places=1)
+        self.assertLessEqual(report["jobs"]["p95"], report["jobs"]["p99"])
+
+
+
+class AsyncViewsTestCase(TestCase):
+    """ Tests for the async pipeline of the views """
+
+    def test_decode_audio_async(self):
+        """ The audio decoded by the async subprocess is the same as the blocking one """
+        data = tone(1000).export(io.BytesIO(), format="wav").getvalue()
+        audio = asyncio.run(decode_audio_async(data, name="tone.wav"))
+        self.assertTrue((audio.samples == decode_audio(data, name="tone.wav").samples).all())
+        with self.assertRaises(ValueError):
+            asyncio.run(decode_audio_async(b"not audio"))
+
+    def test_encode_payload_async(self):
+        """ The async encoder produces the same payload as the blocking one """
+        audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+        accepted = ("FLAC", "LINEAR16")
+        self.assertEqual(asyncio.run(encode_payload_async(audio, accepted)), encode_payload(audio, accepted))
+
+    def test_concurrent_recognitions(self):
+        """ Requests to the recognizer wait concurrently instead of one thread each """
+        recognizer = FakeRecognizer(transcripts=["hello"], latency=0.2)
+        audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+
+        async def recognize_all():
+            return await asyncio.gather(*(recognizer.recognize_async(audio) for _ in range(100)))
+
+        start = time.perf_counter()
+        self.assertEqual(asyncio.run(recognize_all()), ["hello"] * 100)
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+    def test_invalid_http_responses(self):
+        """ Empty or malformed answers of the recognition service are recognition errors """
+        audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+
+        async def recognize(response: bytes):
+            async def answer(reader, writer):
+                await reader.read(1)
+                writer.write(response)
+                await writer.drain()
+                writer.close()
+
+            server = await asyncio.start_server(answer, "127.0.0.1", 0)
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                recognizer = HttpRecognizer("http://127.0.0.1:{}/recognize".format(port), timeout=5)
+                return await recognizer.recognize_async(audio)
+
+        for response in (b"", b"garbage", b"HTTP/1.0 abc OK\r\n\r\n", b"HTTP/1.0 200 OK\r\n"):
+            with self.assertRaises(RecognitionError):
+                asyncio.run(recognize(response))
+        self.assertEqual(asyncio.run(recognize(b'HTTP/1.0 200 OK\r\n\r\n{"text": "hello"}')), "hello")
+
+    def test_job_wait_async(self):
+        """ A job can be awaited without blocking the event loop """
+        queue = JobQueue(workers=1, max_size=2, result_ttl=60)
+        release = threading.Event()
+        job = queue.submit(lambda: release.wait(5) and "done")
+
+        async def wait():
+            self.assertFalse(await job.wait_async(0.05))
+            release.set()
+            return await job.wait_async(5)
+
+        self.assertTrue(asyncio.run(wait()))
+        self.assertEqual(job.result, "done")
+
+    @staticmethod
+    async def asgi_request(method: str, headers: list = (), body: bytes = b"") -> tuple:
+        """ Sends a request to the ASGI application, returns the status, the headers and the body. """
+        from src.recorder.asgi import application
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+                 "path": "/", "raw_path": b"/", "query_string": b"", "root_path": "", "server": ("testserver", 80),
+                 "client": ("127.0.0.1", 1234), "headers": [(b"host", b"testserver")] + list(headers)}
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await application(scope, receive, send)
+        return sent[0]["status"], sent[0]["headers"], b"".join(message.get("body", b"") for message in sent[1:])
+
+    async def test_asgi_upload(self):
+        """ A recording posted to the async view through the ASGI application is transcribed, with the CSRF check """
+        body, content_type = encode_multipart({"reset": "true"}, {
+            "audio_recording": ("blob", tone(1000).export(io.BytesIO(), format="wav").getvalue())})
+        headers = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+
+        status, _, _ = await self.asgi_request("POST", headers, body)
+        self.assertEqual(status, 403)
+
+        status, page_headers, _ = await self.asgi_request("GET")
+        self.assertEqual(status, 200)
+        cookies = [value.split(b";")[0] for name, value in page_headers if name.lower() == b"set-cookie"]
+        token = next(cookie.split(b"=", 1)[1] for cookie in cookies if cookie.startswith(b"csrftoken="))
+        headers += [(b"cookie", b"; ".join(cookies)), (b"x-csrftoken", token)]
+
+        with mock.patch.object(cfg, "ASR_BACKEND", "fake"):
+            status, _, response = await self.asgi_request("POST", headers, body)
+        self.assertEqual(status, 200)
+        self.assertIn("text", json.loads(response.decode()))
+
+class TranscriptionCacheTestCase(TestCase):
+    """ Tests for the transcription cache """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = TranscriptionCache(max_entries=2, ttl=60, directory=self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lru_and_disk_tier(self):
+        """ The memory tier evicts the least recently used entry, the disk tier still has it """
+        for key in ("a", "b", "c"):
+            self.cache.set(key, key.upper())
+
+        self.assertEqual(list(self.cache.memory), ["b", "c"])
+        self.assertEqual(self.cache.get("a"), "A")
+        self.assertEqual(self.cache.stats()["disk_hits"], 1)
+        self.assertEqual(self.cache.stats()["evictions"], 2)
+
+        # Other workers share the disk tier
+        other = TranscriptionCache(max_entries=2, ttl=60, directory=self.directory.name)
+        self.assertEqual(other.get("b"), "B")
+
+    def test_ttl(self):
+        """ Expired entries are not served """
+        cache = TranscriptionCache(max_entries=2, ttl=-1, directory=self.directory.name)
+        cache.set("a", "A")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 2)
+
+    def test_collect(self):
+        """ The collector removes expired entries from the disk tier, then the oldest ones until it fits """
+        for key in ("aa", "bb", "cc"):
+            self.cache.set(key, key)
+        size = {key: os.path.getsize(self.cache._path(key)) for key in ("aa", "bb", "cc")}
+        os.utime(self.cache._path("aa"), (time.time() - 120, time.time() - 120))
+        os.utime(self.cache._path("bb"), (time.time() - 30, time.time() - 30))
+
+        self.cache.max_bytes = size["cc"]
+        self.assertEqual(self.cache.collect(), {"removed": 2, "freed_bytes": size["aa"] + size["bb"]})
+        self.assertTrue(os.path.exists(self.cache._path("cc")))
+        stats = self.cache.stats()
+        self.assertEqual((stats["disk_entries"], stats["disk_bytes"], stats["disk_removals"]), (1, size["cc"], 2))
+
+    def test_coalescing(self):
+        """ Concurrent requests for the same key call the recognizer once """
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return "text"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_compute("key", compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("text", False)] + [("text", True)] * 4)
+
+    def test_cache_key(self):
+        """ The key depends on the audio, backend and language """
+        audio = decode_audio(AudioSegment.silent(duration=100).export(io.BytesIO(), format="wav").getvalue())
+        self.assertEqual(cache_key(audio, "fake", "en"), cache_key(audio, "fake", "en"))
+        self.assertNotEqual(cache_key(audio, "fake", "en"), cache_key(audio, "fake", "nl"))
+        self.assertNotEqual(cache_key(audio, "fake", "en"), cache_key(audio, "dialogflow", "en"))
+
+
+class MediaStoreTestCase(TestCase):
+    """ Tests for the content addressed media store and its collector """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = MediaStore(self.directory.name, ttl=60, max_bytes=25)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_content_addressed(self):
+        """ Files are named by their content, so duplicates share one file """
+        first = self.store.save(b"0123456789", "one.WEBM")
+        self.assertEqual(first, self.store.save(b"0123456789", "two.webm"))
+        self.assertNotEqual(first, self.store.save(b"9876543210", "one.webm"))
+        self.assertTrue(first.endswith(".webm"))
+        self.assertNotIn("..", self.store.save(b"x", "../../evil.sh;rm"))
+
+    def test_collect(self):
+        """ Expired files are removed first, then the oldest files until the store fits """
+        expired = self.store.path(self.store.save(b"a" * 10))
+        oldest = self.store.path(self.store.save(b"b" * 10))
+        newest = self.store.path(self.store.save(b"c" * 10))
+        os.utime(expired, (time.time() - 120, time.time() - 120))
+        os.utime(oldest, (time.time() - 30, time.time() - 30))
+
+        self.assertEqual(self.store.collect(), {"removed": 1, "freed_bytes": 10})
+        self.assertFalse(os.path.exists(expired))
+
+        self.store.save(b"d" * 10)
+        self.assertEqual(self.store.collect()["removed"], 1)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(newest))
+        self.assertEqual(self.store.stats()["files"], 2)
+        self.assertEqual(self.store.stats()["bytes"], 20)
+
+    def test_kept_uploads_are_streamed(self):
+        """ Uploads that are kept are copied in chunks and decoded from the stored file, never read whole """
+        reads = []
+
+        class Upload(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return super().read(size)
+
+        data = tone(2000).export(io.BytesIO(), format="mp3").getvalue()
+        with mock.patch.dict(cfg.MEDIA, {'SPOOL_MAX_BYTES': 1024, 'PERSIST': True}), \
+                mock.patch.object(File, "DEFAULT_CHUNK_SIZE", 4096):
+            context, audio = save_recording({}, File(Upload(data), name="long.mp3"), store=self.store)
+
+        self.assertTrue(reads and all(0 < size <= 4096 for size in reads))
+        self.assertEqual(self.store.save(data, "long.mp3"), context["filename"])
+        self.assertEqual(self.store.stats()["deduplicated"], 1)
+        self.assertEqual(audio.source[:], data)
+        self.assertAlmostEqual(audio.duration, 2.0, delta=0.1)
+
+
+class TranscriptStoreTestCase(TestCase):
+    """ Tests for the append-only transcript store """
+
+    def setUp(self):
+        # The cache of the tests is the only one, so it is shared
+        self.store = TranscriptStore('default', timeout=60, batch_size=3, flush_interval=60, shared=True)
+        self.store.cache.clear()
+
+    def test_append_and_text(self):
+        """ Segments are appended per session and a transcript can start at any segment """
+        self.assertEqual([self.store.append("a", word) for word in ("one", "two", "three")], [0, 1, 2])
+        self.store.append("b", "other")
+
+        self.assertEqual(self.store.text("a"), "one two three")
+        self.assertEqual(self.store.text("a", 1), "two three")
+        self.assertEqual(self.store.text("b"), "other")
+
+    def test_batched_writes(self):
+        """ Segments are written to the database in batches and read back when they left the cache """
+        segments = apps.get_model('main', 'TranscriptSegment').objects
+        self.store.append("a", "one")
+        self.store.append("a", "two")
+        self.assertEqual(segments.count(), 0)
+
+        self.store.append("a", "three")
+        self.assertEqual(segments.count(), 3)
+
+        self.store.append("a", "four")
+        self.store.cache.clear()
+        self.assertEqual(self.store.count("a"), 4)
+        self.assertEqual(self.store.text("a", 2), "three four")
+
+    def test_flush_timer(self):
+        """ Pending segments are written when the flush interval is over, also without further appends """
+        store = TranscriptStore('default', timeout=60, batch_size=10, flush_interval=0.05, shared=True)
+        store.count("a")
+        with mock.patch.object(store, 'flush') as flush:
+            store.append("a", "one")
+            store.timer.join(5)
+        flush.assert_called_once_with()
+        self.assertIsNone(store.timer)
+
+    def test_process_cache(self):
+        """ With the cache of a process, the counters are kept by the process and segments are written in batches """
+        segments = apps.get_model('main', 'TranscriptSegment').objects
+        segments.create(session_key="a", index=0, text="zero")
+        store = TranscriptStore('default', timeout=60, batch_size=3, flush_interval=60)
+        self.assertFalse(store.shared)
+
+        self.assertEqual(store.append("a", "one"), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(store.append("a", "two"), 2)
+            self.assertEqual(store.count("a"), 3)
+            self.assertEqual(store.text("a", 1), "one two")
+
+        store.append("a", "three")
+        self.assertEqual(list(segments.filter(session_key="a").values_list('text', flat=True)),
+                         ["zero", "one", "two", "three"])
+
+    def test_process_cache_conflicts(self):
+        """ A session that is served by two processes without a shared cache keeps all segments """
+        segments = apps.get_model('main', 'TranscriptSegment').objects
+        workers = [TranscriptStore('default', timeout=60, batch_size=1, flush_interval=60) for _ in range(2)]
+        self.assertEqual(workers[0].append("a", "one"), 0)
+        self.assertEqual(workers[1].append("a", "two"), 1)
+        with self.assertLogs(level='ERROR') as logs:
+            workers[0].append("a", "three")
+            workers[1].append("a", "four")
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(list(segments.filter(session_key="a").values_list('index', 'text')),
+                         [(0, "one"), (1, "two"), (2, "three"), (3, "four")])
+        self.assertEqual(workers[1].count("a"), 4)
+
+    def test_conflicts_are_kept(self):
+        """ A pending segment whose index was taken is written at the next free index and logged """
+        segments = apps.get_model('main', 'TranscriptSegment').objects
+        self.store.append("a", "one")
+        segments.create(session_key="a", index=0, text="other")
+
+        with self.assertLogs(level='ERROR'):
+            self.store.flush()
+        self.assertEqual(list(segments.filter(session_key="a").values_list('index', 'text')),
+                         [(0, "other"), (1, "one")])
+
+
+class NormalizationTestCase(TestCase):
+    """ Tests for the normalization of transcripts """
+
+    def test_split_words(self):
+        """ Transcripts are lower cased, punctuation is removed and they are split at any whitespace """
+        self.assertEqual(split_words("Hello,  World!\nIt's  - a test. "), ["hello", "world", "its", "a", "test"])
+        self.assertEqual(normalize_transcript(""), [])
+
+    def test_ids(self):
+        """ Words get ids of one vocabulary, memoized references are reused """
+        normalizer = Normalizer(memo_size=1)
+        first = normalizer.ids("The cat, the hat", memoize=True)
+        self.assertEqual(first.tolist(), [0, 1, 0, 2])
+        self.assertIs(normalizer.ids("The cat, the hat", memoize=True), first)
+        self.assertFalse(first.flags.writeable)
+        self.assertEqual(normalizer.ids("a hat").tolist(), [3, 2])
+
+        normalizer.ids("another reference", memoize=True)
+        self.assertEqual(len(normalizer.memo), 1)
+        self.assertIsNot(normalizer.ids("The cat, the hat", memoize=True), first)
+
+    def test_batch(self):
+        """ A batch gives the same ids as normalizing the texts one by one """
+        texts = ["The quick brown fox.", "", "Jumps over\x00the lazy dog!", "The quick brown fox."]
+        normalizer = Normalizer(memo_size=0)
+        batch = normalizer.batch(texts)
+        self.assertEqual([ids.tolist() for ids in batch], [normalizer.ids(text).tolist() for text in texts])
+        self.assertEqual([len(ids) for ids in batch], [4, 0, 5, 4])
+        self.assertEqual(normalizer.batch([]), [])
+
+        # The metrics engine consumes the ids directly
+        truth, hypothesis = normalizer.batch(["the quick brown fox", "the quick brown box"])
+        self.assertEqual(calculate_metrics({}, truth, hypothesis)["wer"], 0.25)
+
+
+class LiveScoringTestCase(TestCase):
+    """ Tests for the incremental scoring of growing transcripts """
+
+    def test_incremental_scorer(self):
+        """ A hypothesis scored chunk by chunk has the same distance as aligning it at once """
+        truth = "the quick brown fox jumps over the lazy dog".split()
+        hypothesis = "a quick brown box jumps over over the dog".split()
+        scorer = IncrementalScorer(truth)
+        for start in range(0, len(hypothesis), 2):
+            scorer.extend(hypothesis[start:start + 2])
+            live, full = scorer.score(), score(align(truth, hypothesis[:start + 2]))
+            self.assertEqual(live["wer"], full["wer"])
+            self.assertGreaterEqual(live["hits"], full["hits"])
+
+        self.assertEqual((scorer.score()["hits"], scorer.score()["substitutions"], scorer.score()["deletions"],
+                          scorer.score()["insertions"]), (6, 2, 1, 1))
+        self.assertEqual(scorer.cells, (len(hypothesis) + 1) * (len(truth) + 1))
+
+    def test_session_scorers(self):
+        """ Only the segments that were appended since the last score are normalized """
+        store = get_transcript_store()
+        scorers = SessionScorers(max_cells=10 ** 6)
+        store.append("live", "The quick brown")
+        self.assertEqual(scorers.score("live", "The quick brown fox.")["deletions"], 1)
+
+        store.append("live", "fox!")
+        with mock.patch.object(Normalizer, "ids", autospec=True, side_effect=Normalizer.ids) as normalize:
+            metrics = scorers.score("live", "The quick brown fox.")
+        self.assertEqual([call[0][1] for call in normalize.call_args_list], ["fox!"])
+        self.assertEqual((metrics["wer"], metrics["hits"]), (0.0, 4))
+
+        # A new reference text or transcript start is scored from scratch
+        self.assertEqual(scorers.score("live", "The quick brown fox.", start=1)["hits"], 1)
+        self.assertEqual(scorers.score("live", "quick fox")["insertions"], 2)
+
+        # Scorers above max_cells are dropped
+        scorers.max_cells = 0
+        scorers.score("live", "quick fox")
+        self.assertEqual(len(scorers), 0)
+
+    def test_text_upload(self):
+        """ The reference text posted after a chunk is scored against the transcript of the session """
+        self.client.get(reverse("index"))
+        get_transcript_store().append(self.client.session.session_key, "the quick brown")
+        response = self.client.post(reverse("index"), {"text_upload": "The quick brown fox"})
+        self.assertEqual((response.json()["wer"], response.json()["wcr"]), (0.25, 0.75))
+
+
+class ScriptedRecognizer(Recognizer):
+    """ Recognizer whose calls take the scripted (seconds, fails) steps in turn, the last step repeats """
+
+    def __init__(self, steps: list):
+        self.steps = steps
+        self.calls = 0
+        self.active = 0
+        self.most_active = 0
+        self.lock = threading.Lock()
+
+    def _step(self) -> tuple:
+        with self.lock:
+            step = self.steps[min(self.calls, len(self.steps) - 1)]
+            self.calls += 1
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        return step
+
+    def _done(self, fails: bool) -> str:
+        with self.lock:
+            self.active -= 1
+        if fails:
+            raise TransientRecognitionError("Scripted failure.")
+        return "hello"
+
+    def recognize(self, audio, language_code="en", session_id="me"):
+        seconds, fails = self._step()
+        time.sleep(seconds)
+        return self._done(fails)
+
+    async def recognize_async(self, audio, language_code="en", session_id="me"):
+        seconds, fails = self._step()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            with self.lock:
+                self.active -= 1
+        if fails:
+            raise TransientRecognitionError("Scripted failure.")
+        return "hello"
+
+
+class RecognizerPoolTestCase(TestCase):
+    """ Tests for the pool of recognizer clients """
+
+    def setUp(self):
+        self.audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+
+    def test_get_recognizer(self):
+        """ Backends are used through one pool per process """
+        self.assertIsInstance(get_recognizer("fake"), RecognizerPool)
+        self.assertIs(get_recognizer("fake"), get_recognizer("fake"))
+        self.assertIn("slots", recognizer_stats("fake"))
+
+    def test_concurrency_limit(self):
+        """ No more than max_concurrency requests reach the backend at the same time """
+        backend = ScriptedRecognizer([(0.05, False)])
+        pool = RecognizerPool(lambda: backend, max_concurrency=2)
+        threads = [threading.Thread(target=pool.recognize, args=(self.audio,)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        async def recognize_all():
+            return await asyncio.gather(*(pool.recognize_async(self.audio) for _ in range(6)))
+
+        self.assertEqual(asyncio.run(recognize_all()), ["hello"] * 6)
+        self.assertEqual((backend.calls, backend.most_active), (12, 2))
+        self.assertEqual(pool.limit.stats(), {"active": 0, "waiting": 0, "slots": 2})
+
+    def test_limit_timeout(self):
+        """ A waiter that gives up does not keep a slot """
+        limit = ConcurrencyLimit(1)
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire(timeout=0.01))
+        self.assertFalse(asyncio.run(limit.acquire_async(timeout=0.01)))
+        limit.release()
+        self.assertTrue(limit.try_acquire())
+
+    def test_retries(self):
+        """ Failed requests are retried until they succeed or the retries are used up """
+        pool = RecognizerPool(lambda: ScriptedRecognizer([(0, True), (0, False)]), retries=1, backoff=0.01)
+        self.assertEqual(pool.recognize(self.audio), "hello")
+        self.assertEqual(asyncio.run(pool.recognize_async(self.audio)), "hello")
+        self.assertEqual(pool.stats()["retries"], 1)
+
+        pool = RecognizerPool(lambda: ScriptedRecognizer([(0, True)]), retries=2, backoff=0.01)
+        with self.assertRaises(RecognitionError):
+            pool.recognize(self.audio)
+        self.assertEqual((pool.clients[0].calls, pool.stats()["retries"], pool.stats()["failures"]), (3, 2, 1))
+
+    def test_permanent_errors(self):
+        """ Errors that would happen again are not retried """
+        backend = mock.Mock(spec=Recognizer)
+        backend.recognize.side_effect = RecognitionError("Bad request.")
+        pool = RecognizerPool(lambda: backend, retries=2, backoff=0.01)
+        with self.assertRaises(RecognitionError):
+            pool.recognize(self.audio)
+        self.assertEqual((backend.recognize.call_count, pool.stats().get("retries", 0), pool.stats()["failures"]),
+                         (1, 0, 1))
+
+    def test_retry_deadline(self):
+        """ Requests are not retried when the retry can not finish before the deadline """
+        pool = RecognizerPool(lambda: ScriptedRecognizer([(0, True)]), retries=5, backoff=0.01, deadline=0.5)
+        for _ in range(20):
+            pool.latencies.add(1.0)
+        with self.assertRaises(RecognitionError):
+            asyncio.run(pool.recognize_async(self.audio))
+        self.assertEqual(pool.clients[0].calls, 1)
+
+    def test_hedged_requests(self):
+        """ A request that is slower than the recent latencies gets a second attempt, the first result wins """
+        for recognize in (lambda pool: pool.recognize(self.audio),
+                          lambda pool: asyncio.run(pool.recognize_async(self.audio))):
+            backend = ScriptedRecognizer([(2.0, False), (0.01, False)])
+            pool = RecognizerPool(lambda: backend, hedge=True)
+            for _ in range(20):
+                pool.latencies.add(0.01)
+
+            start = time.perf_counter()
+            self.assertEqual(recognize(pool), "hello")
+            self.assertLess(time.perf_counter() - start, 1.0)
+            self.assertEqual((pool.stats()["hedges"], pool.stats()["hedge_wins"]), (1, 1))
+
+    def test_recognition_session(self):
+        """ Every user gets its own session at the recognition backend """
+        first, second = self.client_class(), self.client_class()
+        first.get(reverse("index"))
+        second.get(reverse("index"))
+        with mock.patch("src.main.views.transcribe_async", return_value={"text": "", "segments": []}) as transcribe:
+            for client in (first, second, first):
+                audio = tone(1000).export(io.BytesIO(), format="wav")
+                audio.name = "blob"
+                audio.seek(0)
+                client.post(reverse("index"), {"audio_recording": audio})
+        session_ids = [call[0][2] for call in transcribe.call_args_list]
+        self.assertNotEqual(session_ids[0], session_ids[1])
+        self.assertEqual(session_ids[0], session_ids[2])
+        self.assertNotIn(first.session.session_key, session_ids)
+
+
+class FeatureStoreTestCase(TestCase):
+    """ Tests for the precomputed feature store """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.items = []
+        for i in range(3):
+            path = os.path.join(self.directory, "{}.wav".format(i))
+            tone(500 * (i + 1)).export(path, format="wav")
+            with open(os.path.join(self.directory, "{}.txt".format(i)), "w") as text_file:
+                text_file.write("yes")
+            self.items.append((str(i), path))
+        self.features = {'kind': 'logmel', 'size': 8, 'window_ms': 25, 'hop_ms': 10}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_update_and_read(self):
+        """ Features are extracted once and read as slices of one memory-mapped array """
+        store_path = os.path.join(self.directory, "store")
+        store = FeatureStore(store_path, self.features)
+        self.assertEqual(store.update(self.items, workers=2, processes=False),
+                         {'reused': 0, 'extracted': 3, 'failed': 0})
+
+        reopened = FeatureStore(store_path, self.features)
+        self.assertEqual(len(reopened), 3)
+        for key, path in self.items:
+            audio = decode_file(path)
+            expected = compute_features(audio.samples, audio.sample_rate, **self.features)
+            features = reopened.get(key)
+            self.assertIsInstance(features, np.memmap)
+            self.assertFalse(features.flags.writeable)
+            np.testing.assert_allclose(features, expected, atol=0.1, rtol=1e-3)
+        self.assertAlmostEqual(reopened.duration('2'), 1.5, places=1)
+        self.assertEqual(len(reopened.data), sum(len(reopened.get(key)) for key, _ in self.items))
+
+        # Unchanged files are not read, touched files are hashed and changed files are extracted again
+        os.utime(self.items[0][1], ns=(0, 0))
+        tone(2000).export(self.items[1][1], format="wav")
+        stats = reopened.update(self.items + [("missing", "missing.wav")], processes=False)
+        self.assertEqual(stats, {'reused': 2, 'extracted': 1, 'failed': 1})
+        self.assertEqual(reopened.duration('1'), FeatureStore(store_path, self.features).duration('1'))
+        self.assertAlmostEqual(reopened.duration('1'), 2.0, places=1)
+        self.assertEqual(len([name for name in os.listdir(store_path) if name.startswith("features-")]), 1)
+
+        # Other features are extracted from scratch
+        other = FeatureStore(store_path, dict(self.features, size=13), dtype='float32')
+        self.assertEqual(len(other), 0)
+        self.assertEqual(other.update(self.items, processes=False)['extracted'], 3)
+        self.assertEqual(other.get('0').shape[1], 13)
+
+    def test_extractfeatures_command(self):
+        """ The command extracts a corpus in parallel processes and reuses the store the next time """
+        store_path = os.path.join(self.directory, "store")
+        for expected in ({'extracted': 3, 'reused': 0}, {'extracted': 0, 'reused': 3}):
+            out = io.StringIO()
+            call_command("extractfeatures", self.directory, store=store_path, kind="mfcc", size=13, workers=2,
+                         stdout=out)
+            stats = json.loads(out.getvalue())
+            self.assertEqual({key: stats[key] for key in expected}, expected)
+            self.assertEqual(stats['utterances'], 3)
+
+        with self.assertRaises(CommandError):
+            call_command("extractfeatures", self.directory, model="missing")
+
+
+class LocalModelsTestCase(TestCase):
+    """ Tests for the local models and their micro-batching """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import keras
+
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, "commands.keras")
+        model = keras.Sequential([keras.Input((20, 8)), keras.layers.Flatten(),
+                                  keras.layers.Dense(3, activation="softmax")])
+        model.save(cls.path)
+        cls.config = {'PATH': cls.path, 'LABELS': ["yes", "no", "stop"], 'FRAMES': 20,
+                      'FEATURES': {'SIZE': 8}}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        super().tearDownClass()
+
+    def test_features(self):
+        """ Features have one frame per hop and are padded or cut to a fixed number of frames """
+        samples = np.zeros(16000, dtype=np.int16)
+        for kind in ("logmel", "mfcc"):
+            features = compute_features(samples, 16000, kind=kind, size=13)
+            self.assertEqual((features.shape, features.dtype), ((101, 13), np.float32))
+        self.assertEqual(compute_features(samples[:0], 16000).shape, (0, 40))
+        self.assertEqual(fix_frames(features, 120).shape, (120, 13))
+        self.assertEqual(fix_frames(features, 50).shape, (50, 13))
+        with self.assertRaises(ValueError):
+            compute_features(samples, 16000, kind="spectrum")
+
+    def test_micro_batching(self):
+        """ Concurrent inputs are predicted in batches of inputs with the same shape """
+        sizes = []
+
+        def predict(batch):
+            sizes.append(len(batch))
+            time.sleep(0.02)
+            return batch.sum(axis=1)
+
+        batcher = MicroBatcher(predict, max_batch=8, max_wait=0.01)
+        inputs = [np.full(3 if i % 5 else 4, i, dtype=np.float32) for i in range(40)]
+        outputs = [None] * len(inputs)
+
+        def run(i):
+            outputs[i] = batcher.predict(inputs[i])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(inputs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outputs, [x.sum() for x in inputs])
+        self.assertLess(len(sizes), len(inputs) / 2)
+        self.assertLessEqual(max(sizes), 8)
+        stats = batcher.stats()
+        self.assertEqual((stats["batches"], stats["inputs"], stats["queued"]), (len(sizes), 40, 0))
+
+        async def predict_all():
+            return await asyncio.gather(*(batcher.predict_async(x) for x in inputs[:8]))
+
+        self.assertEqual(asyncio.run(predict_all()), [x.sum() for x in inputs[:8]])
+        self.assertEqual(batcher.stats()["batches"], len(sizes))
+
+    def test_batch_errors(self):
+        """ A failed batch fails all of its inputs, the batcher keeps running """
+        batcher = MicroBatcher(lambda batch: 1 / 0, max_wait=0)
+        with self.assertRaises(ZeroDivisionError):
+            batcher.predict(np.zeros(2))
+        batcher.predict_batch = lambda batch: batch
+        self.assertEqual(batcher.predict(np.ones(2)).tolist(), [1, 1])
+        self.assertEqual(batcher.stats()["errors"], 1)
+
+    def test_registry(self):
+        """ Models are loaded once and predict the same in batches as alone """
+        registry = ModelRegistry({'commands': self.config})
+        with mock.patch("src.main.inference.load_keras_model", side_effect=load_keras_model) as load:
+            model = registry.get('commands')
+            self.assertIs(registry.get('commands'), model)
+        self.assertEqual(load.call_count, 1)
+        with self.assertRaises(ValueError):
+            registry.get('missing')
+
+        audios = [decode_audio(tone(100 * (i + 1)).export(io.BytesIO(), format="wav").getvalue()) for i in range(8)]
+        expected = [model.decode(model.model.predict_on_batch(model.inputs(audio)[np.newaxis])[0]) for audio in audios]
+        texts = [None] * len(audios)
+
+        def run(i):
+            texts[i] = model.transcribe(audios[i])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(audios))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(texts, expected)
+        self.assertLess(model.batcher.stats()["batches"], len(audios))
+        self.assertEqual(registry.stats()["commands/inputs"], len(audios))
+
+    def test_ctc_decoder(self):
+        """ CTC outputs are read per frame, with repeats merged and blanks dropped """
+        model = LocalModel('ctc', load_keras_model(self.path), dict(self.config, DECODER='ctc', LABELS=["a", "b"]))
+        output = np.eye(3)[[0, 0, 2, 0, 1, 1, 2, 2]]
+        self.assertEqual(model.decode(output), "aab")
+        with self.assertRaises(ValueError):
+            LocalModel('bad', model.model, dict(self.config, DECODER='beam'))
+
+    def test_local_backend(self):
+        """ The local backend recognizes with the model and create_global_models() loads it """
+        with mock.patch.dict(cfg.MODELS, {'commands': self.config, 'missing': dict(self.config, PATH="missing")}), \
+                mock.patch("src.main.inference._registry", None):
+            timings = create_global_models()
+            self.assertIsNotNone(timings['commands'])
+            self.assertIsNone(timings['missing'])
+            recognizer = LocalModelRecognizer('commands')
+            audio = decode_audio(tone(1000).export(io.BytesIO(), format="wav").getvalue())
+            text = recognizer.recognize(audio)
+            self.assertIn(text, self.config['LABELS'])
+            self.assertEqual(asyncio.run(recognizer.recognize_async(audio)), text)
+
+    def test_evaluate_model(self):
+        """ Corpora are evaluated with a local model on precomputed features """
+        with tempfile.TemporaryDirectory() as corpus, \
+                mock.patch.dict(cfg.MODELS, {'commands': self.config}), \
+                mock.patch.dict(cfg.FEATURE_STORE, {'DIRECTORY': os.path.join(corpus, "features")}), \
+                mock.patch("src.main.inference._registry", None):
+            for i in range(4):
+                tone(300 * (i + 1)).export(os.path.join(corpus, "{}.wav".format(i)), format="wav")
+                with open(os.path.join(corpus, "{}.txt".format(i)), "w") as text_file:
+                    text_file.write("yes")
+            output_path = os.path.join(corpus, "results.jsonl")
+
+            for _ in range(2):
+                out = io.StringIO()
+                call_command("evaluate", corpus, output=output_path, workers=4, model="commands", stdout=out)
+                with open(output_path) as output:
+                    rows = [json.loads(line) for line in output]
+
+                self.assertEqual(json.loads(out.getvalue())["utterances"], 4)
+                self.assertTrue(all(row["hypothesis"] in self.config['LABELS'] for row in rows))
+                self.assertEqual(len(os.listdir(os.path.join(corpus, "features"))), 1)
+
+
+class AdmissionTestCase(TestCase):
+    """ Tests for the admission control of transcriptions """
+
+    def controller(self, max_wait: float = 5.0, max_queued: float = 100.0,
+                   bulk_share: float = 1.0) -> AdmissionController:
+        return AdmissionController(10, 5, {'live': max_wait, 'bulk': max_wait},
+                                   {'live': max_queued, 'bulk': max_queued}, bulk_share)
+
+    def test_estimate_duration(self):
+        """ The duration is read from the header, or estimated from the size when the header has none """
+        wav = ContentFile(tone(3000).export(io.BytesIO(), format="wav").getvalue(), name="a.wav")
+        self.assertAlmostEqual(estimate_duration(wav), 3.0, places=2)
+        self.assertEqual(wav.tell(), 0)
+        chunk = ContentFile(b"\x1a\x45\xdf\xa3" + bytes(15996), name="blob")
+        self.assertAlmostEqual(estimate_duration(chunk), 16000 / cfg.ADMISSION['BYTES_PER_SECOND'])
+
+    def test_shortest_job_first(self):
+        """ Waiting work is admitted live first and shortest first, as long as it fits """
+        controller = self.controller()
+        first = controller.admit(9.5)
+        self.assertEqual(controller.classify(3), "live")
+        self.assertEqual(controller.classify(30, is_recording=True), "live")
+        self.assertEqual(controller.classify(30), "bulk")
+
+        admitted = []
+
+        def run(seconds, is_recording):
+            admitted.append((seconds, controller.admit(seconds, is_recording, deferred=True)))
+
+        threads = []
+        for seconds, is_recording in ((30, False), (6, False), (2, True), (1, False)):
+            threads.append(threading.Thread(target=run, args=(seconds, is_recording)))
+            threads[-1].start()
+            while controller.stats()["waiting"] < len(threads):
+                time.sleep(0.001)
+
+        first.release()
+        while len(admitted) < 3:
+            time.sleep(0.001)
+        # The long upload came first, but waits for the shorter work
+        self.assertEqual(sorted(seconds for seconds, _ in admitted), [1, 2, 6])
+        self.assertEqual((controller.stats()["inflight_seconds"], controller.stats()["waiting"]), (9, 1))
+
+        # A long file counts as the bulk share
+        for _, ticket in list(admitted):
+            ticket.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(controller.stats()["inflight_seconds"], 10)
+        admitted[-1][1].release()
+        stats = controller.stats()
+        self.assertEqual((stats["active"], stats["admitted_live"], stats["admitted_bulk"], stats["deferred_bulk"]),
+                         (0, 2, 3, 2))
+
+    def test_shedding(self):
+        """ Work is shed when too much waits or it waits too long, its capacity is released after resizing """
+        controller = self.controller(max_wait=0.05, max_queued=20)
+        ticket = controller.admit(10)
+        with self.assertRaises(Overloaded):
+            controller.admit(25)
+        with self.assertRaises(Overloaded) as shed:
+            controller.admit(15)
+        self.assertEqual(shed.exception.retry_after, 1)
+        with self.assertRaises(Overloaded):
+            asyncio.run(controller.admit_async(2, is_recording=True))
+        self.assertEqual((controller.stats()["shed_bulk"], controller.stats()["shed_live"]), (2, 1))
+
+        ticket.resize(4)
+        self.assertTrue(asyncio.run(controller.admit_async(6)).admitted)
+        self.assertEqual(controller.stats()["inflight_seconds"], 10)
+
+    def test_live_reserve(self):
+        """ Bulk work does not take the capacity reserved for live work, long audio is admitted segment by segment """
+        controller = self.controller(max_wait=0.05, bulk_share=0.5)
+        long = controller.admit(3600)
+        self.assertEqual((long.work_class, long.seconds), ("bulk", 5))
+        self.assertTrue(controller.admit(3, is_recording=True).admitted)
+        with self.assertRaises(Overloaded):
+            controller.admit(6)
+        self.assertTrue(controller.admit(2, is_recording=True).admitted)
+        self.assertEqual((controller.stats()["inflight_seconds"], controller.stats()["inflight_bulk_seconds"]), (10, 5))
+
+        controller = self.controller()
+        quiet = AudioSegment.silent(duration=1000)
+        audio = decode_audio((tone(3000) + quiet + tone(3000)).export(io.BytesIO(), format="wav").getvalue())
+        with mock.patch.dict(cfg.SEGMENTATION, {'MIN_SECONDS': 1, 'MAX_SECONDS': 5}), \
+                mock.patch("src.main.admission._controller", controller), \
+                mock.patch("src.main.analyzer.speech_to_text", return_value=("a", 0.1)):
+            text, _, segments = segmented_speech_to_text(audio, work_class="bulk")
+        self.assertEqual((text, len(segments)), ("a a", 2))
+        self.assertEqual((controller.stats()["admitted_bulk"], controller.stats()["active"]), (2, 0))
+
+    def test_deferred_jobs(self):
+        """ Deferred jobs wait for admission without a worker, admitted jobs run live first and shortest first """
+        controller = self.controller()
+        jobs = JobQueue(workers=1, max_size=4, result_ttl=60)
+        full = controller.admit(10)
+        ran = []
+
+        def run(name, ticket=None):
+            ran.append(name)
+            if ticket is not None:
+                ticket.release()
+
+        held = jobs.submit(run, "held", held=True)
+        controller.admit_later(6, False, lambda ticket: jobs.start(held, ticket.key, ticket=ticket))
+        # The worker is not blocked by the job that waits
+        self.assertTrue(jobs.submit(run, "other").wait(5))
+        self.assertEqual((len(jobs), held.status, controller.stats()["waiting"]), (1, "queued", 1))
+
+        release = threading.Event()
+        blocker = jobs.submit(release.wait, 5)
+        while blocker.status != "running":
+            time.sleep(0.001)
+        full.release()
+        jobs.submit(run, "live", priority=(0, 1, 0))
+        self.assertEqual(len(jobs), 2)
+        release.set()
+        self.assertTrue(held.wait(5))
+        self.assertEqual(ran, ["other", "live", "held"])
+        self.assertEqual(controller.stats()["active"], 0)
+
+    def test_overloaded_view(self):
+        """ A shed recording gets a 429 with Retry-After, its decoder is stopped """
+        controller = self.controller(max_wait=0, max_queued=0)
+        controller.admit(10)
+        self.client.get(reverse("index"))
+        audio = tone(1000).export(io.BytesIO(), format="wav")
+        audio.name = "blob"
+        audio.seek(0)
+        with mock.patch("src.main.admission._controller", controller), \
+                mock.patch.object(StreamingDecoder, "abort", autospec=True,
+                                  side_effect=StreamingDecoder.abort) as abort:
+            response = self.client.post(reverse("index"), {"audio_recording": audio})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], "1")
+        self.assertTrue(abort.called)
+        self.assertIsNotNone(abort.call_args[0][0].process.returncode)
+        self.assertIn('speech_admission', self.client.get(reverse("metrics")).content.decode())
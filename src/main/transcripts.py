@@ -0,0 +1,247 @@
+""" Contains the append-only transcript store. Instead of keeping the whole (growing) transcript in the session,
+every recognized chunk is appended as a segment: it is put in the cache right away and written to the database
+later, in batches (write-behind). The session only keeps a small fixed size record, the index at which the current
+transcript starts.
+
+The cache alias is TRANSCRIPTS['CACHE'] in settings.py. The index of a segment is allocated by a counter per session in
+the cache if the cache is shared between workers (memcached, redis, database or file based caches): then every worker
+sees the same segments, and segments that are not in the cache (anymore) are read from the database. With a cache of
+the process (locmem, the default) the counters are kept by the process, starting from the segments in the database.
+That assumes every session is served by one process (the development server, a single worker or sticky sessions);
+deployments with several workers have to configure a shared cache. A segment whose index is taken in the database
+(the counter was lost, or another worker appended to the session) is logged as an error and written at the next free
+index, and the counter of its session is read from the database again.
+
+Pending segments are written when BATCH_SIZE of them are pending, by a timer FLUSH_INTERVAL seconds after the first
+one, and when the process exits.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.apps import apps
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Max
+import src.recorder.settings as cfg
+
+# Number of sessions whose counter a process keeps if the cache is not shared, the least recently used one is dropped
+MAX_COUNTERS = 10000
+
+
+class TranscriptStore:
+    """ Append-only, per session storage of transcript segments.
+
+    Arguments:
+        cache_alias (str): Alias of the Django cache used for the segments.
+        timeout (float): Seconds segments stay in the cache.
+        batch_size (int): Number of pending segments that triggers a database write.
+        flush_interval (float): Maximum age in seconds of a pending segment before it is written.
+        shared (bool): The cache is shared between the workers and holds the counters. Defaults to False for the
+            caches of a process (locmem, dummy), then the store keeps the counters (see above).
+    """
+
+    def __init__(self, cache_alias: str, timeout: float, batch_size: int, flush_interval: float, shared: bool = None):
+        self.cache = caches[cache_alias]
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.shared = not isinstance(self.cache, (LocMemCache, DummyCache)) if shared is None else shared
+        self.counters = OrderedDict()
+        self.pending = []
+        self.oldest_pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _model():
+        return apps.get_model('main', 'TranscriptSegment')
+
+    @staticmethod
+    def _count_key(session_key: str) -> str:
+        return "transcript:{}:count".format(session_key)
+
+    @staticmethod
+    def _segment_key(session_key: str, index: int) -> str:
+        return "transcript:{}:{}".format(session_key, index)
+
+    def count(self, session_key: str) -> int:
+        """ Returns the number of segments of a session. """
+        if not self.shared:
+            with self.lock:
+                count = self.counters.get(session_key)
+                if count is not None:
+                    self.counters.move_to_end(session_key)
+                    return count
+            self.flush()
+            count = self._next_index(session_key)
+            with self.lock:
+                count = self.counters.setdefault(session_key, count)
+                while len(self.counters) > MAX_COUNTERS:
+                    self.counters.popitem(last=False)
+            return count
+
+        count = self.cache.get(self._count_key(session_key))
+        if count is None:
+            self.flush()
+            count = self._model().objects.filter(session_key=session_key).count()
+            self.cache.add(self._count_key(session_key), count, self.timeout)
+            count = self.cache.get(self._count_key(session_key), count)
+        return count
+
+    def _next_index(self, session_key: str) -> int:
+        """ Returns the index after the last segment of a session in the database. """
+        last = self._model().objects.filter(session_key=session_key).aggregate(last=Max('index'))['last']
+        return 0 if last is None else last + 1
+
+    def _insert(self, session_key: str, text: str) -> int:
+        """ Writes a segment at the next free index of the database (another worker may take an index first).
+
+        Returns:
+            The index of the segment (int).
+        """
+        while True:
+            index = self._next_index(session_key)
+            try:
+                with transaction.atomic():
+                    self._model().objects.create(session_key=session_key, index=index, text=text)
+                return index
+            except IntegrityError:
+                continue
+
+    def append(self, session_key: str, text: str) -> int:
+        """ Appends a segment to the transcript of a session.
+
+        Returns:
+            The index of the new segment (int).
+        """
+        index = self._allocate(session_key)
+
+        self.cache.set(self._segment_key(session_key, index), text, self.timeout)
+
+        with self.lock:
+            self.pending.append(self._model()(session_key=session_key, index=index, text=text))
+            if self.oldest_pending is None:
+                self.oldest_pending = time.time()
+            due = len(self.pending) >= self.batch_size or time.time() - self.oldest_pending >= self.flush_interval
+            if not due and self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self._flush_later)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if due:
+            self.flush()
+
+        return index
+
+    def _allocate(self, session_key: str) -> int:
+        """ Returns the next index of a session and increments its counter. """
+        count = self.count(session_key)
+        if not self.shared:
+            with self.lock:
+                index = self.counters.get(session_key, count)
+                self.counters[session_key] = index + 1
+            return index
+
+        try:
+            return self.cache.incr(self._count_key(session_key)) - 1
+        except ValueError:
+            # The counter expired in the meantime
+            self.cache.add(self._count_key(session_key), self.count(session_key), self.timeout)
+            return self.cache.incr(self._count_key(session_key)) - 1
+
+    def segments(self, session_key: str, start: int = 0) -> list:
+        """ Returns the segments of a session from index start on. """
+        keys = [self._segment_key(session_key, index) for index in range(start, self.count(session_key))]
+        cached = self.cache.get_many(keys)
+        if len(cached) < len(keys):
+            self.flush()
+            stored = dict(self._model().objects.filter(session_key=session_key, index__gte=start)
+                          .values_list('index', 'text'))
+            return [cached.get(key, stored.get(start + offset, "")) for offset, key in enumerate(keys)]
+
+        return [cached[key] for key in keys]
+
+    def text(self, session_key: str, start: int = 0) -> str:
+        """ Returns the transcript of a session from segment start on. """
+        return " ".join(self.segments(session_key, start))
+
+    def flush(self):
+        """ Writes the pending segments to the database in one query. """
+        with self.lock:
+            pending, self.pending, self.oldest_pending = self.pending, [], None
+
+        if pending:
+            try:
+                try:
+                    with transaction.atomic():
+                        self._model().objects.bulk_create(pending)
+                except IntegrityError:
+                    self._write_conflicting(pending)
+            except DatabaseError as ex:
+                logging.error("Could not write %d transcript segments: %s", len(pending), ex)
+                with self.lock:
+                    self.pending = pending + self.pending
+                    self.oldest_pending = self.oldest_pending or time.time()
+
+    def _write_conflicting(self, pending: list):
+        """ Writes a batch that conflicts with stored segments one by one, a segment whose index is taken is written at
+        the next free index. """
+        for segment in pending:
+            try:
+                with transaction.atomic():
+                    segment.save(force_insert=True)
+            except IntegrityError:
+                index = self._insert(segment.session_key, segment.text)
+                self._forget(segment.session_key, segment.index)
+                logging.error("Transcript segment %d of session %s was taken by another worker, it was written as "
+                              "segment %d (is TRANSCRIPTS['CACHE'] shared by all workers?)", segment.index,
+                              segment.session_key, index)
+
+    def _forget(self, session_key: str, index: int):
+        """ Drops a cached segment that was stored at another index, it is read from the database again. The counter
+        of the process is read from the database again as well (a shared counter is ahead already). """
+        self.cache.delete(self._segment_key(session_key, index))
+        if not self.shared:
+            with self.lock:
+                self.counters.pop(session_key, None)
+
+    def _flush_later(self):
+        """ Writes the pending segments when the flush interval is over (runs on the timer thread). """
+        with self.lock:
+            self.timer = None
+        try:
+            self.flush()
+        except Exception as ex:
+            logging.error("Could not write the transcript segments: %s", ex)
+        finally:
+            connection.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _flush_at_exit():
+    """ Writes the pending segments when the process exits, unless the database is gone already. """
+    try:
+        _store.flush()
+    except Exception as ex:
+        logging.warning("Could not write the transcript segments at exit: %s", ex)
+
+
+def get_transcript_store() -> TranscriptStore:
+    """ Returns the transcript store of this process, configured by TRANSCRIPTS in settings.py. Pending segments
+    are written when the process exits. """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = TranscriptStore(cfg.TRANSCRIPTS['CACHE'], cfg.TRANSCRIPTS['TIMEOUT'],
+                                     cfg.TRANSCRIPTS['BATCH_SIZE'], cfg.TRANSCRIPTS['FLUSH_INTERVAL'],
+                                     cfg.TRANSCRIPTS['SHARED_CACHE'])
+            atexit.register(_flush_at_exit)
+        return _store
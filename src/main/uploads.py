@@ -0,0 +1,131 @@
+""" Contains the upload handler that decodes audio while it is received. Django's default handlers buffer the whole
+file (in memory or in a temporary file) before the view runs, and only then the file was decoded. DecodingUploadHandler
+writes every chunk of the audio fields to a StreamingDecoder as it comes off the socket, so decoding overlaps with the
+upload and save_recording() only waits for the last chunk to be decoded.
+
+Files that can not be decoded, and uploads of which the header says that they are too short, are rejected while they
+are received: the rest of the body is not read and the view answers with the reason (see upload_error()).
+"""
+
+import tempfile
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers, StopUpload
+from django.http import HttpRequest
+from src.main.audio import StreamingDecoder
+from src.main.probe import probe_header
+import src.recorder.settings as cfg
+
+# Form fields that contain audio, the length of uploads is checked (recordings are chunks of any length)
+AUDIO_FIELDS = ('audio_upload', 'audio_recording')
+LENGTH_CHECKED_FIELDS = ('audio_upload',)
+
+
+class DecodingUploadedFile(UploadedFile):
+    """ An uploaded audio file (in memory, or in a temporary file if it is large) that has been decoded while it was
+    received. decoder.result() returns the decoded audio. """
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra, decoder: StreamingDecoder):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.decoder = decoder
+
+
+class DecodingUploadHandler(FileUploadHandler):
+    """ Upload handler that feeds the audio fields into a StreamingDecoder, other fields are left to the next handler.
+    """
+
+    def __init__(self, request: HttpRequest = None):
+        super().__init__(request)
+        self.decoder = None
+        self.body_size = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        # A file is never larger than the request body, the probe uses it as an upper bound of the file size
+        self.body_size = content_length
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name not in AUDIO_FIELDS:
+            return
+
+        self.decoder = StreamingDecoder(name=self.file_name)
+        self.file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        raise StopFutureHandlers()
+
+    def reject(self, message: str):
+        """ Stops the upload, the view answers with the message. """
+        self.decoder.abort()
+        self.decoder = None
+        self.file.close()
+        self.request.upload_error = message
+        raise StopUpload(connection_reset=True)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.decoder is None:
+            return raw_data
+
+        self.file.write(raw_data)
+        if not self.decoder.feed(raw_data):
+            self.reject("The audio could not be decoded (is the file valid?).")
+        if start == 0:
+            self._check_length(raw_data)
+        return None
+
+    def _check_length(self, header: bytes):
+        """ Rejects uploads of which the header (in the first chunk) says that they are shorter than MIN_LEN. """
+        if self.field_name not in LENGTH_CHECKED_FIELDS:
+            return
+        info = probe_header(header, self.body_size, self.file_name, self.content_type)
+        if info is not None and info.from_header and 0 < info.duration < cfg.MIN_LEN:
+            self.reject("The audio file is too short, it should be at least {} seconds long.".format(cfg.MIN_LEN))
+
+    def file_complete(self, file_size):
+        if self.decoder is None:
+            return None
+
+        # FFMPEG decodes the rest while the view starts
+        self.decoder.close()
+        self.file.seek(0)
+        upload = DecodingUploadedFile(self.file, self.file_name, self.content_type, file_size, self.charset,
+                                      self.content_type_extra, self.decoder)
+        self.decoder = None
+        return upload
+
+    def upload_complete(self):
+        # The body ended before the file did
+        if self.decoder is not None:
+            self.decoder.abort()
+            self.decoder = None
+
+
+def upload_error(request: HttpRequest):
+    """ Returns why the audio of the request was rejected while it was received, or None. """
+    request.FILES  # Parses the body
+    return getattr(request, 'upload_error', None)
+
+
+def detach(file: UploadedFile) -> File:
+    """ Copies an uploaded file, so it can be used after the request (and its files) are closed: into memory, or in
+    chunks into an anonymous temporary file if it is larger than MEDIA['SPOOL_MAX_BYTES']. The decoder of the upload
+    goes with it. """
+    if file.size <= cfg.MEDIA['SPOOL_MAX_BYTES']:
+        copy = ContentFile(file.read(), name=file.name)
+    else:
+        spool = tempfile.TemporaryFile()
+        for chunk in file.chunks():
+            spool.write(chunk)
+        spool.seek(0)
+        copy = File(spool, name=file.name)
+    copy.decoder = getattr(file, 'decoder', None)
+    return copy
+
+
+def abort_decoders(request: HttpRequest, keep: UploadedFile = None):
+    """ Stops the decoders of the uploads of a request that are not (or no longer) transcribed, except the one of
+    keep. A decoder that has finished is not affected. """
+    for _, files in request.FILES.lists():
+        for file in files:
+            decoder = getattr(file, 'decoder', None)
+            if decoder is not None and file is not keep:
+                decoder.abort()
@@ -1,13 +1,9 @@
 from django.urls import path
-from django.conf.urls.static import static
-
-from src.recorder import settings
 from src.main import views
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('info', views.info, name='info'),
+    path('jobs/<str:job_id>', views.job_status, name='job_status'),
+    path('metrics', views.metrics, name='metrics'),
 ]
-
-# Serve media content
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,104 @@
+""" Contains the voice activity detection (VAD) stage. The decoded PCM is cut into fixed length frames and every frame
+is classified at once with NumPy: a frame is speech when its energy is well above the noise floor of the file and
+above an absolute floor, or when it is a little quieter but has the high zero-crossing rate of unvoiced sounds
+("s", "f"). Audio that is speech from start to end has no noise floor, so the threshold is never more than the same
+margin below the loudest frame. Speech frames are padded on both sides so word onsets and endings are kept.
+
+The result is used to trim leading and trailing silence before the audio is sent to the recognizer, to skip chunks
+that contain no speech at all and to report the RTF against the speech only duration.
+"""
+
+from typing import NamedTuple, Tuple
+import numpy as np
+from src.main.audio import DecodedAudio
+import src.recorder.settings as cfg
+
+
+class VoiceActivity(NamedTuple):
+    """ Speech detected in an audio buffer.
+
+    Attributes:
+        start (int): First sample of the speech (0 if there is none).
+        end (int): Sample after the last sample of the speech (0 if there is none).
+        speech_duration (float): Seconds of speech (padded speech frames, without the silence in between).
+        duration (float): Seconds of audio that were analyzed.
+    """
+    start: int
+    end: int
+    speech_duration: float
+    duration: float
+
+    @property
+    def has_speech(self) -> bool:
+        return self.speech_duration * 1000 >= cfg.VAD['MIN_SPEECH_MS']
+
+
+def frame_features(samples: np.ndarray, frame_length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """ Calculates the energy and zero-crossing rate of every frame, the last incomplete frame is zero padded.
+
+    Arguments:
+        samples (np.ndarray): 16-bit samples.
+        frame_length (int): Number of samples per frame.
+
+    Returns:
+        (energy, zcr): Energy in dBFS and the fraction of samples where the sign changes, per frame.
+    """
+    frame_count = -(-len(samples) // frame_length)
+    frames = np.zeros(frame_count * frame_length, dtype=np.float32)
+    frames[:len(samples)] = samples
+    frames = frames.reshape(frame_count, frame_length) / 32768.0
+
+    power = np.einsum('ij,ij->i', frames, frames) / frame_length
+    energy = 10 * np.log10(np.maximum(power, 1e-10))
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / float(frame_length)
+    return energy, zcr
+
+
+def detect_speech(audio: DecodedAudio) -> VoiceActivity:
+    """ Finds the speech in the audio, configured by VAD in settings.py.
+
+    Arguments:
+        audio (DecodedAudio): The decoded audio.
+
+    Returns:
+        The detected speech (VoiceActivity).
+    """
+    samples = audio.samples
+    frame_length = max(1, int(audio.sample_rate * cfg.VAD['FRAME_MS'] / 1000))
+    if not len(samples):
+        return VoiceActivity(0, 0, 0.0, 0.0)
+
+    energy, zcr = frame_features(samples, frame_length)
+    noise_floor = np.percentile(energy, 10)
+    threshold = max(cfg.VAD['ENERGY_THRESHOLD'],
+                    min(noise_floor + cfg.VAD['NOISE_MARGIN'], energy.max() - cfg.VAD['NOISE_MARGIN']))
+    speech = (energy > threshold) | ((energy > threshold - cfg.VAD['ZCR_MARGIN']) &
+                                     (zcr > cfg.VAD['ZCR_THRESHOLD']) & (energy > cfg.VAD['ENERGY_THRESHOLD']))
+
+    # Pad the speech frames on both sides (a dilation of the mask)
+    padding = int(cfg.VAD['PADDING_MS'] / cfg.VAD['FRAME_MS'])
+    if padding and speech.any():
+        speech = np.convolve(speech.astype(np.int32), np.ones(2 * padding + 1, dtype=np.int32), mode='same') > 0
+
+    frames = np.flatnonzero(speech)
+    if not len(frames):
+        return VoiceActivity(0, 0, 0.0, audio.duration)
+
+    start = int(frames[0]) * frame_length
+    end = min(len(samples), (int(frames[-1]) + 1) * frame_length)
+    speech_duration = min(len(frames) * frame_length, end - start) / float(audio.sample_rate)
+    return VoiceActivity(start, end, speech_duration, audio.duration)
+
+
+def trim_silence(audio: DecodedAudio) -> Tuple[DecodedAudio, VoiceActivity]:
+    """ Removes the leading and trailing silence.
+
+    Returns:
+        (audio, activity): The trimmed audio (empty if there is no speech) and the detected speech.
+    """
+    activity = detect_speech(audio)
+    width = DecodedAudio.SAMPLE_WIDTH
+    trimmed = DecodedAudio(audio.pcm[activity.start * width:activity.end * width], audio.sample_rate, audio.name,
+                           audio.source, audio.offset + activity.start / float(audio.sample_rate))
+    return trimmed, activity
@@ -2,16 +2,143 @@
 """
 import os
 import json
-import jiwer
+import time
+import hashlib
 from typing import Union
 from django.shortcuts import render
+from asgiref.sync import sync_to_async
+from django.middleware.csrf import CsrfViewMiddleware
 from django.http import HttpRequest, HttpResponse, JsonResponse
-from src.main.analyzer import save_recording, speech_to_text, calculate_metrics
+from src.main.analyzer import transcribe, transcribe_async
+from src.main.admission import Overloaded, admit_later, get_admission_controller
+from src.main.jobs import get_job_queue, QueueFull
+from src.main.transcripts import get_transcript_store
+from src.main.cache import get_transcription_cache
+from src.main.media import get_media_store
+from src.main.scoring import score_session
+from src.main.inference import get_model_registry
+from src.main.recognizers import recognizer_stats
+from src.main.uploads import DecodingUploadHandler, abort_decoders, detach, upload_error
+from src.main.instrumentation import get_metrics, render_gauge, timed
+import src.recorder.settings as cfg
 import warnings
 warnings.filterwarnings('ignore')
 
+# Initial session context, read once
+with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'config.json')) as jsonfile:
+    DEFAULT_CONTEXT = json.load(jsonfile)
 
-def index(req: HttpRequest) -> Union[HttpResponse, JsonResponse]:
+
+def _get_context(req: HttpRequest) -> dict:
+    """ Returns the session context (a small, fixed size record), creates it and the session if necessary. """
+    if 'context' not in req.session:
+        req.session['context'] = dict(DEFAULT_CONTEXT)
+    if not req.session.session_key:
+        req.session.save()
+
+    return req.session['context']
+
+
+def _recognition_session(req: HttpRequest) -> str:
+    """ Returns the session id of the user for the recognition backend, a hash of the session key (which is a secret
+    and should not leave the server). Creates the session if necessary. """
+    _get_context(req)
+    return hashlib.sha256(req.session.session_key.encode()).hexdigest()[:32]
+
+
+@timed("transcript")
+def _update_text(req: HttpRequest, result: dict, reset: bool, is_recording: bool) -> str:
+    """ Appends a transcription result to the transcript of the session, or starts a new transcript if reset is
+    True, and stores the other results (audio features, rtf) in the session context. Segments of long files are
+    only returned to the client, they are not kept in the session.
+
+    Returns:
+        str: The complete current transcript.
+    """
+    context = _get_context(req)
+    store = get_transcript_store()
+    if reset:
+        context['transcript_start'] = store.count(req.session.session_key)
+    if result['text']:
+        store.append(req.session.session_key, result['text'])
+
+    context.update((key, value) for key, value in result.items() if key not in ('text', 'segments'))
+    req.session['context'] = context
+
+    text = store.text(req.session.session_key, context.get('transcript_start', 0))
+    return text if is_recording else text.capitalize()
+
+
+def _apply_job(req: HttpRequest, job):
+    """ Adds the text of a finished job to the transcript of the session (see JobQueue.apply()). A failed job adds
+    nothing, but still starts a new transcript if its chunk did. """
+    if job.status == "done":
+        job.data["text"] = _update_text(req, job.result, job.data["reset"], job.data["is_recording"])
+    elif job.data["reset"]:
+        _update_text(req, {"text": ""}, True, job.data["is_recording"])
+
+
+_csrf = CsrfViewMiddleware(lambda req: None)
+
+
+def _check_request(req: HttpRequest) -> Union[HttpResponse, None]:
+    """ Parses the body (the upload handlers run now) and checks the CSRF token. index is exempt from the CSRF
+    middleware, because the upload handler has to be installed before the middleware parses the body.
+
+    Returns:
+        The response if the request is rejected (403), otherwise None.
+    """
+    rejected = _csrf.process_view(req, None, (), {})
+    req.FILES
+    return rejected
+
+
+def _submit(req: HttpRequest, file, is_recording: bool, reset: bool) -> JsonResponse:
+    """ Queues the transcription of an upload (async=true), the session key owns the job. """
+    session_id = _recognition_session(req)
+    # Read the upload now, the temporary upload file is gone once this request is finished
+    file = detach(file)
+    jobs = get_job_queue()
+    try:
+        job = jobs.submit(transcribe, file, is_recording, session_id, owner=req.session.session_key,
+                          data={"reset": reset, "is_recording": is_recording}, held=True)
+    except QueueFull as ex:
+        if file.decoder is not None:
+            file.decoder.abort()
+        return JsonResponse({"error": str(ex)}, status=429)
+
+    # Jobs are deferred by the admission control, they are not shed. The job waits for admission without a worker and
+    # is queued with its admission order as priority: live first, then shortest first
+    admit_later(file, is_recording, lambda ticket: jobs.start(job, ticket.key, ticket=ticket))
+
+    return JsonResponse({"job": job.id, "status": job.status}, status=202)
+
+
+def _score(req: HttpRequest) -> JsonResponse:
+    """ Calculates the metrics of the current transcript against the uploaded reference text. """
+    context = _get_context(req)
+    # Only the segments appended since the last score are aligned (see scoring.py)
+    context = score_session(context, req.session.session_key, req.POST['text_upload'])
+    req.session['context'] = context
+
+    res = {'wer': context['wer'], 'wcr': context['wcr'], 'rtf': context['rtf'],
+           'precision_micro': context['precision_micro'], 'precision_macro': context['precision_macro'],
+           'recall_micro': context['recall_micro'], 'recall_macro': context['recall_macro'],
+           'f1_micro': context['f1_micro'], 'f1_macro': context['f1_macro']}
+    return JsonResponse(res)
+
+
+def _render_index(req: HttpRequest) -> HttpResponse:
+    """ Renders main/index.html and starts a new transcript. """
+    context = _get_context(req)
+    context['transcript_start'] = get_transcript_store().count(req.session.session_key)
+    context['to_be_analyzed'] = None
+    req.session['context'] = context
+    with timed("render"):
+        return render(req, 'main/index.html', dict(context, text="", streaming_path=cfg.STREAMING_PATH))
+
+
+async def index(req: HttpRequest) -> Union[HttpResponse, JsonResponse]:
     """ Loads main/index.html and processes POST data (audio input, form data).
     Args:
         req (HttpRequest): Contains information about the page request.
@@ -19,81 +146,118 @@ def index(req: HttpRequest) -> Union[HttpResponse, JsonResponse]:
     Returns:
         Renders main/index.html with main_context OR in case of audio upload (AJAX call) returns
         a JsonResponse containing a wrapper rendered to a string (more info in notes). May also return
-        a JsonResponse containing an error if an uploaded file is considered too short.
+        a JsonResponse containing an error if an uploaded file is considered too short. If the audio is posted
+        with async=true it is queued and the id of the job is returned (202), or a 429 if the queue is full. Audio
+        that is shed by the admission control (see admission.py) gets a 429 with a Retry-After header.
 
     Notes:
         - Currently the only way I've found to clear POST values and render the page after an AJAX call
         (without redirecting) has been to return the wrapper rendered to a string in JSON, save the JSON in
         session storage using JS, refresh the page, insert the wrapper on the page and then delete it from
         session storage. It's not optimal but it works for now.
+        - The view is async: under ASGI (recorder/asgi.py) decoding and recognition are awaited instead of
+        occupying a thread, the body, the session and the database are handled in worker threads.
     """
+    # Audio is decoded while it is received (see uploads.py)
+    if cfg.UPLOAD_DECODING:
+        req.upload_handlers.insert(0, DecodingUploadHandler(req))
+    rejected = await sync_to_async(_check_request)(req)
+    if rejected is not None:
+        abort_decoders(req)
+        return rejected
 
-    # Create context from JSON and initialize some keys
-    with open('main/config.json') as jsonfile:
-        req.session.setdefault('context', json.load(jsonfile))
-
-    GOOGLE_AUTHENTICATION_FILE_NAME = "dialogflow.json"
-    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), GOOGLE_AUTHENTICATION_FILE_NAME)
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = path
-
-    # Create wrapper for session context and update model variables
-    context = req.session["context"]
+    # Audio that was rejected while it was received (it can not be decoded or is too short)
+    if req.method == 'POST' and upload_error(req):
+        abort_decoders(req)
+        return JsonResponse({"error": upload_error(req)}, status=400)
 
     # On audio upload or in-app recording:
     if req.method == 'POST' and (req.FILES.get("audio_upload", False) or req.FILES.get("audio_recording", False)):
 
-        # Convert audio to .wav and save it
         is_recording = False if req.FILES.get("audio_upload", False) else True
         file = req.FILES['audio_recording'] if is_recording else req.FILES['audio_upload']
-        context, to_be_analyzed = save_recording(context=context, file=file, is_recording=is_recording)
-
-        if "reset" in req.POST and req.POST["reset"] == "true":
-            old_text = ""
-        else:
-            old_text = context['text'] + " "
+        reset = req.POST.get("reset") == "true"
+        # Only one upload is transcribed
+        abort_decoders(req, keep=file)
 
-        context['text'], context['rtf'] = speech_to_text(context['to_be_analyzed'])
-        context['text'] = old_text + context['text']
+        if req.POST.get("async") == "true":
+            return await sync_to_async(_submit)(req, file, is_recording, reset)
 
-        if not is_recording:
-            context['text'] = context['text'].capitalize()
+        # Decode the audio once in memory and recognize it
+        session_id = await sync_to_async(_recognition_session)(req)
+        try:
+            result = await transcribe_async(file, is_recording, session_id)
+        except ValueError as ex:
+            return JsonResponse({"error": str(ex)}, status=400)
+        except Overloaded as ex:
+            response = JsonResponse({"error": str(ex)}, status=429)
+            response['Retry-After'] = str(ex.retry_after)
+            return response
+        finally:
+            # The request may end before the upload was decoded (shed, or failed before it was saved)
+            abort_decoders(req)
 
-        # Replace session context with wrapper
-        req.session['context'] = context
-
-        # Render wrapper and return it to AJAX call
-        res = {"text": context['text']}
-        return JsonResponse(res)
+        # Return the complete transcript to the AJAX call
+        text = await sync_to_async(_update_text)(req, result, reset, is_recording)
+        return JsonResponse({"text": text, "segments": result['segments']})
 
+    # Audio that is posted with other form data is not transcribed
+    abort_decoders(req)
     if req.method == 'POST' and "text_upload" in req.POST:
         # Calculate metrics
-        transformation = jiwer.Compose([
-            jiwer.ToLowerCase(),
-            jiwer.RemoveMultipleSpaces(),
-            jiwer.SentencesToListOfWords(word_delimiter=" "),
-            jiwer.RemoveMultipleSpaces(),
-            jiwer.Strip(),
-            jiwer.RemoveEmptyStrings(),
-            jiwer.RemovePunctuation()
-        ])
-
-        truth = transformation(req.POST['text_upload'])
-        hypothesis = transformation(context['text'])
-
-        context = calculate_metrics(context, truth, hypothesis)
-        req.session['context'] = context
-
-        res = {'wer': context['wer'], 'wcr': context['wcr'], 'rtf': context['rtf'],
-               'precision_micro': context['precision_micro'], 'precision_macro': context['precision_macro'],
-               'recall_micro': context['recall_micro'], 'recall_macro': context['recall_macro'],
-               'f1_micro': context['f1_micro'], 'f1_macro': context['f1_macro']}
-        return JsonResponse(res)
-
-    context['text'] = ""
-    context['to_be_analyzed'] = None
-    # Replace session context with wrapper
-    req.session['context'] = context
-    return render(req, 'main/index.html', req.session['context'])
+        return await sync_to_async(_score)(req)
+
+    return await sync_to_async(_render_index)(req)
+
+
+# csrf_exempt() would wrap the coroutine in a sync view (Django < 4.1), _check_request() does the CSRF check
+index.csrf_exempt = True
+
+
+async def job_status(req: HttpRequest, job_id: str) -> JsonResponse:
+    """ Returns the status of a transcription job, waits for it to finish first if ?wait=<seconds> is given
+    (long-polling, capped at JOB_LONG_POLL_TIMEOUT). When the job is done its text is added to the session context,
+    in the order the jobs of the session were submitted: a job that finished before an earlier one is "waiting" until
+    that one is finished too. The view is async, so a long-poll does not occupy a thread while it waits.
+
+    Args:
+        req (HttpRequest): Incoming request
+        job_id (str): Id of the job as returned by index
+
+    Returns:
+        JsonResponse: Status, timings and, once done, the text, RTF and segments (or the error) of the job.
+    """
+    jobs = get_job_queue()
+    job = jobs.get(job_id)
+    if job is None or job.owner != req.session.session_key:
+        return JsonResponse({"error": "Unknown job."}, status=404)
+
+    try:
+        wait = min(float(req.GET.get("wait", 0)), cfg.JOB_LONG_POLL_TIMEOUT)
+    except ValueError:
+        wait = 0
+    deadline = time.monotonic() + wait
+    if wait > 0:
+        await job.wait_async(wait)
+
+    held_back = None
+    if job.finished.is_set():
+        # Apply the results of the session in submission order, each only once, even if the job is polled again
+        while True:
+            held_back = await sync_to_async(jobs.apply)(job, lambda finished: _apply_job(req, finished))
+            if held_back is None or deadline - time.monotonic() <= 0:
+                break
+            await held_back.wait_async(deadline - time.monotonic())
+
+    res = {"job": job.id, "status": job.status, "timings": job.timings}
+    if held_back is not None:
+        res["status"] = "waiting"
+    elif job.status == "done":
+        res.update({"text": job.data["text"], "rtf": job.result['rtf'], "segments": job.result['segments']})
+    elif job.status == "failed":
+        res["error"] = job.error
+
+    return JsonResponse(res)
 
 
 def info(req: HttpRequest) -> HttpResponse:
@@ -106,3 +270,30 @@ def info(req: HttpRequest) -> HttpResponse:
         HttpResponse: Response produced by this view
     """
     return render(req, "main/info.html")
+
+
+def metrics(req: HttpRequest) -> HttpResponse:
+    """ Exposes the latency histograms of this process, the transcription cache, media store, recognizer pool, model
+    batching and admission counters and the length of the job queue in the Prometheus text format.
+
+    Args:
+        req (HttpRequest): Incoming request
+
+    Returns:
+        HttpResponse: The metrics as text/plain.
+    """
+    body = get_metrics().render()
+    body += render_gauge('speech_transcription_cache', "Counters and size of the transcription cache.",
+                         get_transcription_cache().stats(), 'counter')
+    body += render_gauge('speech_job_queue', "Number of queued transcription jobs.",
+                         {"queued": len(get_job_queue())}, 'state')
+    body += render_gauge('speech_media_store', "Counters and size of the media store.",
+                         get_media_store().stats(), 'counter')
+    body += render_gauge('speech_recognizer_pool', "Slots, waiting requests, retries, hedges and latencies of the "
+                         "recognizer pool.", recognizer_stats(), 'counter')
+    admission = get_admission_controller()
+    body += render_gauge('speech_admission', "Admitted, deferred and shed transcriptions per class and the seconds "
+                         "of audio in flight and waiting.", admission.stats() if admission else {}, 'counter')
+    body += render_gauge('speech_model_batching', "Batches, inputs and queued inputs of the local models.",
+                         get_model_registry().stats(), 'counter')
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,85 @@
+""" Contains the warm-up phase of a worker. Heavy libraries are imported lazily, on first use, so a worker starts
+fast. When WARM_UP is set in settings.py, a server process runs warm_up() at boot instead: it exercises every stage
+of the pipeline once (the FFMPEG decoder, the metrics engine, transcript normalization, the local models and the
+recognition backend client), so the first request after a restart is not slower than the others.
+
+Only the servers warm up (recorder/wsgi.py and asgi.py call prepare_server()), management commands do not start the
+threads of the job queue and the recognizer pool or load the models. A server that loads the application in a master
+and forks its workers from it (gunicorn --preload, see PRELOAD_MODELS in settings.py) warms up every forked worker,
+threads and models do not survive the fork.
+"""
+
+import io
+import logging
+import os
+import time
+import wave
+from collections import OrderedDict
+from src.main.analyzer import create_global_models
+from src.main.audio import decode_audio
+from src.main.jobs import get_job_queue
+from src.main.metrics import align, score
+from src.main.normalization import get_normalizer
+from src.main.recognizers import get_recognizer
+from src.main.cache import get_transcription_cache
+from src.main.media import get_media_store
+
+
+def _silence(seconds: float, sample_rate: int = 8000) -> bytes:
+    """ Creates a silent WAV file, its sample rate differs from SAMPLE_RATE so it is decoded by FFMPEG. """
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b'\0\0' * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+STEPS = OrderedDict([
+    ("decoder", lambda: decode_audio(_silence(0.5), name="warm-up")),
+    ("metrics", lambda: score(align(["warm", "up", "the", "worker"], ["warm", "the", "workers"]))),
+    ("normalization", lambda: get_normalizer().ids("Warm up the worker.")),
+    ("cache", get_transcription_cache),
+    ("jobs", get_job_queue),
+    ("media", get_media_store),
+    ("models", create_global_models),
+    ("recognizer", get_recognizer),
+])
+
+
+def warm_up() -> dict:
+    """ Runs every warm-up step, a step that fails is logged and skipped (the request that needs it will fail).
+
+    Returns:
+        dict: Seconds spent per step, None for the steps that failed.
+    """
+    timings = OrderedDict()
+    for name, step in STEPS.items():
+        start = time.time()
+        try:
+            step()
+            timings[name] = round(time.time() - start, 4)
+
+        except Exception as ex:
+            logging.error("Warm-up step '%s' failed: %s", name, ex)
+            timings[name] = None
+
+    logging.info("Worker warmed up: %s", ", ".join("{} {}s".format(*item) for item in timings.items()))
+    return timings
+
+
+def prepare_server():
+    """ Prepares a server process when it loads the application: imports the libraries of the local models
+    (PRELOAD_MODELS) and warms up (WARM_UP), in the forked workers if the libraries are preloaded in a master. """
+    # The settings module is configured by the server at this point
+    from django.conf import settings
+
+    if settings.PRELOAD_MODELS:
+        from src.main.inference import preload_model_libraries
+        preload_model_libraries()
+    if settings.WARM_UP:
+        if settings.PRELOAD_MODELS:
+            os.register_at_fork(after_in_child=warm_up)
+        else:
+            warm_up()
@@ -2,6 +2,9 @@
 ASGI config for recorder project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are handled by Django, WebSocket connections by the streaming
+transcription endpoint in main/streaming.py. The index and job views are async,
+so under ASGI decoding, recognition and long-polls do not occupy a thread.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -13,4 +16,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'recorder.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from src.main.streaming import websocket_application  # noqa: E402 (needs the configured settings)
+from src.main.warmup import prepare_server  # noqa: E402
+
+prepare_server()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
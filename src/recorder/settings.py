@@ -11,12 +11,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
-# INFO and WARNING messages are not printed
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-
-# Load TensorFlow on start and only enable error logging
-import tensorflow as tf
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+# INFO and WARNING messages of TensorFlow are not printed (when it is loaded)
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -32,7 +28,7 @@ SECRET_KEY = '*2_=ojikyl!su5l(osebwd17a7c=ol+)wtq54*=_11f%3gcjj$'
 DEBUG = True if os.environ.get("DEBUG", True) != "0" else False
 
 SESSION_COOKIE_SECURE = False
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
 # Allow default hosts in DEBUG, allow all in production
 ALLOWED_HOSTS = [] if DEBUG else ["*"]
@@ -49,8 +45,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'src.main.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'src.main.instrumentation.TimedSessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -89,6 +86,18 @@ DATABASES = {
     }
 }
 
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Use a cache that is shared between the workers (memcached, redis) when running more than one worker process
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -110,6 +119,21 @@ AUTH_PASSWORD_VALIDATORS = [
 MEDIA_URL = '/audio/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'audio')
 
+# Lifecycle of the audio files in MEDIA_ROOT (see media.py): uploads up to SPOOL_MAX_BYTES and all recordings are
+# processed in memory only, larger uploads are stored content addressed if PERSIST is set. The collector runs every
+# COLLECT_INTERVAL seconds (0 disables it) and removes files older than TTL, then the oldest files above MAX_BYTES.
+MEDIA = {
+    'PERSIST': os.environ.get("MEDIA_PERSIST", "1") != "0",
+    'SPOOL_MAX_BYTES': 5 * 1024 * 1024,
+    'TTL': 24 * 3600,
+    'MAX_BYTES': 2 * 1024 ** 3,
+    'COLLECT_INTERVAL': 600,
+}
+# Uploads Django keeps in memory, larger ones are spooled to a temporary file
+FILE_UPLOAD_MAX_MEMORY_SIZE = MEDIA['SPOOL_MAX_BYTES']
+# Decode uploaded audio while it is received (see uploads.py), invalid or too short files are rejected early
+UPLOAD_DECODING = os.environ.get("UPLOAD_DECODING", "1") != "0"
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
 
@@ -158,3 +182,218 @@ logging.config.dictConfig({
     },
 })
 MIN_LEN = 2.5
+
+# Audio decoding: every file is decoded once to mono 16-bit PCM at this sample rate (speech needs no more than 16 kHz)
+SAMPLE_RATE = 16000
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+
+# Encodings of the audio sent to the recognizer, in order of preference: the first one the backend accepts is used
+# (see encoding.py). OGG_OPUS passes the recorded Opus stream through, FLAC is lossless, LINEAR16 is raw PCM.
+PAYLOAD_ENCODINGS = ('OGG_OPUS', 'FLAC', 'LINEAR16')
+
+# Warm up the server workers when they start (decoder, metrics, normalization, the local models and the recognition
+# backend client), so the first request does not pay for it. Set WARM_UP=1 to enable it, management commands never
+# warm up (see warmup.py).
+WARM_UP = os.environ.get("WARM_UP", "0") != "0"
+
+# Voice activity detection: audio is analyzed in frames of FRAME_MS, a frame is speech if its energy (dBFS) is above
+# ENERGY_THRESHOLD and NOISE_MARGIN dB above the noise floor (at most NOISE_MARGIN dB below the loudest frame), or up
+# to ZCR_MARGIN dB lower with a zero-crossing rate above ZCR_THRESHOLD. Speech is padded with PADDING_MS, audio with
+# less than MIN_SPEECH_MS of speech is not sent to the recognizer.
+VAD = {
+    'ENABLED': True,
+    'FRAME_MS': 30,
+    'ENERGY_THRESHOLD': -50,
+    'NOISE_MARGIN': 10,
+    'ZCR_MARGIN': 10,
+    'ZCR_THRESHOLD': 0.25,
+    'PADDING_MS': 210,
+    'MIN_SPEECH_MS': 150,
+}
+
+# Audio longer than MAX_SECONDS (the recognizer limits the duration of one request) is split at silence into segments
+# of MIN_SECONDS to MAX_SECONDS, up to WORKERS segments of one file are recognized at the same time
+SEGMENTATION = {
+    'ENABLED': True,
+    'MIN_SECONDS': 20,
+    'MAX_SECONDS': 50,
+    'WORKERS': 8,
+}
+
+# Speech recognition backends, ASR_BACKEND selects the one that is used. "fake" is an offline stand-in with
+# configurable latency (seconds), jitter (seconds), error rate and canned transcripts. "http" posts the audio to a
+# recognition service at ASR_HTTP_URL, e.g. the stand-in started with "manage.py fakerecognizer".
+ASR_BACKEND = os.environ.get("ASR_BACKEND", "dialogflow")
+ASR_BACKENDS = {
+    'dialogflow': {
+        'CLASS': 'src.main.recognizers.DialogflowRecognizer',
+        'OPTIONS': {
+            'project_id': 'clean-pilot-296112',
+        },
+    },
+    'fake': {
+        'CLASS': 'src.main.recognizers.FakeRecognizer',
+        'OPTIONS': {
+            'transcripts': ["the quick brown fox jumps over the lazy dog"],
+            'latency': 0.1,
+            'jitter': 0.05,
+            'realtime_factor': 0.0,
+            'error_rate': 0.0,
+            'words_per_second': 2.5,
+        },
+    },
+    'http': {
+        'CLASS': 'src.main.recognizers.HttpRecognizer',
+        'OPTIONS': {
+            'url': os.environ.get("ASR_HTTP_URL", "http://127.0.0.1:8765/recognize"),
+            'timeout': 30,
+        },
+        'POOL': {
+            'HEDGE': True,
+        },
+    },
+    'local': {
+        'CLASS': 'src.main.recognizers.LocalModelRecognizer',
+        'OPTIONS': {
+            'model': 'commands',
+        },
+        'POOL': {
+            'MAX_CONCURRENCY': 256,
+            'RETRIES': 0,
+        },
+    },
+}
+
+# Every backend is used through a pool of long-lived clients (see pool.py), POOL in a backend overrides these defaults:
+# CLIENTS clients, at most MAX_CONCURRENCY requests at the same time, up to RETRIES retries after a jittered exponential
+# BACKOFF (seconds) while the DEADLINE (seconds) allows it, and with HEDGE a second attempt for requests that are
+# slower than the HEDGE_PERCENTILE of the recent latencies. Hedging sends requests twice, Dialogflow keeps it off
+# because a duplicated detect_intent can change the state of the session.
+RECOGNIZER_POOL = {
+    'CLIENTS': 1,
+    'MAX_CONCURRENCY': 16,
+    'DEADLINE': 60,
+    'RETRIES': 2,
+    'BACKOFF': 0.2,
+    'HEDGE': False,
+    'HEDGE_PERCENTILE': 95,
+}
+
+# Local Keras models of the "local" backend (see inference.py): the model file at PATH maps the FEATURES of the audio
+# (FEATURES below, overridden per model) to LABELS. A 'classifier' DECODER picks one label (e.g. a command or intent), a
+# 'ctc' DECODER reads the best label (character) per frame, the output after the last label is the blank. Inputs are
+# padded or cut to FRAMES frames (None keeps their length, inputs of the same length are batched together).
+# No model is shipped: the 'commands' model (of the "local" backend) is configured when LOCAL_MODEL_PATH points to it.
+MODELS = {}
+if os.environ.get("LOCAL_MODEL_PATH"):
+    MODELS['commands'] = {
+        'PATH': os.environ["LOCAL_MODEL_PATH"],
+        'LABELS': ['yes', 'no', 'up', 'down', 'left', 'right', 'on', 'off', 'stop', 'go'],
+        'DECODER': 'classifier',
+        'FRAMES': 100,
+    }
+
+# Features of the local models (see features.py): 'logmel' or 'mfcc', SIZE bands or coefficients per frame of
+# WINDOW_MS milliseconds every HOP_MS milliseconds
+FEATURES = {
+    'KIND': 'logmel',
+    'SIZE': 40,
+    'WINDOW_MS': 25,
+    'HOP_MS': 10,
+}
+
+# Precomputed features of evaluation corpora (see features.py and "manage.py extractfeatures"), one store per corpus
+# and features in DIRECTORY, stored as DTYPE ('float16' or 'float32')
+FEATURE_STORE = {
+    'DIRECTORY': os.path.join(BASE_DIR, 'cache', 'features'),
+    'DTYPE': 'float16',
+}
+
+# Concurrent predictions of a local model are batched: up to MAX_BATCH inputs, the oldest one waits at most
+# MAX_WAIT_MS for the others. BATCHING in a model overrides these defaults.
+MODEL_BATCHING = {
+    'MAX_BATCH': 32,
+    'MAX_WAIT_MS': 5,
+}
+
+# Import the libraries of the local models when the server loads the application. The models themselves can not be
+# loaded before a fork (TensorFlow does not survive it), so a server that forks its workers from a preloaded master
+# (gunicorn --preload) shares the code of the libraries copy-on-write and every worker loads the models once (WARM_UP
+# runs after the fork then, or on first use). Set it only for such servers.
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "0") != "0"
+
+# Transcription cache: in-memory LRU (MAX_ENTRIES per process) and a DIRECTORY shared by all workers,
+# entries expire after TTL seconds. The collector of the DIRECTORY runs every COLLECT_INTERVAL seconds (0 disables it)
+# and removes the expired entries, then the oldest entries above MAX_BYTES.
+TRANSCRIPTION_CACHE = {
+    'ENABLED': os.environ.get("TRANSCRIPTION_CACHE", "1") != "0",
+    'MAX_ENTRIES': 1024,
+    'TTL': 7 * 24 * 3600,
+    'DIRECTORY': os.path.join(BASE_DIR, 'cache', 'transcripts'),
+    'MAX_BYTES': 256 * 1024 ** 2,
+    'COLLECT_INTERVAL': 600,
+}
+
+# Transcripts are stored as append-only segments: in the CACHE for TIMEOUT seconds and written to the database in
+# batches of BATCH_SIZE segments, or when the oldest unwritten segment is FLUSH_INTERVAL seconds old. The segment
+# counters are kept in the CACHE if it is shared by all workers (SHARED_CACHE, None detects it from the backend),
+# otherwise by the process: then every session has to be served by one process, use a shared CACHE with more workers
+TRANSCRIPTS = {
+    'CACHE': 'default',
+    'SHARED_CACHE': None,
+    'TIMEOUT': 24 * 3600,
+    'BATCH_SIZE': 50,
+    'FLUSH_INTERVAL': 30,
+}
+
+# Normalization of transcripts for scoring (see normalization.py): words are mapped to ids of a vocabulary per process,
+# a new vocabulary is started above MAX_WORDS words; the ids of the last MEMO_SIZE reference texts are memoized
+NORMALIZATION = {
+    'MAX_WORDS': 1000000,
+    'MEMO_SIZE': 256,
+}
+
+# Live scoring (see scoring.py): every session keeps the alignment of its transcript against the reference text, the
+# alignments of all sessions together use up to MAX_CELLS bytes (one byte per reference word per transcript word)
+SCORING = {
+    'MAX_CELLS': 256 * 1024 * 1024,
+}
+
+# Instrumentation: the durations of the pipeline stages and requests are collected in histograms with these BUCKETS
+# (seconds), exposed per process at /metrics in the Prometheus text format and sent in a Server-Timing header
+INSTRUMENTATION = {
+    'ENABLED': True,
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+}
+
+# Baseline of "manage.py benchmark", it fails when a case is slower than in this file (it depends on the machine, save
+# one with --save-baseline first, the command fails without it)
+BENCHMARK_BASELINE = os.path.join(BASE_DIR, 'main', 'benchmarks', 'baseline.json')
+
+# Admission control of transcriptions (see admission.py): at most MAX_INFLIGHT_SECONDS seconds of audio are processed
+# at the same time per process, recording chunks and audio of up to SHORT_SECONDS are "live" work and are admitted
+# before longer "bulk" uploads, shortest first. Bulk work uses at most BULK_SHARE of MAX_INFLIGHT_SECONDS, the rest is
+# reserved for live work. A request is shed (429) when the audio waiting in its class would exceed MAX_QUEUED_SECONDS
+# or it waited MAX_WAIT seconds, jobs wait instead. Files without a duration in their header are estimated at
+# BYTES_PER_SECOND until they are decoded.
+ADMISSION = {
+    'ENABLED': os.environ.get("ADMISSION", "1") != "0",
+    'MAX_INFLIGHT_SECONDS': 600,
+    'BULK_SHARE': 0.5,
+    'SHORT_SECONDS': 10,
+    'MAX_WAIT': {'live': 10, 'bulk': 30},
+    'MAX_QUEUED_SECONDS': {'live': 600, 'bulk': 1800},
+    'BYTES_PER_SECOND': 8000,
+}
+
+# Transcription job queue: number of worker threads, maximum number of queued jobs (more gives a 429),
+# seconds a finished job is kept and the maximum number of seconds a client may long-poll for a result
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 32))
+JOB_RESULT_TTL = 300
+JOB_LONG_POLL_TIMEOUT = 30
+
+# Live transcription over WebSocket (served by recorder/asgi.py), every open stream takes a thread: at most
+# STREAMING_MAX_STREAMS streams per process, more connections are closed with 1013 (try again later)
+STREAMING_PATH = '/stream'
+STREAMING_MAX_STREAMS = int(os.environ.get("STREAMING_MAX_STREAMS", 32))
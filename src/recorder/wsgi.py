@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'recorder.settings')
 
 application = get_wsgi_application()
+
+from src.main.warmup import prepare_server  # noqa: E402 (needs the configured settings)
+
+prepare_server()